@@ -0,0 +1,515 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""asyncio client API over pyngus.
+
+An AsyncContainer drives its pyngus Connections from the asyncio event loop
+(loop.add_reader/add_writer for the sockets, loop.call_at for the
+Connection deadlines), so a single process can run thousands of independent
+clients as coroutines:
+
+    container = AsyncContainer()
+    connection = await container.connect("127.0.0.1", 5672)
+    sender = await connection.create_sender("queue")
+    status = await sender.send(Message(body="hi"))
+    receiver = await connection.create_receiver("queue")
+    async for message in receiver:
+        ...
+    await connection.close()
+
+Like utils.EventLoop, a Connection that becomes ready is only marked as
+dirty: all the dirty Connections are processed in one pass per loop
+iteration, after which their reader/writer/timer registrations are updated
+only if they changed.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+import uuid
+
+import pyngus
+
+from utils import connect_socket
+
+LOG = logging.getLogger()
+
+
+class AMQPError(Exception):
+    """A connection or link failed, or was closed by the peer."""
+    def __init__(self, message, condition=None):
+        super(AMQPError, self).__init__(message)
+        self.condition = condition
+
+
+def _condition_error(what, pn_condition):
+    return AMQPError("%s closed by peer: %s" % (what, pn_condition),
+                     pn_condition)
+
+
+def _set_result(future, result=None):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, error):
+    if not future.done():
+        future.set_exception(error)
+        # the error may also be raised by a later call: don't log it as
+        # never retrieved
+        future.exception()
+
+
+class AsyncContainer(object):
+    """Create AsyncConnections and drive them from an asyncio event loop.
+    The event loop defaults to the running loop.
+    """
+    def __init__(self, name=None, loop=None):
+        self.container = pyngus.Container(name or uuid.uuid4().hex)
+        self._loop = loop
+        self._connections = set()
+        self._dirty = set()
+        self._scheduled = False
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return self._loop
+
+    def __len__(self):
+        return len(self._connections)
+
+    async def connect(self, host, port, properties=None, name=None):
+        """Connect to host:port and return the AsyncConnection once it is
+        active.  properties are the pyngus connection properties.
+        """
+        connection = AsyncConnection(self, host, port, properties, name)
+        try:
+            await connection.opened
+        except BaseException:
+            connection._abort()
+            raise
+        return connection
+
+    async def close(self):
+        """Close all the connections."""
+        connections = list(self._connections)
+        if connections:
+            await asyncio.gather(*[c.close() for c in connections],
+                                 return_exceptions=True)
+        self.container.destroy()
+
+    # Called by the AsyncConnections
+
+    def _add(self, connection):
+        self._connections.add(connection)
+        self._schedule(connection)
+
+    def _remove(self, connection):
+        self._connections.discard(connection)
+        self._dirty.discard(connection)
+
+    def _schedule(self, connection):
+        """Process connection on the next loop iteration."""
+        self._dirty.add(connection)
+        if not self._scheduled:
+            self._scheduled = True
+            self.loop.call_soon(self._run)
+
+    def _run(self):
+        self._scheduled = False
+        dirty, self._dirty = self._dirty, set()
+        now = time.time()
+        for connection in dirty:
+            connection._process(now)
+
+
+class AsyncConnection(pyngus.ConnectionEventHandler):
+    """A pyngus Connection and its socket, registered with the event loop
+    of an AsyncContainer.
+    """
+    def __init__(self, container, host, port, properties=None, name=None):
+        self._container = container
+        self._loop = container.loop
+        self.socket = connect_socket(host, port, blocking=False)
+        self.connection = container.container.create_connection(
+            name or uuid.uuid4().hex, self, properties)
+        self.opened = self._loop.create_future()
+        self.closed = self._loop.create_future()
+        self.error = None
+        self._links = set()
+        self._reading = False
+        self._writing = False
+        self._timer = None
+        self._deadline = None
+        self.connection.open()
+        container._add(self)
+
+    @property
+    def name(self):
+        return self.connection.name
+
+    async def create_sender(self, target, source=None, name=None,
+                            properties=None):
+        """Attach a sender link to target and return the AsyncSender once it
+        is active.
+        """
+        sender = AsyncSender(self, target, source, name, properties)
+        await sender.opened
+        return sender
+
+    async def create_receiver(self, source, target=None, name=None,
+                              properties=None, credit=100):
+        """Attach a receiver link to source (None for a dynamic source) and
+        return the AsyncReceiver once it is active.  credit is the number of
+        messages that can be buffered before they are consumed.
+        """
+        receiver = AsyncReceiver(self, source, target, name, properties,
+                                 credit)
+        await receiver.opened
+        return receiver
+
+    async def close(self):
+        """Close the connection and wait for the peer to close it."""
+        if not self.closed.done():
+            self.connection.close()
+            self.wakeup()
+            try:
+                await self.closed
+            except AMQPError:
+                pass
+        self._abort()
+
+    def wakeup(self):
+        """Process the connection after a call into pyngus that may have
+        generated output.
+        """
+        self._container._schedule(self)
+
+    def _abort(self):
+        """Release the socket and the pyngus Connection."""
+        if self.socket is None:
+            return
+        self._finish(AMQPError("Connection aborted"))
+        self._register(False, False)
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._container._remove(self)
+        self.socket.close()
+        self.socket = None
+        self.connection.destroy()
+
+    def _finish(self, error=None):
+        """The connection is closed: error is None if it was closed
+        cleanly.
+        """
+        if self.closed.done():
+            return
+        self.error = error
+        _set_exception(self.opened, error or AMQPError("Connection closed"))
+        if error:
+            _set_exception(self.closed, error)
+        else:
+            self.closed.set_result(None)
+        for link in list(self._links):
+            link._finish(error)
+
+    # I/O
+
+    def _register(self, reading, writing):
+        if reading != self._reading:
+            if reading:
+                self._loop.add_reader(self.socket, self._readable)
+            else:
+                self._loop.remove_reader(self.socket)
+            self._reading = reading
+        if writing != self._writing:
+            if writing:
+                self._loop.add_writer(self.socket, self._writable)
+            else:
+                self._loop.remove_writer(self.socket)
+            self._writing = writing
+
+    def _readable(self):
+        try:
+            pyngus.read_socket_input(self.connection, self.socket)
+        except Exception as e:
+            LOG.error("Socket error on read: %s", str(e))
+            self.connection.close_input()
+            self.connection.close()
+        self.wakeup()
+
+    def _writable(self):
+        try:
+            pyngus.write_socket_output(self.connection, self.socket)
+        except Exception as e:
+            LOG.error("Socket error on write %s", str(e))
+            self.connection.close_output()
+            self.connection.close()
+        self.wakeup()
+
+    def _timeout(self):
+        self._timer = None
+        self._deadline = None
+        self.wakeup()
+
+    def _process(self, now):
+        if self.socket is None:
+            return
+        connection = self.connection
+        connection.process(now)
+        if self.socket is None:
+            # aborted from a callback
+            return
+        self._register(connection.needs_input > 0, connection.has_output > 0)
+        deadline = connection.deadline
+        if deadline != self._deadline:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if deadline:
+                # pyngus deadlines are in time.time() units
+                self._timer = self._loop.call_at(
+                    self._loop.time() + max(deadline - now, 0),
+                    self._timeout)
+            self._deadline = deadline
+
+    # ConnectionEventHandler callbacks
+
+    def connection_active(self, connection):
+        _set_result(self.opened, self)
+
+    def connection_failed(self, connection, error):
+        LOG.debug("Connection %s failed: %s", self.name, error)
+        self._finish(AMQPError("Connection failed: %s" % error))
+
+    def connection_remote_closed(self, connection, pn_condition):
+        LOG.debug("Connection %s closed by peer: %s", self.name, pn_condition)
+        if pn_condition:
+            self._finish(_condition_error("Connection", pn_condition))
+        connection.close()
+        self.wakeup()
+
+    def connection_closed(self, connection):
+        self._finish()
+
+
+class _AsyncLink(object):
+    """Common state of AsyncSender and AsyncReceiver."""
+    def __init__(self, connection):
+        self._connection = connection
+        self.opened = connection._loop.create_future()
+        self.done = connection._loop.create_future()
+        self.error = None
+        self.link = None
+        connection._links.add(self)
+
+    @property
+    def name(self):
+        return self.link.name
+
+    async def close(self):
+        """Detach the link."""
+        if self.link is not None and not self.link.closed:
+            self.link.close()
+            self._connection.wakeup()
+            await self.done
+        self._destroy()
+
+    def _destroy(self):
+        self._connection._links.discard(self)
+        if self.link is not None:
+            self.link.destroy()
+            self.link = None
+
+    def _finish(self, error=None):
+        """The link is closed: error is None if it was closed cleanly."""
+        if self.done.done():
+            return
+        self.error = error
+        _set_exception(self.opened, error or AMQPError("Link closed"))
+        self.done.set_result(None)
+
+    # Link callbacks, shared by senders and receivers
+
+    def _link_active(self, link):
+        _set_result(self.opened, self)
+
+    def _link_remote_closed(self, link, pn_condition):
+        if pn_condition:
+            self._finish(_condition_error("Link %s" % link.name,
+                                          pn_condition))
+        link.close()
+        self._connection.wakeup()
+
+    def _link_failed(self, link, error):
+        self._finish(AMQPError("Link %s failed: %s" % (link.name, error)))
+
+    def _link_closed(self, link):
+        self._finish()
+
+
+class AsyncSender(_AsyncLink, pyngus.SenderEventHandler):
+    """Send messages on a pyngus SenderLink."""
+
+    ACCEPTED = pyngus.SenderLink.ACCEPTED
+
+    def __init__(self, connection, target, source=None, name=None,
+                 properties=None):
+        super(AsyncSender, self).__init__(connection)
+        self._unsettled = set()
+        self.link = connection.connection.create_sender(
+            source or "", target, self, name, properties)
+        self.link.open()
+        connection.wakeup()
+
+    @property
+    def credit(self):
+        return self.link.credit
+
+    @property
+    def pending(self):
+        """Messages sent and not yet settled by the peer."""
+        return len(self._unsettled)
+
+    def _check(self):
+        if self.done.done():
+            raise self.error or AMQPError("Link closed")
+
+    def send(self, message, timeout=None):
+        """Send message and return a Future for its outcome: one of the
+        pyngus.SenderLink status values (ACCEPTED, REJECTED, RELEASED,
+        MODIFIED, ABORTED or TIMED_OUT).  The message is queued until the
+        peer grants credit.
+        """
+        self._check()
+        future = self._connection._loop.create_future()
+        self._unsettled.add(future)
+        deadline = time.time() + timeout if timeout else None
+        self.link.send(message, self._settled, future, deadline)
+        self._connection.wakeup()
+        return future
+
+    def send_presettled(self, message):
+        """Send message pre-settled, without waiting for its outcome."""
+        self._check()
+        self.link.send(message)
+        self._connection.wakeup()
+
+    def _settled(self, link, future, status, error):
+        self._unsettled.discard(future)
+        _set_result(future, status)
+
+    def _finish(self, error=None):
+        super(AsyncSender, self)._finish(error)
+        # pyngus aborts the pending sends when the link closes, but not
+        # when the connection is torn down under it
+        unsettled, self._unsettled = self._unsettled, set()
+        for future in unsettled:
+            _set_result(future, pyngus.SenderLink.ABORTED)
+
+    sender_active = _AsyncLink._link_active
+    sender_remote_closed = _AsyncLink._link_remote_closed
+    sender_failed = _AsyncLink._link_failed
+    sender_closed = _AsyncLink._link_closed
+
+
+class AsyncReceiver(_AsyncLink, pyngus.ReceiverEventHandler):
+    """Receive messages from a pyngus ReceiverLink with receive() or
+    async for.  Messages are accepted as they arrive.  Credit is granted
+    for up to credit buffered (received and not yet consumed) messages, and
+    replenished once half of it has been consumed.
+    """
+    def __init__(self, connection, source, target=None, name=None,
+                 properties=None, credit=100):
+        super(AsyncReceiver, self).__init__(connection)
+        self._credit = max(credit, 1)
+        self._buffer = collections.deque()
+        self._waiter = None
+        self.link = connection.connection.create_receiver(
+            target or "", source, self, name, properties)
+        self.link.add_capacity(self._credit)
+        self.link.open()
+        connection.wakeup()
+
+    @property
+    def source_address(self):
+        """The source address, as assigned by the peer for a dynamic
+        source.
+        """
+        return self.link.source_address
+
+    @property
+    def buffered(self):
+        """Messages received and not yet consumed."""
+        # not __len__: pyngus tests its handlers for truth
+        return len(self._buffer)
+
+    def _replenish(self):
+        granted = self.link.capacity + len(self._buffer)
+        if granted <= self._credit // 2:
+            self.link.add_capacity(self._credit - granted)
+            self._connection.wakeup()
+
+    async def receive(self):
+        """Return the next message.  Raises AMQPError once the link is
+        closed and the messages received before have been consumed.
+        """
+        while not self._buffer:
+            if self.done.done():
+                raise self.error or AMQPError("Link closed")
+            self._waiter = self._connection._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        message = self._buffer.popleft()
+        if not self.done.done():
+            self._replenish()
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Iteration stops when the link is closed cleanly."""
+        try:
+            return await self.receive()
+        except AMQPError:
+            if self.error:
+                raise
+            raise StopAsyncIteration
+
+    def _finish(self, error=None):
+        super(AsyncReceiver, self)._finish(error)
+        if self._waiter is not None:
+            _set_result(self._waiter)
+
+    def message_received(self, receiver_link, message, handle):
+        receiver_link.message_accepted(handle)
+        self._buffer.append(message)
+        if self._waiter is not None:
+            _set_result(self._waiter)
+
+    receiver_active = _AsyncLink._link_active
+    receiver_remote_closed = _AsyncLink._link_remote_closed
+    receiver_failed = _AsyncLink._link_failed
+    receiver_closed = _AsyncLink._link_closed
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Run a benchmark scenario against the perf clients and save the results.
+
+A scenario is a JSON file describing which perf tools ("engines") to run,
+with what options, and how many times.  Each engine is run for a number of
+discarded warmup runs followed by the measured trials, and the per trial
+results are summarized with t-distribution confidence intervals.  See
+scenarios/ for examples.
+"""
+
+import copy
+import json
+import logging
+import optparse
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import stats
+from store import ResultsStore
+
+LOG = logging.getLogger()
+LOG.addHandler(logging.StreamHandler())
+
+CLIENTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CLIENTS_DIR)
+from utils import get_host_port  # noqa: E402
+
+# the perf tools that support --json:
+TOOLS = ('perf-pyngus', 'perf-tool', 'perf-reactor')
+
+# the per trial results that are summarized across trials:
+METRICS = ('tx_msgs_per_sec', 'rx_msgs_per_sec', 'tx_mb_per_sec',
+           'ack_latency.mean', 'ack_latency.p50', 'ack_latency.p99',
+           'ack_latency.p99.9', 'ack_latency.max',
+           'rx_latency.mean', 'rx_latency.p50', 'rx_latency.p99',
+           'rx_latency.p99.9', 'rx_latency.max')
+
+
+def versions():
+    """Return the versions of the software under test."""
+    values = {'python': platform.python_version()}
+    try:
+        import proton
+        values['proton'] = ".".join(str(v) for v in proton.VERSION)
+    except (ImportError, AttributeError):
+        pass
+    try:
+        import pyngus
+        values['pyngus'] = ".".join(str(v) for v in pyngus.VERSION)
+    except (ImportError, AttributeError):
+        pass
+    return values
+
+
+def command_args(args):
+    """Convert a dict of options into command line arguments.  True means a
+    flag with no value, False or None leaves the option out.
+    """
+    argv = []
+    for name in sorted(args):
+        value = args[name]
+        if value is None or value is False:
+            continue
+        argv.append(("-%s" if len(name) == 1 else "--%s") % name)
+        if value is not True:
+            argv.append(str(value))
+    return argv
+
+
+def metric(results, name):
+    """Look up a dotted metric name in a tool's results.  Returns None if the
+    tool did not measure it (e.g. no receivers).
+    """
+    if name == 'rx_msgs_per_sec' and not results.get('rx_messages'):
+        return None
+    value = results
+    for part in name.split('.', 1):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        if isinstance(value[part], dict) and not value[part].get('samples'):
+            return None  # an empty histogram
+        value = value[part]
+    return value
+
+
+class Server(object):
+    """Run clients/server.py on the scenario's address for the benchmark."""
+    def __init__(self, address, args):
+        self.address = address
+        cmd = [sys.executable, os.path.join(CLIENTS_DIR, 'server.py'),
+               '-a', address] + command_args(args)
+        LOG.debug("Starting server: %s", " ".join(cmd))
+        self._devnull = open(os.devnull, 'w')
+        # the readiness probe makes the server log a connection error, so
+        # only show its logging when debugging:
+        stderr = None if LOG.isEnabledFor(logging.DEBUG) else self._devnull
+        self._process = subprocess.Popen(cmd, stdout=self._devnull,
+                                         stderr=stderr)
+
+    def wait_ready(self, timeout=10.0):
+        host, port = get_host_port(self.address)
+        if host in ('0.0.0.0', ''):
+            host = '127.0.0.1'
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self._process.poll() is not None:
+                raise Exception("server.py exited with status %s"
+                                % self._process.returncode)
+            try:
+                socket.create_connection((host, port), 1.0).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        raise Exception("server.py did not start listening on %s"
+                        % self.address)
+
+    def stop(self):
+        if self._process.poll() is None:
+            self._process.send_signal(signal.SIGINT)
+            self._process.wait()
+        self._devnull.close()
+
+
+def run_tool(tool, args, timeout):
+    """Run a perf tool once.  Returns its JSON results."""
+    cmd = ([sys.executable, os.path.join(CLIENTS_DIR, tool + '.py')] +
+           command_args(args) + ['--json'])
+    LOG.debug("Running: %s", " ".join(cmd))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    try:
+        out, err = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise Exception("%s timed out after %s seconds" % (tool, timeout))
+    if process.returncode:
+        raise Exception("%s exited with status %d: %s"
+                        % (tool, process.returncode, err.strip()))
+    for line in reversed(out.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line)
+    raise Exception("%s printed no results: %s" % (tool, err.strip()))
+
+
+def run_engine(scenario, engine, timeout):
+    """Run the warmup runs and trials of one engine.  Returns its results."""
+    args = dict(scenario.get('args', {}))
+    args.update(engine.get('args', {}))
+    args['a'] = scenario['address']
+    warmup = scenario.get('warmup', {})
+    warmup_args = dict(args)
+    warmup_args.update(warmup.get('args', {}))
+    tool = engine['tool']
+    name = engine.get('name', tool)
+
+    for run in range(warmup.get('runs', 0)):
+        LOG.info("%s: warmup %d", name, run + 1)
+        run_tool(tool, warmup_args, timeout)
+
+    trials = []
+    failures = []
+    for trial in range(scenario.get('trials', 5)):
+        try:
+            results = run_tool(tool, args, timeout)
+        except Exception as e:
+            LOG.error("%s: trial %d failed: %s", name, trial + 1, str(e))
+            failures.append(str(e))
+            continue
+        LOG.info("%s: trial %d: %f msgs/sec", name, trial + 1,
+                 results['tx_msgs_per_sec'])
+        trials.append(results)
+
+    confidence = scenario.get('confidence', 0.95)
+    summary = {}
+    for metric_name in METRICS:
+        values = [metric(results, metric_name) for results in trials]
+        values = [v for v in values if v is not None]
+        if values:
+            summary[metric_name] = stats.summarize(values, confidence)
+    return {'name': name,
+            'tool': tool,
+            'args': args,
+            'trials': trials,
+            'failures': failures,
+            'summary': summary}
+
+
+def run_scenario(scenario, labels, timeout):
+    """Run every engine in the scenario.  Returns the results document."""
+    result = {'scenario': scenario['name'],
+              'description': scenario.get('description', ''),
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'host': platform.node(),
+              'versions': versions(),
+              'config': copy.deepcopy(scenario),
+              'engines': []}
+    result['versions'].update(labels)
+
+    server = None
+    if 'server' in scenario:
+        server = Server(scenario['address'],
+                        scenario['server'].get('args', {}))
+    try:
+        if server:
+            server.wait_ready()
+        for engine in scenario['engines']:
+            result['engines'].append(run_engine(scenario, engine, timeout))
+    finally:
+        if server:
+            server.stop()
+    result['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    return result
+
+
+def load_scenario(path):
+    with open(path) as f:
+        scenario = json.load(f)
+    for key in ('name', 'address', 'engines'):
+        if key not in scenario:
+            raise Exception("scenario %s has no '%s'" % (path, key))
+    for engine in scenario['engines']:
+        if engine.get('tool') not in TOOLS:
+            raise Exception("unknown tool '%s', expected one of %s"
+                            % (engine.get('tool'), ", ".join(TOOLS)))
+    return scenario
+
+
+def report(result):
+    """Return a printable summary of the results as a list of lines."""
+    lines = ["Scenario %s (%s)" % (result['scenario'],
+                                   ", ".join("%s %s" % item for item in
+                                             sorted(result['versions']
+                                                    .items())))]
+    for engine in result['engines']:
+        lines.append(" %s: %d trials, %d failed"
+                     % (engine['name'], len(engine['trials']),
+                        len(engine['failures'])))
+        for name in METRICS:
+            summary = engine['summary'].get(name)
+            if not summary:
+                continue
+            if summary['ci_low'] is None:
+                lines.append("   %-18s %f" % (name, summary['mean']))
+            else:
+                lines.append("   %-18s %f [%f, %f]"
+                             % (name, summary['mean'], summary['ci_low'],
+                                summary['ci_high']))
+    return lines
+
+
+def main(argv=None):
+
+    _usage = """Usage: %prog [options] SCENARIO.json"""
+    parser = optparse.OptionParser(usage=_usage)
+    parser.add_option("--output", type='string',
+                      help='Write the JSON results to this file [stdout]')
+    parser.add_option("--store", type='string',
+                      help='Also append the results to this JSON-lines'
+                      ' results store (see compare.py)')
+    parser.add_option("--label", action="append", default=[],
+                      help='Record KEY=VALUE with the versions, e.g.'
+                      ' dispatch=1.12 (may be repeated)')
+    parser.add_option("--trials", type='int',
+                      help='Override the number of trials in the scenario')
+    parser.add_option("--timeout", type='float', default=600,
+                      help='Fail a run after this many seconds [600]')
+    parser.add_option("--quiet", action="store_true",
+                      help='Do not log progress')
+    parser.add_option("--debug", dest="debug", action="store_true",
+                      help="enable debug logging")
+
+    opts, arguments = parser.parse_args(args=argv)
+    if len(arguments) != 1:
+        parser.error("expected a single scenario file")
+    labels = {}
+    for label in opts.label:
+        key, sep, value = label.partition('=')
+        if not sep:
+            parser.error("bad --label %s, expected KEY=VALUE" % label)
+        labels[key] = value
+    LOG.setLevel(logging.DEBUG if opts.debug else
+                 logging.WARNING if opts.quiet else logging.INFO)
+
+    try:
+        scenario = load_scenario(arguments[0])
+    except Exception as e:
+        parser.error(str(e))
+    if opts.trials:
+        scenario['trials'] = opts.trials
+
+    result = run_scenario(scenario, labels, opts.timeout)
+    if opts.store:
+        ResultsStore(opts.store).append(result)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("\n".join(report(result)))
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    return 0 if all(engine['trials'] for engine in result['engines']) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Compare benchmark results against a stored baseline.
+
+Flags the throughput and p99 latency metrics of each engine that got
+significantly worse, using Welch's t-test on the per trial values.  Exits
+with status 1 if there is any regression, so it can gate an upgrade.
+"""
+
+import json
+import optparse
+import sys
+
+from bench import metric
+import stats
+from store import ResultsStore
+
+# metric name -> True if higher is better
+COMPARED = (('tx_msgs_per_sec', True),
+            ('rx_msgs_per_sec', True),
+            ('ack_latency.p99', False),
+            ('rx_latency.p99', False))
+
+
+def parse_versions(values, parser):
+    versions = {}
+    for value in values:
+        key, sep, version = value.partition('=')
+        if not sep:
+            parser.error("bad version %s, expected KEY=VALUE" % value)
+        versions[key] = version
+    return versions
+
+
+def compare(baseline, candidate, alpha=0.05, min_change=0.0):
+    """Compare two results documents.  Returns a list of (engine, metric,
+    baseline mean, candidate mean, relative change, p-value, verdict) tuples.
+    """
+    rows = []
+    baseline_engines = dict((engine['name'], engine)
+                            for engine in baseline['engines'])
+    for engine in candidate['engines']:
+        base = baseline_engines.get(engine['name'])
+        if base is None:
+            continue
+        for name, higher_is_better in COMPARED:
+            old = [v for v in (metric(r, name) for r in base['trials'])
+                   if v is not None]
+            new = [v for v in (metric(r, name) for r in engine['trials'])
+                   if v is not None]
+            if not old or not new:
+                continue
+            old_mean, new_mean = stats.mean(old), stats.mean(new)
+            change = (new_mean - old_mean) / old_mean if old_mean else 0.0
+            if len(old) < 2 or len(new) < 2:
+                rows.append((engine['name'], name, old_mean, new_mean,
+                             change, None, "too few trials"))
+                continue
+            _, _, p = stats.welch_t_test(old, new)
+            worse = change < 0 if higher_is_better else change > 0
+            if p >= alpha or abs(change) < min_change:
+                verdict = "ok"
+            elif worse:
+                verdict = "REGRESSION"
+            else:
+                verdict = "improved"
+            rows.append((engine['name'], name, old_mean, new_mean, change,
+                         p, verdict))
+    return rows
+
+
+def main(argv=None):
+
+    _usage = """Usage: %prog [options]"""
+    parser = optparse.OptionParser(usage=_usage)
+    parser.add_option("--store", type='string', default='results.jsonl',
+                      help='The results store [results.jsonl]')
+    parser.add_option("--scenario", type='string',
+                      help='Scenario to compare [that of the candidate]')
+    parser.add_option("--baseline", action="append", default=[],
+                      help='KEY=VALUE version of the baseline, e.g.'
+                      ' proton=0.39.0 (may be repeated)')
+    parser.add_option("--candidate", action="append", default=[],
+                      help='KEY=VALUE version of the candidate [latest]')
+    parser.add_option("--candidate-file", type='string',
+                      help='Take the candidate from this bench.py results'
+                      ' file instead of the store')
+    parser.add_option("--alpha", type='float', default=0.05,
+                      help='Significance level [0.05]')
+    parser.add_option("--min-change", type='float', default=0.0,
+                      help='Ignore relative changes smaller than this,'
+                      ' e.g. 0.05 for 5%% [0]')
+
+    opts, _ = parser.parse_args(args=argv)
+    if not opts.baseline:
+        parser.error("--baseline is required")
+    store = ResultsStore(opts.store)
+    baseline_versions = parse_versions(opts.baseline, parser)
+
+    if opts.candidate_file:
+        with open(opts.candidate_file) as f:
+            candidate = json.load(f)
+    else:
+        candidate = store.latest(opts.scenario,
+                                 parse_versions(opts.candidate, parser))
+        if candidate is None:
+            parser.error("no candidate results in %s" % opts.store)
+    scenario = opts.scenario or candidate['scenario']
+    baseline = store.latest(scenario, baseline_versions)
+    if baseline is None:
+        parser.error("no baseline results for %s in %s"
+                     % (scenario, opts.store))
+    if baseline is candidate or baseline == candidate:
+        parser.error("the baseline and candidate are the same results")
+
+    def describe(result):
+        return ", ".join("%s %s" % item
+                         for item in sorted(result['versions'].items()))
+    print("Scenario %s" % scenario)
+    print(" baseline:  %s (%s)" % (describe(baseline), baseline['started']))
+    print(" candidate: %s (%s)" % (describe(candidate), candidate['started']))
+    regressions = 0
+    for engine, name, old, new, change, p, verdict in compare(
+            baseline, candidate, opts.alpha, opts.min_change):
+        print("  %-22s %-16s %12f -> %12f %+7.1f%%  p=%s  %s"
+              % (engine, name, old, new, change * 100.0,
+                 "%.4f" % p if p is not None else "-", verdict))
+        if verdict == "REGRESSION":
+            regressions += 1
+    if regressions:
+        print("%d regression(s)" % regressions)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Small sample statistics for benchmark results, in pure python."""
+
+import math
+
+
+def mean(values):
+    return sum(values) / float(len(values))
+
+
+def stdev(values):
+    """Sample standard deviation (0.0 for fewer than 2 values)."""
+    if len(values) < 2:
+        return 0.0
+    m = mean(values)
+    return math.sqrt(sum((v - m) ** 2 for v in values) / (len(values) - 1))
+
+
+def _beta_fraction(a, b, x):
+    """Continued fraction for the incomplete beta function (modified Lentz
+    method, see Numerical Recipes 6.4).
+    """
+    tiny = 1e-300
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    c = 1.0
+    d = 1.0 - qab * x / qap
+    if abs(d) < tiny:
+        d = tiny
+    d = 1.0 / d
+    h = d
+    for m in range(1, 300):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 3e-16:
+            break
+    return h
+
+
+def betainc(a, b, x):
+    """Regularized incomplete beta function I_x(a, b)."""
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                     a * math.log(x) + b * math.log(1.0 - x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _beta_fraction(a, b, x) / a
+    return 1.0 - front * _beta_fraction(b, a, 1.0 - x) / b
+
+
+def t_cdf(t, df):
+    """Cumulative distribution function of Student's t."""
+    tail = 0.5 * betainc(df / 2.0, 0.5, df / (df + t * t))
+    return 1.0 - tail if t > 0 else tail
+
+
+def t_ppf(p, df):
+    """Inverse of t_cdf: the t value with P(T <= t) == p."""
+    if not 0.0 < p < 1.0:
+        raise ValueError("p must be between 0 and 1")
+    if p < 0.5:
+        return -t_ppf(1.0 - p, df)
+    low, high = 0.0, 1.0
+    while t_cdf(high, df) < p:
+        low, high = high, high * 2
+    for _ in range(100):
+        mid = (low + high) / 2.0
+        if t_cdf(mid, df) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2.0
+
+
+def confidence_interval(values, confidence=0.95):
+    """Return (mean, half width) of the confidence interval for the mean of
+    values, using the t distribution.  The half width is None for a single
+    value.
+    """
+    m = mean(values)
+    if len(values) < 2:
+        return m, None
+    df = len(values) - 1
+    t = t_ppf(0.5 + confidence / 2.0, df)
+    return m, t * stdev(values) / math.sqrt(len(values))
+
+
+def summarize(values, confidence=0.95):
+    """Return a JSON-friendly summary of a list of per-trial values."""
+    m, half = confidence_interval(values, confidence)
+    return {'n': len(values),
+            'mean': m,
+            'stdev': stdev(values),
+            'min': min(values),
+            'max': max(values),
+            'confidence': confidence,
+            'ci_low': m - half if half is not None else None,
+            'ci_high': m + half if half is not None else None}
+
+
+def welch_t_test(a, b):
+    """Welch's unequal variances t-test of the means of samples a and b.
+    Returns (t, degrees of freedom, two-sided p-value).
+    """
+    if len(a) < 2 or len(b) < 2:
+        raise ValueError("need at least two values in each sample")
+    va = stdev(a) ** 2 / len(a)
+    vb = stdev(b) ** 2 / len(b)
+    diff = mean(a) - mean(b)
+    if va + vb == 0.0:
+        # no variation at all: the means either match or they do not
+        return 0.0, float(len(a) + len(b) - 2), 1.0 if diff == 0 else 0.0
+    t = diff / math.sqrt(va + vb)
+    df = (va + vb) ** 2 / (va ** 2 / (len(a) - 1) + vb ** 2 / (len(b) - 1))
+    return t, df, betainc(df / 2.0, 0.5, df / (df + t * t))
@@ -0,0 +1,75 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""An append-only store of benchmark results.
+
+The store is a JSON-lines file: each line is the complete results document
+written by bench.py for one run of a scenario.  Records are keyed by the
+scenario name and the versions (including --label values) they were run
+with.
+"""
+
+import json
+
+
+def matches(record, scenario=None, versions=None):
+    """True if record is for scenario and has all the given versions."""
+    if scenario is not None and record.get('scenario') != scenario:
+        return False
+    record_versions = record.get('versions', {})
+    for key, value in (versions or {}).items():
+        if record_versions.get(key) != value:
+            return False
+    return True
+
+
+class ResultsStore(object):
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, result):
+        """Add a bench.py results document to the store."""
+        line = json.dumps(result, sort_keys=True)
+        with open(self.path, 'a') as f:
+            f.write(line + "\n")
+
+    def records(self, scenario=None, versions=None):
+        """Return the matching records, oldest first."""
+        found = []
+        try:
+            f = open(self.path)
+        except IOError:
+            return found
+        with f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    raise Exception("%s line %d: not valid JSON"
+                                    % (self.path, number))
+                if matches(record, scenario, versions):
+                    found.append(record)
+        return found
+
+    def latest(self, scenario=None, versions=None):
+        """Return the most recent matching record, or None."""
+        found = self.records(scenario, versions)
+        return found[-1] if found else None
@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Connection storm / link churn benchmark.
+
+Opens connections, attaches links on them, then detaches the links and
+closes the connections again, as fast as possible with up to --concurrency
+connections in progress at once.  Reports the connections and links
+completed per second, and the latency from starting the TCP connect until
+the connection (including any SSL and SASL handshakes) and then all its
+links are active.
+
+With SSL all the connections share one SSL context.  --ssl-resume has each
+connection offer to resume the TLS session of the previous one, and
+--ssl-compare measures a run with full handshakes against one with resumed
+sessions, including the CPU time used per connection.
+"""
+
+import json
+import logging
+import optparse
+import os
+import sys
+import time
+import uuid
+
+import pyngus
+
+from metrics import add_metrics_options
+from metrics import metrics_exporter
+from metrics import Registry
+from utils import connect_socket
+from utils import EventLoop
+from utils import get_host_port
+from utils import IntervalReporter
+from utils import LatencyHistogram
+from utils import raise_fd_limit
+from utils import SSLConfig
+
+LOG = logging.getLogger()
+LOG.addHandler(logging.StreamHandler())
+
+
+class ChurnCycle(pyngus.ConnectionEventHandler,
+                 pyngus.SenderEventHandler,
+                 pyngus.ReceiverEventHandler):
+    """One connect, attach, detach, close cycle of a single connection."""
+    def __init__(self, bench, name):
+        self._bench = bench
+        self.done = False
+        self.error = None
+        self.start = time.time()
+        self.socket = connect_socket(bench.host, bench.port, blocking=False)
+        self.connection = bench.container.create_connection(
+            name, self, bench.conn_properties)
+        self.ssl = None
+        if bench.ssl:
+            self.ssl = bench.ssl.configure(self.connection, bench.session_id)
+        self.links = []
+        for i in range(bench.links):
+            link_name = "churn-%d" % i
+            if bench.link_type == 'receiver':
+                link = self.connection.create_receiver(bench.node, bench.node,
+                                                       self, name=link_name)
+            else:
+                link = self.connection.create_sender(bench.node, bench.node,
+                                                     self, name=link_name)
+            self.links.append(link)
+        self._active = 0
+        self._closed = 0
+        self.connection.open()
+        for link in self.links:
+            link.open()
+
+    def _finish(self, error=None):
+        if not self.done:
+            self.done = True
+            self.error = error
+            self._bench.finished(self)
+
+    def expire(self):
+        if not self.done:
+            self._finish("timed out")
+
+    # Connection events
+
+    def connection_active(self, connection):
+        self._bench.connect_latency.record(time.time() - self.start)
+        if self.ssl and self.ssl.resume_status() == self.ssl.RESUME_REUSED:
+            self._bench.resumed += 1
+        if not self.links:
+            connection.close()
+
+    def connection_closed(self, connection):
+        self._finish()
+
+    def connection_failed(self, connection, error):
+        self._finish(error or "connection failed")
+
+    def connection_remote_closed(self, connection, pn_condition):
+        if not self.links or self._closed < len(self.links):
+            self._finish("connection closed by peer: %s" % pn_condition)
+        connection.close()
+
+    # Link events, for both senders and receivers
+
+    def _link_active(self, link):
+        self._active += 1
+        if self._active == len(self.links):
+            self._bench.active_latency.record(time.time() - self.start)
+            self._bench.links_attached += len(self.links)
+            for link in self.links:
+                link.close()
+
+    def _link_closed(self, link):
+        self._closed += 1
+        if self._closed == len(self.links):
+            self.connection.close()
+
+    def _link_failed(self, link, error):
+        self._finish(error or "link failed")
+
+    def _link_remote_closed(self, link, pn_condition):
+        if self._active < len(self.links):
+            self._finish("link refused: %s" % pn_condition)
+        link.close()
+
+    sender_active = receiver_active = _link_active
+    sender_closed = receiver_closed = _link_closed
+    sender_failed = receiver_failed = _link_failed
+    sender_remote_closed = receiver_remote_closed = _link_remote_closed
+
+
+class ChurnBench(object):
+    """Keep up to 'concurrency' ChurnCycles in progress until 'count'
+    connections have been made (forever if 0) or 'duration' seconds have
+    passed.  If ssl_resume the connections offer to resume the TLS session
+    of the previous one.
+    """
+    def __init__(self, opts, conn_properties, ssl_resume=False):
+        self.host, self.port = get_host_port(opts.server)
+        self.node = opts.node
+        self.links = opts.links
+        self.link_type = opts.link_type
+        self.ssl, self.conn_properties = SSLConfig.split(conn_properties)
+        self.session_id = None
+        if self.ssl and ssl_resume:
+            self.session_id = "churn-%s:%s" % (self.host, self.port)
+        self.container = pyngus.Container(uuid.uuid4().hex)
+        self.loop = EventLoop()
+        self._concurrency = opts.concurrency
+        self._count = opts.count
+        self._duration = opts.duration
+        self._timeout = opts.timeout
+        self._cycles = set()
+        self._finished = []
+        self._reset()
+
+    def _reset(self):
+        self._started = 0
+        self.completed = 0
+        self.failed = 0
+        self.resumed = 0
+        self.links_attached = 0
+        self.connect_latency = LatencyHistogram()
+        self.active_latency = LatencyHistogram()
+        self.start_time = None
+        self.stop_time = None
+        self.cpu = 0.0
+
+    def __len__(self):
+        return len(self._cycles)
+
+    def finished(self, cycle):
+        # called from the cycle's callbacks: clean up after loop.process()
+        self._finished.append(cycle)
+
+    def _start_cycle(self):
+        cycle = ChurnCycle(self, "churn-%d" % self._started)
+        self._started += 1
+        self._cycles.add(cycle)
+        self.loop.add(cycle.connection, cycle.socket)
+        if self._timeout:
+            self.loop.call_later(self._timeout, cycle.expire)
+
+    def _reap(self):
+        finished, self._finished = self._finished, []
+        for cycle in finished:
+            self._cycles.discard(cycle)
+            if cycle.error:
+                self.failed += 1
+                LOG.debug("Connection failed: %s", cycle.error)
+            else:
+                self.completed += 1
+            self.loop.remove(cycle.connection)
+            for link in cycle.links:
+                link.destroy()
+            cycle.connection.destroy()
+            cycle.socket.close()
+
+    def _more(self, now):
+        if self._count and self._started >= self._count:
+            return False
+        return not self._duration or now - self.start_time < self._duration
+
+    def prime(self):
+        """Make one connection that is not measured, e.g. so there is a TLS
+        session for the measured connections to resume.
+        """
+        self._start_cycle()
+        while self._cycles:
+            self.loop.process()
+            self._reap()
+        self._reset()
+
+    def run(self):
+        self.start_time = time.time()
+        cpu_start = sum(os.times()[:2])
+        try:
+            while True:
+                now = time.time()
+                while (len(self._cycles) < self._concurrency and
+                       self._more(now)):
+                    self._start_cycle()
+                if not self._cycles:
+                    break
+                self.loop.process()
+                self._reap()
+        except KeyboardInterrupt:
+            pass
+        self.stop_time = time.time()
+        self.cpu = sum(os.times()[:2]) - cpu_start
+
+    def close(self):
+        for cycle in list(self._cycles):
+            self.loop.remove(cycle.connection)
+            cycle.connection.destroy()
+            cycle.socket.close()
+        self._cycles.clear()
+        self.loop.close()
+        self.container.destroy()
+
+    def _rate(self, count):
+        duration = self.stop_time - self.start_time
+        return count / duration if duration > 0 else 0.0
+
+    @property
+    def cpu_per_connection(self):
+        return self.cpu / self.completed if self.completed else 0.0
+
+    def results(self):
+        return {'tool': 'churn',
+                'duration': self.stop_time - self.start_time,
+                'connections': self.completed,
+                'failed': self.failed,
+                'links': self.links_attached,
+                'connections_per_sec': self._rate(self.completed),
+                'links_per_sec': self._rate(self.links_attached),
+                'ssl_resumed': self.resumed,
+                'cpu': self.cpu,
+                'cpu_per_connection': self.cpu_per_connection,
+                'connect_latency': self.connect_latency.summary_dict(),
+                'active_latency': self.active_latency.summary_dict()}
+
+    def report(self):
+        lines = [" Connections: %d (%d failed) in %f secs"
+                 % (self.completed, self.failed,
+                    self.stop_time - self.start_time),
+                 " Connections/Sec: %f Links/Sec: %f"
+                 % (self._rate(self.completed),
+                    self._rate(self.links_attached)),
+                 " CPU: %f secs, %f per connection"
+                 % (self.cpu, self.cpu_per_connection)]
+        if self.ssl:
+            lines.append(" SSL sessions resumed: %d" % self.resumed)
+        lines.extend(self.connect_latency.report("Connect Latency"))
+        lines.extend(self.active_latency.report("Links Active Latency"))
+        return lines
+
+    def metrics(self, metrics):
+        metrics.counter('connections_total', 'Connection cycles completed',
+                        self.completed)
+        metrics.counter('failed_total', 'Connection cycles that failed',
+                        self.failed)
+        metrics.counter('links_total', 'Links attached', self.links_attached)
+        metrics.counter('ssl_resumed_total', 'SSL sessions resumed',
+                        self.resumed)
+        metrics.gauge('open', 'Connection cycles in progress', len(self))
+        metrics.summary('connect_latency_seconds', 'Time from connect until'
+                        ' the connection is active', self.connect_latency)
+        metrics.summary('active_latency_seconds', 'Time from connect until'
+                        ' all links are active', self.active_latency)
+
+
+def compare_report(full, resumed):
+    """Print full handshake and resumed session runs side by side."""
+    rows = [("Connections/Sec", lambda b: "%.1f" % b._rate(b.completed)),
+            ("Connect p50 (ms)",
+             lambda b: "%.3f" % (b.connect_latency.percentile(50) * 1000)),
+            ("Connect p99 (ms)",
+             lambda b: "%.3f" % (b.connect_latency.percentile(99) * 1000)),
+            ("CPU/Connection (ms)",
+             lambda b: "%.3f" % (b.cpu_per_connection * 1000)),
+            ("Resumed", lambda b: "%d/%d" % (b.resumed, b.completed)),
+            ("Failed", lambda b: "%d" % b.failed)]
+    lines = ["SSL handshakes: %20s %20s" % ("full", "resumed")]
+    for title, value in rows:
+        lines.append(" %-20s %16s %20s" % (title, value(full),
+                                           value(resumed)))
+    return lines
+
+
+def main(argv=None):
+
+    _usage = """Usage: %prog [options]"""
+    parser = optparse.OptionParser(usage=_usage)
+    parser.add_option("-a", dest="server", type="string",
+                      default="amqp://0.0.0.0:5672",
+                      help="The address of the server [amqp://0.0.0.0:5672]")
+    parser.add_option("--node", type='string', default='amq.topic',
+                      help='Name of the source/target node of the links')
+    parser.add_option("--count", type='int', default=1000,
+                      help='Make N connections in total (0 for no limit)'
+                      ' [1000]')
+    parser.add_option("--duration", type='float', default=0,
+                      help='Stop making new connections after N seconds'
+                      ' [no limit]')
+    parser.add_option("--concurrency", type='int', default=10,
+                      help='Connections in progress at once [10]')
+    parser.add_option("--links", type='int', default=1,
+                      help='Links to attach on each connection [1]')
+    parser.add_option("--link-type", type='choice',
+                      choices=['sender', 'receiver'], default='sender',
+                      help='Attach sender or receiver links [sender]')
+    parser.add_option("--timeout", type='float', default=30.0,
+                      help='Fail a connection that has not completed in N'
+                      ' seconds, 0 to wait forever [30]')
+    parser.add_option("--json", action="store_true",
+                      help='Print the results as JSON instead of text')
+    parser.add_option("--interval", type='float', default=0,
+                      help='Also report the rates and latency every N'
+                      ' seconds [off]')
+    parser.add_option("--interval-output", type='string',
+                      help='Write the interval reports to this file [stdout]')
+    parser.add_option("--interval-format", type='choice',
+                      choices=['text', 'csv', 'json'], default='text',
+                      help='Interval report format: text, csv or json'
+                      ' (lines) [text]')
+    parser.add_option("--ssl-resume", action="store_true",
+                      help='Offer to resume the TLS session of the previous'
+                      ' connection')
+    parser.add_option("--ssl-compare", action="store_true",
+                      help='Run once with full TLS handshakes and once with'
+                      ' resumed sessions, and compare them')
+    parser.add_option("--idle-timeout", type="int", default=0,
+                      help="Idle timeout for connections (seconds).")
+    parser.add_option("--ca",
+                      help="Certificate Authority PEM file")
+    parser.add_option("--ssl-cert-file",
+                      help="Self-identifying certificate (PEM file)")
+    parser.add_option("--ssl-key-file",
+                      help="Key for self-identifying certificate (PEM file)")
+    parser.add_option("--ssl-key-password",
+                      help="Password to unlock SSL key file")
+    parser.add_option("--username", type="string",
+                      help="User Id for authentication")
+    parser.add_option("--password", type="string",
+                      help="User password for authentication")
+    parser.add_option("--sasl-mechs", type="string",
+                      help="The list of acceptable SASL mechs")
+    parser.add_option("--sasl-config-dir", type="string",
+                      help="Path to directory containing sasl config")
+    parser.add_option("--sasl-config-name", type="string",
+                      help="Name of the sasl config file (without '.config')")
+    add_metrics_options(parser)
+    parser.add_option("--debug", dest="debug", action="store_true",
+                      help="enable debug logging")
+    parser.add_option("--trace", dest="trace", action="store_true",
+                      help="enable protocol tracing")
+
+    opts, _ = parser.parse_args(args=argv)
+    if opts.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if opts.links < 0:
+        parser.error("--links cannot be negative")
+    if not opts.count and not opts.duration:
+        LOG.warning("No --count or --duration: running until interrupted")
+    if opts.ssl_compare and opts.interval:
+        parser.error("--interval cannot be used with --ssl-compare")
+    if (opts.ssl_resume or opts.ssl_compare) and not (opts.ca or
+                                                      opts.ssl_cert_file):
+        parser.error("SSL is not enabled (see --ca and --ssl-cert-file)")
+    if opts.debug:
+        LOG.setLevel(logging.DEBUG)
+    raise_fd_limit()
+
+    host, _ = get_host_port(opts.server)
+    conn_properties = {'hostname': host,
+                       'x-server': False}
+    if opts.trace:
+        conn_properties["x-trace-protocol"] = True
+    if opts.ca:
+        conn_properties["x-ssl-ca-file"] = opts.ca
+    if opts.ssl_cert_file:
+        conn_properties["x-ssl-identity"] = (opts.ssl_cert_file,
+                                             opts.ssl_key_file,
+                                             opts.ssl_key_password)
+    if opts.idle_timeout:
+        conn_properties["idle-time-out"] = opts.idle_timeout
+    if opts.username:
+        conn_properties['x-username'] = opts.username
+    if opts.password:
+        conn_properties['x-password'] = opts.password
+    if opts.sasl_mechs:
+        conn_properties['x-sasl-mechs'] = opts.sasl_mechs
+    if opts.sasl_config_dir:
+        conn_properties["x-sasl-config-dir"] = opts.sasl_config_dir
+    if opts.sasl_config_name:
+        conn_properties["x-sasl-config-name"] = opts.sasl_config_name
+
+    if opts.ssl_compare:
+        benches = []
+        for resume in (False, True):
+            bench = ChurnBench(opts, conn_properties, resume)
+            bench.prime()
+            bench.run()
+            bench.close()
+            benches.append(bench)
+        if opts.json:
+            print(json.dumps({'full': benches[0].results(),
+                              'resumed': benches[1].results()},
+                             sort_keys=True))
+        else:
+            print("\n".join(compare_report(*benches)))
+        return 0 if all(bench.completed for bench in benches) else 1
+
+    bench = ChurnBench(opts, conn_properties, opts.ssl_resume)
+    if opts.ssl_resume:
+        bench.prime()
+    reporter = None
+    if opts.interval:
+        reporter = IntervalReporter(opts.interval, opts.interval_output,
+                                    opts.interval_format)
+        reporter.counter('connections', lambda: bench.completed)
+        reporter.counter('links', lambda: bench.links_attached)
+        reporter.counter('failed', lambda: bench.failed)
+        reporter.gauge('open', lambda: len(bench))
+        reporter.histograms('connect_latency',
+                            lambda: [bench.connect_latency])
+        reporter.histograms('active_latency',
+                            lambda: [bench.active_latency])
+        reporter.start(bench.loop)
+    registry = Registry("churn_")
+    registry.register(bench.metrics)
+    exporter = metrics_exporter(opts, registry)
+    if exporter:
+        exporter.start(bench.loop)
+    bench.run()
+    if reporter:
+        reporter.stop()
+    if exporter:
+        exporter.stop()
+    bench.close()
+
+    if opts.json:
+        print(json.dumps(bench.results(), sort_keys=True))
+    else:
+        print("Stats:")
+        print("\n".join(bench.report()))
+    return 0 if bench.completed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Build and inspect message corpora for the perf tools (see
+utils.Corpus).
+
+  corpus.py build CORPUS [--input FILE] [--record-format FORMAT]
+  corpus.py info CORPUS
+  corpus.py dump CORPUS [--count N]
+"""
+
+import optparse
+import sys
+
+from proton import Message
+
+from utils import Corpus
+from utils import CorpusWriter
+from utils import read_records
+
+
+def build(opts, path):
+    if opts.input in (None, '-'):
+        input_file = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        input_file = open(opts.input, 'rb')
+    record_format = opts.record_format
+    if record_format == 'encoded':
+        # captured messages, already AMQP encoded
+        record_format = 'length-prefixed'
+    writer = CorpusWriter(path)
+    message = Message()
+    try:
+        for record in read_records(input_file, record_format):
+            if opts.record_format == 'encoded':
+                message.decode(record)  # check it is a valid message
+                encoded = record
+            else:
+                message.clear()
+                message.address = opts.address
+                message.body = record
+                encoded = message.encode()
+            writer.append(encoded)
+    finally:
+        writer.close()
+        if input_file is not getattr(sys.stdin, 'buffer', sys.stdin):
+            input_file.close()
+    print("Wrote %d messages to %s" % (len(writer), path))
+
+
+def info(path):
+    corpus = Corpus(path)
+    sizes = [len(corpus[i]) for i in range(len(corpus))]
+    print("%s: %d messages, %d bytes" % (path, len(corpus), corpus.data_size))
+    if sizes:
+        print(" message size: min %d mean %.1f max %d"
+              % (min(sizes), float(sum(sizes)) / len(sizes), max(sizes)))
+    corpus.close()
+
+
+def dump(path, count):
+    corpus = Corpus(path)
+    message = Message()
+    for i in range(min(count, len(corpus)) if count else len(corpus)):
+        message.decode(bytes(corpus[i]))
+        print("%d: %s" % (i, message))
+    corpus.close()
+
+
+def main(argv=None):
+
+    _usage = """Usage: %prog build|info|dump CORPUS [options]"""
+    parser = optparse.OptionParser(usage=_usage)
+    parser.add_option("--input", type="string",
+                      help="Read the records from this file [stdin]")
+    parser.add_option("--record-format", type="choice",
+                      choices=["lines", "length-prefixed", "encoded"],
+                      default="lines",
+                      help="The input records are text lines or binary"
+                      " bodies prefixed with a 4 byte big-endian length,"
+                      " both sent as message bodies, or length-prefixed"
+                      " encoded AMQP messages sent as they are [lines]")
+    parser.add_option("--address", type="string",
+                      help="Set the 'to' address of built messages")
+    parser.add_option("--count", type="int", default=10,
+                      help="Dump the first N messages, 0 for all [10]")
+
+    opts, arguments = parser.parse_args(args=argv)
+    if len(arguments) != 2 or arguments[0] not in ('build', 'info', 'dump'):
+        parser.error("expected a command (build, info or dump) and a"
+                     " corpus path")
+    command, path = arguments
+    if command == 'build':
+        build(opts, path)
+    elif command == 'info':
+        info(path)
+    else:
+        dump(path, opts.count)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Merge latency histograms saved by the perf tools' --histogram-out."""
+
+import optparse
+import sys
+
+from utils import load_histograms
+from utils import save_histograms
+
+
+def main(argv=None):
+
+    _usage = """Usage: %prog [options] histogram-file [histogram-file ...]"""
+    parser = optparse.OptionParser(usage=_usage)
+    parser.add_option("--output", type='string',
+                      help='Save the merged histograms to this JSON file')
+
+    opts, paths = parser.parse_args(args=argv)
+    if not paths:
+        parser.error("no histogram files given")
+
+    merged = {}
+    for path in paths:
+        for name, hist in load_histograms(path).items():
+            if name in merged:
+                merged[name].merge(hist)
+            else:
+                merged[name] = hist
+
+    print("Merged %d files:" % len(paths))
+    for name in sorted(merged):
+        print("\n".join(merged[name].report(name)))
+    if opts.output:
+        save_histograms(opts.output, merged)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,397 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#
+"""Metrics of the server and the clients, in the Prometheus text format.
+
+The programs keep their counters as plain attributes, as before.  A
+Registry reads them through collector functions that are only called when
+a snapshot is taken, so nothing is added to the per-message path.  An
+Exporter takes the snapshots from the program's own I/O loop, every
+interval, so the collectors never race with it.  The latest snapshot is
+published from background threads: served over HTTP on a TCP or Unix
+socket, and/or written to a file.
+"""
+
+import collections
+import json
+import optparse
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import UnixStreamServer
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import UnixStreamServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return '%d' % value
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class Metrics(object):
+    """The samples of one snapshot, grouped into metric families.  Passed
+    to the collectors, which add the current values of their metrics.
+    """
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, prefix=''):
+        self._prefix = prefix
+        self.timestamp = time.time()
+        # name -> (type, help, [(sample name, labels, value)])
+        self.families = collections.OrderedDict()
+
+    def _add(self, kind, name, help_text, samples):
+        name = self._prefix + name
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (kind, help_text, [])
+        family[2].extend((name + suffix, labels, value)
+                         for suffix, labels, value in samples)
+
+    def counter(self, name, help_text, value, **labels):
+        self._add('counter', name, help_text, [('', labels, value)])
+
+    def gauge(self, name, help_text, value, **labels):
+        self._add('gauge', name, help_text, [('', labels, value)])
+
+    def summary(self, name, help_text, histogram, **labels):
+        """A LatencyHistogram: its quantiles (seconds), _sum and _count."""
+        samples = []
+        for quantile in self.QUANTILES:
+            quantile_labels = dict(labels, quantile=quantile)
+            samples.append(('', quantile_labels,
+                            histogram.percentile(quantile * 100)))
+        samples.append(('_sum', labels, histogram.total / 1000000.0))
+        samples.append(('_count', labels, histogram.count))
+        self._add('summary', name, help_text, samples)
+
+    def text(self):
+        """The Prometheus text exposition format."""
+        lines = []
+        for name, (kind, help_text, samples) in self.families.items():
+            lines.append('# HELP %s %s' % (name, help_text.replace(
+                '\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample_name, labels, value in samples:
+                if labels:
+                    sample_name += '{%s}' % ','.join(
+                        '%s="%s"' % (key, _escape(labels[key]))
+                        for key in sorted(labels))
+                lines.append('%s %s' % (sample_name, _format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return {'timestamp': self.timestamp,
+                'metrics': dict(
+                    (name, {'type': kind, 'help': help_text,
+                            'samples': [{'name': sample_name,
+                                         'labels': labels,
+                                         'value': value}
+                                        for sample_name, labels, value
+                                        in samples]})
+                    for name, (kind, help_text, samples)
+                    in self.families.items())}
+
+
+class Registry(object):
+    """The collectors of a program.  All the metric names are given the
+    prefix, e.g. 'server_'.
+    """
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._collectors = []
+
+    def register(self, collector):
+        """collector(metrics) is called for every snapshot, and adds the
+        current values to the Metrics.
+        """
+        self._collectors.append(collector)
+
+    def collect(self):
+        metrics = Metrics(self.prefix)
+        for collector in self._collectors:
+            collector(metrics)
+        return metrics
+
+
+def collect_perf_links(metrics, senders, receivers):
+    """Add the metrics of the (link, handler) pairs of perf-pyngus and
+    perf-tool: their SenderHandlers and ReceiverHandlers.
+    """
+    for link, handler in senders:
+        labels = {'connection': link.connection.name, 'link': link.name,
+                  'direction': 'out'}
+        metrics.counter('link_messages_total',
+                        'Messages sent or received on a link',
+                        handler.sequence, **labels)
+        metrics.counter('link_bytes_total',
+                        'Bytes of the messages sent on a link',
+                        handler.sequence * handler.message_size, **labels)
+        metrics.counter('link_settled_total',
+                        'Messages sent on a link that have been acked, or'
+                        ' sent pre-settled', handler.calls, **labels)
+        metrics.gauge('link_unsettled',
+                      'Messages sent on a link and not yet acked',
+                      handler.outstanding, **labels)
+        metrics.gauge('link_credit',
+                      'Credit granted by the peer to a sender link, or by a'
+                      ' receiver link to the peer', link.credit, **labels)
+        metrics.summary('ack_latency_seconds',
+                        'Time from sending a message until it is acked',
+                        handler.ack_latency, **labels)
+    for link, handler in receivers:
+        labels = {'connection': link.connection.name, 'link': link.name,
+                  'direction': 'in'}
+        metrics.counter('link_messages_total',
+                        'Messages sent or received on a link',
+                        handler.receives, **labels)
+        metrics.gauge('link_credit',
+                      'Credit granted by the peer to a sender link, or by a'
+                      ' receiver link to the peer', link.capacity, **labels)
+        metrics.summary('rx_latency_seconds',
+                        'Time from sending a message until it is received',
+                        handler.rx_latency, **labels)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serve the exporter's latest snapshot: GET /metrics (or /) for the
+    text format, GET /metrics.json for JSON.
+    """
+    def do_GET(self):
+        snapshot = self.server.exporter.snapshot()
+        path = self.path.split('?')[0]
+        if snapshot is None or path not in ('/', '/metrics',
+                                            '/metrics.json'):
+            self.send_error(404 if snapshot else 503)
+            return
+        if path == '/metrics.json':
+            body = json.dumps(snapshot.to_dict(), sort_keys=True)
+            content_type = 'application/json'
+        else:
+            body = snapshot.text()
+            content_type = CONTENT_TYPE
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address or 'unix')
+
+    def log_message(self, fmt, *args):
+        pass  # no log I/O per scrape
+
+
+class _UnixHTTPServer(UnixStreamServer):
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, ''
+
+
+def parse_address(address):
+    """Return ('unix', PATH) for 'unix:PATH', else (HOST, PORT) for
+    '[HOST:]PORT'.
+    """
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def worker_address(address, index):
+    """The metrics address of worker process index: the TCP port is offset
+    by the index, a Unix socket path gets the suffix '.index'.
+    """
+    host, port = parse_address(address)
+    if host == 'unix':
+        return '%s.%d' % (address, index)
+    return '%s:%d' % (host, port + index)
+
+
+class Exporter(object):
+    """Publish snapshots of a Registry, taken every interval seconds from
+    the program's I/O loop (see start() and poll()).  address is
+    'HOST:PORT' (HOST defaults to 127.0.0.1) or 'unix:PATH' to serve them
+    over HTTP; path is a file rewritten with each snapshot, as JSON if it
+    ends with '.json', else in the text format.
+    """
+    def __init__(self, registry, interval=1.0, address=None, path=None):
+        if interval <= 0:
+            raise Exception("The metrics interval must be greater than 0")
+        self.registry = registry
+        self.interval = interval
+        self._path = path
+        self._snapshot = None
+        self._written = None
+        self._next = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._threads = []
+        self._server = None
+        self._unix_path = None
+        if address:
+            host, port = parse_address(address)
+            if host == 'unix':
+                self._unix_path = port
+                if os.path.exists(self._unix_path):
+                    os.unlink(self._unix_path)  # left by an earlier run
+                self._server = _UnixHTTPServer(self._unix_path, _Handler)
+            else:
+                self._server = HTTPServer((host, port), _Handler)
+            self._server.exporter = self
+            self._start_thread(self._server.serve_forever)
+        if path:
+            self._start_thread(self._write_snapshots)
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def start(self, loop, now=None):
+        """Take the snapshots from an EventLoop timer."""
+        def tick():
+            if self._stopped:
+                return
+            loop.call_later(self.poll(), tick)
+        self.update()
+        self._next = (now or time.time()) + self.interval
+        loop.call_at(self._next, tick)
+
+    def poll(self, now=None):
+        """Take a snapshot if one is due.  Returns the seconds until the
+        next one.
+        """
+        now = now or time.time()
+        if self._next is None or now >= self._next:
+            self.update()
+            self._next = (self._next or now) + self.interval
+            if self._next <= now:  # the loop fell behind, skip
+                self._next = now + self.interval
+        return self._next - now
+
+    def update(self):
+        """Take a snapshot now."""
+        snapshot = self.registry.collect()
+        with self._cond:
+            self._snapshot = snapshot
+            self._cond.notify()
+
+    def snapshot(self):
+        with self._cond:
+            return self._snapshot
+
+    def _write_snapshots(self):
+        while True:
+            with self._cond:
+                while self._snapshot is self._written and not self._stopped:
+                    self._cond.wait()
+                snapshot = self._written = self._snapshot
+                stopped = self._stopped
+            if self._path.endswith('.json'):
+                data = json.dumps(snapshot.to_dict(), sort_keys=True)
+            else:
+                data = snapshot.text()
+            # replace the file atomically, so readers never see part of it
+            tmp = '%s.tmp' % self._path
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.rename(tmp, self._path)
+            if stopped:
+                return
+
+    def stop(self):
+        """Take the final snapshot and stop publishing."""
+        if self._stopped:
+            return
+        snapshot = self.registry.collect()
+        with self._cond:
+            self._snapshot = snapshot
+            self._stopped = True
+            self._cond.notify()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            if self._unix_path:
+                os.unlink(self._unix_path)
+        for thread in self._threads:
+            thread.join()
+
+
+def _check_interval(option, opt_str, value, parser):
+    # a zero interval would take a snapshot on every pass of the I/O loop
+    if value <= 0:
+        raise optparse.OptionValueError("%s must be greater than 0"
+                                        % opt_str)
+    setattr(parser.values, option.dest, value)
+
+
+def add_metrics_options(parser):
+    """Add the --metrics-* options to an optparse parser."""
+    parser.add_option("--metrics-address", type='string',
+                      help='Serve the metrics over HTTP (Prometheus text'
+                      ' format at /metrics, JSON at /metrics.json) on'
+                      ' [HOST:]PORT or unix:PATH')
+    parser.add_option("--metrics-file", type='string',
+                      help='Rewrite a snapshot of the metrics to this file'
+                      ' (JSON if it ends with .json) every'
+                      ' --metrics-interval seconds')
+    parser.add_option("--metrics-interval", type='float', default=1.0,
+                      action='callback', callback=_check_interval,
+                      help='Seconds between metrics snapshots [1.0]')
+
+
+def metrics_exporter(opts, registry, index=None):
+    """Return an Exporter for the --metrics-* options, or None if they are
+    not used.  index is the worker process index, if there are several.
+    """
+    address, path = opts.metrics_address, opts.metrics_file
+    if not (address or path):
+        return None
+    if index is not None:
+        if address:
+            address = worker_address(address, index)
+        if path:
+            path = '%s.%d' % (path, index)
+    return Exporter(registry, opts.metrics_interval, address, path)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""Many clients in one process, on the asyncio adapter (see aioclient.py).
+
+Each of --clients clients opens its own connection with a sender and/or a
+receiver on the node --node-N, and sends (receives) --count messages,
+keeping up to --window unacked messages in flight.  With server.py --broker
+every client receives its own messages.  The aggregate rates and the
+connect, ack and receive latency percentiles are reported.
+"""
+
+import asyncio
+import json
+import logging
+import optparse
+import sys
+import time
+
+from proton import Message
+
+from aioclient import AsyncContainer
+from utils import get_host_port
+from utils import LatencyHistogram
+from utils import perf_results
+from utils import PreEncodedMessage
+from utils import raise_fd_limit
+from utils import SequenceChecker
+
+LOG = logging.getLogger()
+LOG.addHandler(logging.StreamHandler())
+
+
+class LoadStats(object):
+    """The totals of all the clients."""
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.sent = 0
+        self.accepted = 0
+        self.received = 0
+        self.connect_latency = LatencyHistogram()
+        self.ack_latency = LatencyHistogram()
+        self.rx_latency = LatencyHistogram()
+        # each client only receives its own messages: one checker for all
+        self.sequences = SequenceChecker()
+        self.start_time = None
+        self.tx_done = None
+        self.rx_done = None
+
+    def _duration(self, done):
+        return done - self.start_time if done else None
+
+    def results(self):
+        results = perf_results('perf-aio', self.sent,
+                               self._duration(self.tx_done), self.received,
+                               self._duration(self.rx_done),
+                               self.ack_latency, self.rx_latency,
+                               sequence=self.sequences.counts())
+        results.update({'clients': self.connected,
+                        'failed': self.failed,
+                        'accepted': self.accepted,
+                        'connect_latency':
+                        self.connect_latency.summary_dict()})
+        return results
+
+    def report(self):
+        results = self.results()
+        lines = [" Clients: %d (%d failed)" % (self.connected, self.failed),
+                 " TX Msgs: %d (%d accepted) Avg Msgs/Sec: %f"
+                 % (self.sent, self.accepted, results['tx_msgs_per_sec']),
+                 " RX Msgs: %d Avg Msgs/Sec: %f"
+                 % (self.received, results['rx_msgs_per_sec'])]
+        if self.received:
+            lines.append(self.sequences.report())
+        lines.extend(self.connect_latency.report("Connect Latency"))
+        lines.extend(self.ack_latency.report("Ack Latency"))
+        lines.extend(self.rx_latency.report("RX Latency"))
+        return lines
+
+
+async def send_messages(sender, opts, stats):
+    """Send from --window slots, each re-sending its pre-encoded message
+    once the previous send from it is settled.  Each slot is a sender of
+    its own for the sequence checks: it has its own group-id and sequence.
+    """
+    remaining = [opts.count]
+
+    async def slot():
+        template = Message()
+        if opts.size:
+            template.body = {'payload': b'x' * opts.size}
+        msg = PreEncodedMessage(template)
+        sequence = 0
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            now = time.time()
+            msg.stamp(now, sequence)
+            sequence += 1
+            stats.sent += 1
+            status = await sender.send(msg)
+            stats.ack_latency.record(time.time() - now)
+            if status == sender.ACCEPTED:
+                stats.accepted += 1
+
+    await asyncio.gather(*[slot() for _ in range(opts.window)])
+
+
+async def receive_messages(receiver, opts, stats):
+    received = 0
+    async for message in receiver:
+        stats.sequences.record(message)
+        sent = PreEncodedMessage.sent_at(message)
+        if sent:
+            stats.rx_latency.record(time.time() - sent)
+        received += 1
+        stats.received += 1
+        if received == opts.count:
+            break
+
+
+async def run_client(container, index, opts, conn_properties, stats):
+    host, port = get_host_port(opts.server)
+    start = time.time()
+    try:
+        connection = await container.connect(host, port, conn_properties,
+                                             "perf-aio-%d" % index)
+    except Exception as e:
+        LOG.debug("Client %d failed to connect: %s", index, e)
+        stats.failed += 1
+        return
+    stats.connected += 1
+    stats.connect_latency.record(time.time() - start)
+    node = "%s-%d" % (opts.node, index)
+    try:
+        tasks = []
+        if not opts.receive_only:
+            sender = await connection.create_sender(node)
+            tasks.append(send_messages(sender, opts, stats))
+        if not opts.send_only:
+            receiver = await connection.create_receiver(node,
+                                                        credit=opts.credit)
+            tasks.append(receive_messages(receiver, opts, stats))
+        await asyncio.gather(*tasks)
+    except Exception as e:
+        LOG.error("Client %d failed: %s", index, e)
+        stats.failed += 1
+    await connection.close()
+
+
+async def run_load(opts, conn_properties):
+    stats = LoadStats()
+    container = AsyncContainer()
+    stats.start_time = time.time()
+    await asyncio.gather(*[run_client(container, i, opts, conn_properties,
+                                      stats)
+                           for i in range(opts.clients)])
+    done = time.time()
+    stats.tx_done = None if opts.receive_only else done
+    stats.rx_done = None if opts.send_only else done
+    await container.close()
+    return stats
+
+
+def main(argv=None):
+
+    _usage = """Usage: %prog [options]"""
+    parser = optparse.OptionParser(usage=_usage)
+    parser.add_option("-a", dest="server", type="string",
+                      default="amqp://0.0.0.0:5672",
+                      help="The address of the server [amqp://0.0.0.0:5672]")
+    parser.add_option("--node", type='string', default='perf-aio',
+                      help='Prefix of the per client node names [perf-aio]')
+    parser.add_option("--clients", type='int', default=100,
+                      help='Number of clients [100]')
+    parser.add_option("--count", type='int', default=1000,
+                      help='Messages sent and received per client [1000]')
+    parser.add_option("--window", type='int', default=1,
+                      help='Max unacked messages in flight per client [1]')
+    parser.add_option("--credit", type='int', default=100,
+                      help='Credit of each receiver [100]')
+    parser.add_option("--size", type='int', default=0,
+                      help='Bytes of padding in each message body [0]')
+    parser.add_option("--send-only", action="store_true",
+                      help='Clients only send')
+    parser.add_option("--receive-only", action="store_true",
+                      help='Clients only receive')
+    parser.add_option("--json", action="store_true",
+                      help='Print the results as JSON instead of text')
+    parser.add_option("--idle-timeout", type="int", default=0,
+                      help="Idle timeout for connections (seconds).")
+    parser.add_option("--ca",
+                      help="Certificate Authority PEM file")
+    parser.add_option("--ssl-cert-file",
+                      help="Self-identifying certificate (PEM file)")
+    parser.add_option("--ssl-key-file",
+                      help="Key for self-identifying certificate (PEM file)")
+    parser.add_option("--ssl-key-password",
+                      help="Password to unlock SSL key file")
+    parser.add_option("--username", type="string",
+                      help="User Id for authentication")
+    parser.add_option("--password", type="string",
+                      help="User password for authentication")
+    parser.add_option("--sasl-mechs", type="string",
+                      help="The list of acceptable SASL mechs")
+    parser.add_option("--sasl-config-dir", type="string",
+                      help="Path to directory containing sasl config")
+    parser.add_option("--sasl-config-name", type="string",
+                      help="Name of the sasl config file (without '.config')")
+    parser.add_option("--debug", dest="debug", action="store_true",
+                      help="enable debug logging")
+    parser.add_option("--trace", dest="trace", action="store_true",
+                      help="enable protocol tracing")
+
+    opts, _ = parser.parse_args(args=argv)
+    if opts.clients < 1 or opts.window < 1 or opts.credit < 1:
+        parser.error("--clients, --window and --credit must be at least 1")
+    if opts.send_only and opts.receive_only:
+        parser.error("--send-only and --receive-only are exclusive")
+    if opts.debug:
+        LOG.setLevel(logging.DEBUG)
+    raise_fd_limit()
+
+    host, _ = get_host_port(opts.server)
+    conn_properties = {'hostname': host,
+                       'x-server': False}
+    if opts.trace:
+        conn_properties["x-trace-protocol"] = True
+    if opts.ca:
+        conn_properties["x-ssl-ca-file"] = opts.ca
+    if opts.ssl_cert_file:
+        conn_properties["x-ssl-identity"] = (opts.ssl_cert_file,
+                                             opts.ssl_key_file,
+                                             opts.ssl_key_password)
+    if opts.idle_timeout:
+        conn_properties["idle-time-out"] = opts.idle_timeout
+    if opts.username:
+        conn_properties['x-username'] = opts.username
+    if opts.password:
+        conn_properties['x-password'] = opts.password
+    if opts.sasl_mechs:
+        conn_properties['x-sasl-mechs'] = opts.sasl_mechs
+    if opts.sasl_config_dir:
+        conn_properties["x-sasl-config-dir"] = opts.sasl_config_dir
+    if opts.sasl_config_name:
+        conn_properties["x-sasl-config-name"] = opts.sasl_config_name
+
+    stats = asyncio.run(run_load(opts, conn_properties))
+    if opts.json:
+        print(json.dumps(stats.results(), sort_keys=True))
+    else:
+        print("Stats:")
+        print("\n".join(stats.report()))
+    return 0 if stats.connected and not stats.failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,6 +19,8 @@
 #
 """Tool to gauge message passing throughput and latencies"""
 
+import csv
+import json
 import logging
 import optparse
 import sys
@@ -28,9 +30,23 @@ import uuid
 import pyngus
 from proton import Message
 
+from metrics import add_metrics_options
+from metrics import collect_perf_links
+from metrics import metrics_exporter
+from metrics import Registry
 from utils import connect_socket
+from utils import Corpus
+from utils import CorpusMessage
+from utils import EventLoop
 from utils import get_host_port
-from utils import process_connection
+from utils import IntervalReporter
+from utils import LatencyHistogram
+from utils import perf_results
+from utils import PreEncodedMessage
+from utils import raise_fd_limit
+from utils import run_workers
+from utils import save_histograms
+from utils import SequenceChecker
 
 LOG = logging.getLogger()
 LOG.addHandler(logging.StreamHandler())
@@ -51,36 +67,132 @@ class ConnectionEventHandler(pyngus.ConnectionEventHandler):
 
 
 class SenderHandler(pyngus.SenderEventHandler):
-    def __init__(self, count):
-        self._count = count
-        self._msg = Message()
+    """Send messages, keeping up to 'window' unacked deliveries in flight.
+
+    A window of 1 is strict stop-and-wait.  Larger windows are further bounded
+    by the credit granted by the peer.  The first 'warmup' messages are sent
+    before the measurement starts, and are not counted.
+
+    If a rate is given the window is ignored: messages are sent open-loop on
+    a fixed schedule, regardless of pending acks.  Latencies are measured
+    from the scheduled send time, so delays caused by a lack of credit are
+    not hidden (no coordinated omission).
+
+    If presettled the messages are sent at-most-once: there are no acks to
+    wait for, so the window is ignored and only credit limits the sender.
+
+    If a Corpus is given its messages are replayed instead of the synthetic
+    timestamped message (so there is no RX latency).
+    """
+    def __init__(self, count, window=1, payload_size=0, warmup=0,
+                 rate=0.0, loop=None, presettled=False, corpus=None):
+        self._presettled = presettled
+        self._rate = rate
+        self._loop = loop
+        self._schedule_start = None
+        self._timer_pending = False
+        self._warmup = warmup
+        self._count = count + warmup if count else 0
+        self._forever = not count
+        self._unsent = self._count
+        self._window = window
+        if corpus is not None:
+            self._msg = CorpusMessage(corpus)
+        else:
+            template = Message()
+            if payload_size:
+                template.body = {'payload': b'x' * payload_size}
+            self._msg = PreEncodedMessage(template)
+        self.message_size = len(self._msg)
+        self.sequence = 0
+        self.outstanding = 0
         self.calls = 0
-        self.total_ack_latency = 0.0
+        self.ack_latency = LatencyHistogram()
         self.stop_time = None
         self.start_time = None
 
     def credit_granted(self, sender_link):
-        if self.start_time is None:
+        if self.start_time is None and not self._warmup:
             self.start_time = time.time()
-            self._send_message(sender_link)
-
-    def _send_message(self, link):
-        now = time.time()
-        self._msg.body = {'tx-timestamp': now}
-        self._last_send = now
-        link.send(self._msg, self)
-
-    def __call__(self, link, handle, status, error):
-        now = time.time()
-        self.total_ack_latency += now - self._last_send
-        self.calls += 1
+        if self._rate:
+            if self._schedule_start is None:
+                self._schedule_start = time.time()
+            if not self._timer_pending:
+                self._scheduled_send(sender_link)
+                return
+        self._send_messages(sender_link)
+
+    def _scheduled_send(self, link):
+        self._timer_pending = False
+        if link.closed:
+            return
+        self._send_messages(link)
+        # may be called from a timer, outside the connection's callbacks:
+        self._loop.wakeup(link.connection)
+        if not self._forever and not self._unsent:
+            return
+        if link.credit > 0:
+            next_send = self._schedule_start + self.sequence / self._rate
+            self._timer_pending = True
+            self._loop.call_at(next_send, lambda: self._scheduled_send(link))
+        # else out of credit: credit_granted() restarts the schedule
+
+    def _send_messages(self, link):
+        if self._rate:
+            # send everything that is due, as far as credit allows
+            due = (time.time() - self._schedule_start) * self._rate
+            while (self.sequence < due and link.credit > 0 and
+                   (self._forever or self._unsent)):
+                self._send_message(link, self._schedule_start +
+                                   self.sequence / self._rate)
+            return
+        while (self.outstanding < self._window and link.credit > 0 and
+               (self._forever or self._unsent)):
+            self._send_message(link)
+
+    def _send_message(self, link, now=None):
+        if now is None:
+            now = time.time()
+        self._msg.stamp(now, self.sequence)
+        self.sequence += 1
+        if self._unsent:
+            self._unsent -= 1
+        if self._presettled:
+            # no callback: pyngus settles the delivery as it is sent
+            link.send(self._msg)
+            if self._completed(now):
+                link.close()
+            return
+        self.outstanding += 1
+        # the send time is passed back as the handle in the ack callback, so
+        # latency is correct with many deliveries outstanding:
+        link.send(self._msg, self, handle=now)
+
+    def _completed(self, now, send_time=None):
+        """Account for a finished message.  Returns True once all messages
+        are done.
+        """
+        if self._warmup:
+            self._warmup -= 1
+            if self._warmup == 0:
+                self.start_time = now
+        else:
+            if send_time is not None:
+                self.ack_latency.record(now - send_time)
+            self.calls += 1
         if self._count:
             self._count -= 1
             if self._count == 0:
                 self.stop_time = now
-                link.close()
-                return
-        self._send_message(link)
+                return True
+        return False
+
+    def __call__(self, link, handle, status, error):
+        self.outstanding -= 1
+        if self._completed(time.time(), handle):
+            link.close()
+            return
+        self._send_messages(link)
 
     def sender_remote_closed(self, sender_link, pn_condition):
         LOG.debug("Sender peer_closed condition=%s", pn_condition)
@@ -93,12 +205,19 @@ class SenderHandler(pyngus.SenderEventHandler):
 
 
 class ReceiverHandler(pyngus.ReceiverEventHandler):
-    def __init__(self, count, capacity):
-        self._count = count
+    """Receive messages, checking each sender's sequence numbers in
+    'sequences' (a SequenceChecker, which may be shared between receivers).
+    """
+    def __init__(self, count, capacity, warmup=0, sequences=None):
+        self.sequences = sequences or SequenceChecker()
+        self._warmup = warmup
+        self._count = count + warmup if count else 0
         self._capacity = capacity
         self._msg = Message()
         self.receives = 0
-        self.tx_total_latency = 0.0
+        self.rx_latency = LatencyHistogram()
+        self.start_time = None
+        self.stop_time = None
 
     def receiver_active(self, receiver_link):
         receiver_link.add_capacity(self._capacity)
@@ -116,8 +235,19 @@ class ReceiverHandler(pyngus.ReceiverEventHandler):
     def message_received(self, receiver, message, handle):
         now = time.time()
         receiver.message_accepted(handle)
-        self.tx_total_latency += now - message.body['tx-timestamp']
-        self.receives += 1
+        self.sequences.record(message)
+        # the message-id is the sender's sequence number, if it has one:
+        sequence = message.id
+        if not isinstance(sequence, int):
+            sequence = self._warmup
+        if sequence >= self._warmup:
+            if self.start_time is None:
+                self.start_time = now
+            self.stop_time = now
+            sent = PreEncodedMessage.sent_at(message)
+            if sent is not None:
+                self.rx_latency.record(now - sent)
+            self.receives += 1
         if self._count:
             self._count -= 1
             if self._count == 0:
@@ -129,6 +259,384 @@ class ReceiverHandler(pyngus.ReceiverEventHandler):
             receiver.add_capacity(cap - lc)
 
 
+class LoadStats(object):
+    """Throughput and latency results, mergeable across processes."""
+    def __init__(self):
+        self.calls = 0
+        self.tx_bytes = 0
+        self.tx_start = None
+        self.tx_stop = None
+        self.receives = 0
+        self.rx_start = None
+        self.rx_stop = None
+        self.ack_latency = LatencyHistogram()
+        self.rx_latency = LatencyHistogram()
+        self.sequence = {}  # the sum of the per receiver sequence counts
+        # with --shared-sequence, the checks of all the receivers merged:
+        self.shared_sequence = None
+
+    @staticmethod
+    def _span(start, stop, other_start, other_stop):
+        if other_start is None:
+            return start, stop
+        if start is None:
+            return other_start, other_stop
+        # a handler closed before it completed has no stop time
+        if other_stop is not None and (stop is None or other_stop > stop):
+            stop = other_stop
+        return min(start, other_start), stop
+
+    def add_sender(self, s_handler):
+        self.calls += s_handler.calls
+        self.tx_bytes += s_handler.calls * s_handler.message_size
+        self.tx_start, self.tx_stop = self._span(self.tx_start, self.tx_stop,
+                                                 s_handler.start_time,
+                                                 s_handler.stop_time)
+        self.ack_latency.merge(s_handler.ack_latency)
+
+    def add_receiver(self, r_handler):
+        self.receives += r_handler.receives
+        self.rx_start, self.rx_stop = self._span(self.rx_start, self.rx_stop,
+                                                 r_handler.start_time,
+                                                 r_handler.stop_time)
+        self.rx_latency.merge(r_handler.rx_latency)
+
+    def add_sequences(self, checker, shared=False):
+        """Add the sequence checks of a receiver, or merge those shared by
+        the receivers of a balanced address: merging their trackers, rather
+        than adding their counts, does not count the messages of a sender
+        that went to the other receivers as gaps.
+        """
+        if not shared:
+            SequenceChecker.merge_counts(self.sequence, checker.counts())
+        elif self.shared_sequence is None:
+            self.shared_sequence = SequenceChecker().merge(checker)
+        else:
+            self.shared_sequence.merge(checker)
+
+    @property
+    def sequence_counts(self):
+        counts = dict(self.sequence)
+        if self.shared_sequence:
+            SequenceChecker.merge_counts(counts,
+                                         self.shared_sequence.counts())
+        return counts
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.tx_bytes += other.tx_bytes
+        self.tx_start, self.tx_stop = self._span(self.tx_start, self.tx_stop,
+                                                 other.tx_start, other.tx_stop)
+        self.receives += other.receives
+        self.rx_start, self.rx_stop = self._span(self.rx_start, self.rx_stop,
+                                                 other.rx_start, other.rx_stop)
+        self.ack_latency.merge(other.ack_latency)
+        self.rx_latency.merge(other.rx_latency)
+        SequenceChecker.merge_counts(self.sequence, other.sequence)
+        if other.shared_sequence:
+            self.add_sequences(other.shared_sequence, shared=True)
+
+    def to_dict(self):
+        return {'calls': self.calls,
+                'tx_bytes': self.tx_bytes,
+                'tx_start': self.tx_start,
+                'tx_stop': self.tx_stop,
+                'receives': self.receives,
+                'rx_start': self.rx_start,
+                'rx_stop': self.rx_stop,
+                'ack_latency': self.ack_latency.to_dict(),
+                'rx_latency': self.rx_latency.to_dict(),
+                'sequence': self.sequence,
+                'shared_sequence': (self.shared_sequence.to_dict()
+                                    if self.shared_sequence else None)}
+
+    @classmethod
+    def from_dict(cls, values):
+        stats = cls()
+        for name in ('calls', 'tx_bytes', 'tx_start', 'tx_stop',
+                     'receives', 'rx_start', 'rx_stop', 'sequence'):
+            setattr(stats, name, values[name])
+        for name in ('ack_latency', 'rx_latency'):
+            setattr(stats, name, LatencyHistogram.from_dict(values[name]))
+        if values.get('shared_sequence'):
+            stats.shared_sequence = SequenceChecker.from_dict(
+                values['shared_sequence'])
+        return stats
+
+    @staticmethod
+    def _duration(start, stop):
+        if start is None or stop is None or stop <= start:
+            return None
+        return stop - start
+
+    @classmethod
+    def _rate(cls, count, start, stop):
+        duration = cls._duration(start, stop)
+        return count / duration if duration else 0.0
+
+    @property
+    def tx_rate(self):
+        return self._rate(self.calls, self.tx_start, self.tx_stop)
+
+    @property
+    def tx_byte_rate(self):
+        return self._rate(self.tx_bytes, self.tx_start, self.tx_stop)
+
+    @property
+    def rx_rate(self):
+        return self._rate(self.receives, self.rx_start, self.rx_stop)
+
+    def results(self):
+        """Return the results in the common perf tool JSON format."""
+        return perf_results('perf-pyngus',
+                            self.calls,
+                            self._duration(self.tx_start, self.tx_stop),
+                            self.receives,
+                            self._duration(self.rx_start, self.rx_stop),
+                            self.ack_latency, self.rx_latency,
+                            tx_bytes=self.tx_bytes,
+                            sequence=self.sequence_counts or None)
+
+    def report(self):
+        thru = self.tx_rate
+        permsg = 1.0 / thru if thru else 0.0
+        lines = [" TX Avg Calls/Sec: %f Per Call: %f MB/Sec: %f"
+                 % (thru, permsg, self.tx_byte_rate / 1000000.0),
+                 " RX Msgs: %d Avg Msgs/Sec: %f"
+                 % (self.receives, self.rx_rate)]
+        counts = self.sequence_counts
+        if counts:
+            lines.append(SequenceChecker.format_counts(counts))
+        lines.extend(self.ack_latency.report("Ack Latency"))
+        lines.extend(self.rx_latency.report("RX Latency"))
+        return lines
+
+
+def run_load(opts, index):
+    """Run one load generating process.  Returns its LoadStats."""
+    host, port = get_host_port(opts.server)
+
+    # create AMQP Container, Connections, SenderLinks and ReceiverLinks, all
+    # driven from a single EventLoop
+    #
+    container = pyngus.Container(uuid.uuid4().hex)
+    conn_properties = {'hostname': host,
+                       'x-server': False}
+    if opts.trace:
+        conn_properties["x-trace-protocol"] = True
+
+    # a single receiver can stop after count messages, otherwise the
+    # receivers do not know how the messages are distributed across them so
+    # they drain until idle after the senders are done
+    single = (opts.processes == opts.connections == 1 and
+              opts.senders_per_conn == opts.receivers_per_conn == 1)
+    rx_count = opts.count if single else 0
+    warmup = opts.warmup if opts.count else 0
+    # the rate is shared by all the senders of all the processes:
+    rate = float(opts.rate) / (opts.processes * opts.connections *
+                               opts.senders_per_conn or 1)
+    presettled = opts.settle_mode == 'presettled'
+    sender_properties = {'snd-settle-mode':
+                         'settled' if presettled else 'unsettled'}
+
+    # with a balanced (anycast) address each receiver only gets part of each
+    # sender's sequence, so the receivers must share the sequence checks (and
+    # the processes merge theirs, see LoadStats.add_sequences)
+    shared = SequenceChecker() if opts.shared_sequence else None
+
+    corpus = Corpus(opts.corpus) if opts.corpus else None
+
+    loop = EventLoop()
+    connections = []
+    senders = []
+    receivers = []
+    for c in range(opts.connections):
+        my_socket = connect_socket(host, port)
+        connection = container.create_connection("perf_tool-%d-%d"
+                                                 % (index, c),
+                                                 ConnectionEventHandler(),
+                                                 conn_properties)
+        for r in range(opts.receivers_per_conn):
+            r_handler = ReceiverHandler(rx_count, opts.count or 1000, warmup,
+                                        shared)
+            receiver = connection.create_receiver(opts.node, opts.node,
+                                                  r_handler,
+                                                  name="receiver-%d" % r)
+            receivers.append((receiver, r_handler))
+        for s in range(opts.senders_per_conn):
+            s_handler = SenderHandler(opts.count, opts.window,
+                                      opts.payload_size, warmup,
+                                      rate, loop, presettled, corpus)
+            sender = connection.create_sender(opts.node, opts.node,
+                                              s_handler,
+                                              name="sender-%d" % s,
+                                              properties=sender_properties)
+            senders.append((sender, s_handler))
+        connection.open()
+        loop.add(connection, my_socket)
+        connections.append((connection, my_socket))
+
+    for receiver, _ in receivers:
+        receiver.open()
+    while not all(receiver.active for receiver, _ in receivers):
+        loop.process()
+
+    for sender, _ in senders:
+        sender.open()
+    loop.wakeup()
+
+    reporter = None
+    if opts.interval:
+        reporter = interval_reporter(opts, index, senders, receivers)
+        reporter.start(loop)
+    registry = Registry("perf_pyngus_")
+    registry.register(lambda metrics: collect_perf_links(metrics, senders,
+                                                         receivers))
+    exporter = metrics_exporter(opts, registry,
+                                index if opts.processes > 1 else None)
+    if exporter:
+        exporter.start(loop)
+
+    # Run until all messages transfered
+    last_rx = None
+    while not all(link.closed for link, _ in senders + receivers):
+        loop.process(opts.drain if rx_count == 0 else None)
+        if rx_count or not all(sender.closed for sender, _ in senders):
+            continue
+        received = sum(r_handler.receives for _, r_handler in receivers)
+        if not senders and not received:
+            continue  # receive only: wait for the traffic to start
+        if received != last_rx:
+            last_rx = received
+            drain_start = time.time()
+        elif time.time() - drain_start >= opts.drain:
+            for receiver, _ in receivers:
+                if not receiver.closed:
+                    receiver.close()
+            loop.wakeup()
+    if reporter:
+        reporter.stop()
+    if exporter:
+        exporter.stop()
+
+    for connection, _ in connections:
+        connection.close()
+    loop.wakeup()
+    while not all(connection.closed for connection, _ in connections):
+        loop.process()
+
+    stats = LoadStats()
+    for sender, s_handler in senders:
+        stats.add_sender(s_handler)
+        sender.destroy()
+    for receiver, r_handler in receivers:
+        stats.add_receiver(r_handler)
+        if not shared:
+            stats.add_sequences(r_handler.sequences)
+        receiver.destroy()
+    if shared and receivers:
+        stats.add_sequences(shared, shared=True)
+    loop.close()
+    for connection, my_socket in connections:
+        connection.destroy()
+        my_socket.close()
+    container.destroy()
+    if corpus:
+        corpus.close()
+    return stats
+
+
+def interval_reporter(opts, index, senders, receivers):
+    """Report the rates, messages in flight, credit and latency of this
+    process's links every opts.interval seconds.
+    """
+    path = opts.interval_output
+    fields = {}
+    if opts.processes > 1:
+        fields['process'] = index
+        if path:
+            path = "%s.%d" % (path, index)
+    reporter = IntervalReporter(opts.interval, path, opts.interval_format,
+                                fields)
+    s_handlers = [s_handler for _, s_handler in senders]
+    r_handlers = [r_handler for _, r_handler in receivers]
+    reporter.counter('tx_msgs',
+                     lambda: sum(h.sequence for h in s_handlers))
+    reporter.counter('tx_bytes',
+                     lambda: sum(h.sequence * h.message_size
+                                 for h in s_handlers))
+    reporter.counter('acked_msgs', lambda: sum(h.calls for h in s_handlers))
+    reporter.counter('rx_msgs', lambda: sum(h.receives for h in r_handlers))
+    reporter.gauge('in_flight',
+                   lambda: sum(h.outstanding for h in s_handlers))
+    reporter.gauge('credit',
+                   lambda: sum(link.credit for link, _ in senders))
+    reporter.histograms('ack_latency',
+                        lambda: [h.ack_latency for h in s_handlers])
+    reporter.histograms('rx_latency',
+                        lambda: [h.rx_latency for h in r_handlers])
+    return reporter
+
+
+def run_trial(opts):
+    """Run the load in opts.processes processes.  Returns the merged
+    LoadStats.
+    """
+    if opts.processes == 1:
+        return run_load(opts, 0)
+    stats = LoadStats()
+    results = run_workers(opts.processes,
+                          lambda index: run_load(opts, index).to_dict())
+    for result in results:
+        if result:
+            stats.merge(LoadStats.from_dict(result))
+    return stats
+
+
+def parse_sweep(value):
+    """Parse 'min:max:step' into a list of payload sizes.  A step of the form
+    'xN' multiplies the size by N instead of adding N.
+    """
+    low, high, step = value.split(':')
+    low, high = int(low), int(high)
+    if step.startswith('x'):
+        factor, step = int(step[1:]), 0
+        if factor < 2:
+            raise ValueError("multiplier must be at least 2")
+    else:
+        factor, step = 1, int(step)
+        if step < 1:
+            raise ValueError("step must be at least 1")
+    if low < 0 or high < low:
+        raise ValueError("need 0 <= min <= max")
+    sizes = []
+    size = low
+    while size <= high:
+        sizes.append(size)
+        size = size * factor + step if size or step else 1
+    return sizes
+
+
+SWEEP_FIELDS = ('payload_size', 'messages', 'msgs_per_sec', 'mb_per_sec',
+                'rx_msgs_per_sec',
+                'ack_p50', 'ack_p90', 'ack_p99', 'ack_p99.9', 'ack_max',
+                'rx_p50', 'rx_p90', 'rx_p99', 'rx_p99.9', 'rx_max')
+
+
+def sweep_row(size, stats):
+    """Summarize the LoadStats of one sweep trial."""
+    row = {'payload_size': size,
+           'messages': stats.calls,
+           'msgs_per_sec': stats.tx_rate,
+           'mb_per_sec': stats.tx_byte_rate / 1000000.0,
+           'rx_msgs_per_sec': stats.rx_rate}
+    for name, hist in (('ack', stats.ack_latency), ('rx', stats.rx_latency)):
+        for pct in (50, 90, 99, 99.9):
+            row["%s_p%s" % (name, pct)] = hist.percentile(pct)
+        row["%s_max" % name] = hist.max / 1000000.0
+    return row
+
+
 def main(argv=None):
 
     _usage = """Usage: %prog [options]"""
@@ -139,65 +647,119 @@ def main(argv=None):
     parser.add_option("--node", type='string', default='amq.topic',
                       help='Name of source/target node')
     parser.add_option("--count", type='int', default=100,
-                      help='Send N messages (send forever if N==0)')
+                      help='Send N messages per sender (forever if N==0)')
+    parser.add_option("--window", type='int', default=1,
+                      help='Max unacked messages in flight [1]')
+    parser.add_option("--rate", type='float', default=0,
+                      help='Send open-loop at this many msgs/sec in total,'
+                      ' ignoring --window [closed-loop]')
+    parser.add_option("--settle-mode", type='choice',
+                      choices=['presettled', 'at-least-once'],
+                      default='at-least-once',
+                      help='Send presettled (at-most-once, no acks, ignores'
+                      ' --window) or at-least-once [at-least-once]')
+    parser.add_option("--connections", type='int', default=1,
+                      help='Connections per process [1]')
+    parser.add_option("--senders-per-conn", type='int', default=1,
+                      help='Sender links per connection [1]')
+    parser.add_option("--receivers-per-conn", type='int', default=1,
+                      help='Receiver links per connection [1]')
+    parser.add_option("--shared-sequence", action="store_true",
+                      help='Check sequence numbers across all the receivers'
+                      ' of all the processes rather than per receiver: use'
+                      ' it with balanced addresses, where each receiver only'
+                      ' gets part of each sender\'s messages (otherwise the'
+                      ' rest are counted as gaps)')
+    parser.add_option("--processes", type='int', default=1,
+                      help='Number of load generating processes [1]')
+    parser.add_option("--drain", type='float', default=2.0,
+                      help='With multiple links, stop receiving after this'
+                      ' many idle seconds once all sends are done [2.0]')
+    parser.add_option("--payload-size", type='int', default=0,
+                      help='Add a payload of N bytes to each message [0]')
+    parser.add_option("--corpus", type='string',
+                      help='Replay the messages of this corpus (see'
+                      ' corpus.py) instead of sending a synthetic message')
+    parser.add_option("--warmup", type='int', default=0,
+                      help='Send N messages per sender before measuring [0]')
+    parser.add_option("--sweep", type='string',
+                      help='Run a trial for each payload size in min:max:step'
+                      ' (use a step of xN for a geometric sweep)')
+    parser.add_option("--format", type='choice', choices=['csv', 'json'],
+                      default='csv', help='Sweep output format [csv]')
+    parser.add_option("--output", type='string',
+                      help='Write the sweep results to this file [stdout]')
+    parser.add_option("--histogram-out", type='string',
+                      help='Save the latency histograms to this JSON file')
+    parser.add_option("--json", action="store_true",
+                      help='Print the results as JSON instead of text')
+    parser.add_option("--interval", type='float', default=0,
+                      help='Also report the rates, messages in flight, credit'
+                      ' and latency every N seconds [off]')
+    parser.add_option("--interval-output", type='string',
+                      help='Write the interval reports to this file, one per'
+                      ' process (PATH.N) with --processes [stdout]')
+    parser.add_option("--interval-format", type='choice',
+                      choices=['text', 'csv', 'json'], default='text',
+                      help='Interval report format: text, csv or json'
+                      ' (lines) [text]')
+    add_metrics_options(parser)
     parser.add_option("--debug", dest="debug", action="store_true",
                       help="enable debug logging")
     parser.add_option("--trace", dest="trace", action="store_true",
                       help="enable protocol tracing")
 
     opts, _ = parser.parse_args(args=argv)
+    if opts.window < 1:
+        parser.error("--window must be at least 1")
+    for name in ('connections', 'processes'):
+        if getattr(opts, name) < 1:
+            parser.error("--%s must be at least 1" % name)
+    if opts.corpus and opts.sweep:
+        parser.error("--sweep cannot be used with --corpus")
+    if opts.interval and opts.sweep:
+        parser.error("--sweep cannot be used with --interval")
+    if opts.sweep:
+        try:
+            sizes = parse_sweep(opts.sweep)
+        except ValueError as e:
+            parser.error("bad --sweep value: %s" % str(e))
     if opts.debug:
         LOG.setLevel(logging.DEBUG)
-    host, port = get_host_port(opts.server)
-    my_socket = connect_socket(host, port)
-
-    # create AMQP Container, Connection, and SenderLink
-    #
-    container = pyngus.Container(uuid.uuid4().hex)
-    conn_properties = {'hostname': host,
-                       'x-server': False}
-    if opts.trace:
-        conn_properties["x-trace-protocol"] = True
-
-    c_handler = ConnectionEventHandler()
-    connection = container.create_connection("perf_tool",
-                                             c_handler,
-                                             conn_properties)
-
-    r_handler = ReceiverHandler(opts.count, opts.count or 1000)
-    receiver = connection.create_receiver(opts.node, opts.node, r_handler)
-
-    s_handler = SenderHandler(opts.count)
-    sender = connection.create_sender(opts.node, opts.node, s_handler)
-
-    connection.open()
-    receiver.open()
-    while not receiver.active:
-        process_connection(connection, my_socket)
-
-    sender.open()
-
-    # Run until all messages transfered
-    while not sender.closed or not receiver.closed:
-        process_connection(connection, my_socket)
-    connection.close()
-    while not connection.closed:
-        process_connection(connection, my_socket)
-
-    duration = s_handler.stop_time - s_handler.start_time
-    thru = s_handler.calls / duration
-    permsg = duration / s_handler.calls
-    ack = s_handler.total_ack_latency / s_handler.calls
-    lat = r_handler.tx_total_latency / r_handler.receives
-    print("Stats:\n"
-          " TX Avg Calls/Sec: %f Per Call: %f Ack Latency %f\n"
-          " RX Latency: %f" % (thru, permsg, ack, lat))
-
-    sender.destroy()
-    receiver.destroy()
-    connection.destroy()
-    container.destroy()
-    my_socket.close()
+    if opts.connections > 1:
+        raise_fd_limit()
+
+    if not opts.sweep:
+        stats = run_trial(opts)
+        if opts.json:
+            print(json.dumps(stats.results(), sort_keys=True))
+        else:
+            print("Stats:")
+            print("\n".join(stats.report()))
+        if opts.histogram_out:
+            save_histograms(opts.histogram_out, {'ack': stats.ack_latency,
+                                                 'rx': stats.rx_latency})
+        return 0
+
+    rows = []
+    for size in sizes:
+        opts.payload_size = size
+        stats = run_trial(opts)
+        rows.append(sweep_row(size, stats))
+        LOG.info("payload %d: %f msgs/sec", size, stats.tx_rate)
+
+    out = open(opts.output, 'w') if opts.output else sys.stdout
+    try:
+        if opts.format == 'json':
+            json.dump(rows, out, indent=2)
+            out.write("\n")
+        else:
+            writer = csv.DictWriter(out, fieldnames=SWEEP_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    finally:
+        if out is not sys.stdout:
+            out.close()
     return 0
 
 
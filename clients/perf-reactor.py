@@ -18,6 +18,7 @@
 # under the License.
 #
 
+import json
 import optparse
 import logging
 import sys
@@ -25,14 +26,32 @@ import time
 import pdb
 import proton
 from proton import Message, Url
-from proton.reactor import Reactor, AtLeastOnce
+from proton.reactor import Reactor, AtLeastOnce, AtMostOnce
 from proton.handlers import CHandshaker, CFlowController
 
+from utils import Corpus
+from utils import CorpusMessage
+from utils import IntervalReporter
+from utils import LatencyHistogram
+from utils import perf_results
+from utils import PreEncodedMessage
+from utils import save_histograms
+from utils import SequenceChecker
+
 
 class Perfy:
 
-    def __init__(self, target, count):
-        self.message = Message()
+    def __init__(self, target, count, histogram_out=None, presettled=False,
+                 json_out=False, corpus=None, reporter=None):
+        self.json_out = json_out
+        self.reporter = reporter
+        self.presettled = presettled
+        if corpus is not None:
+            self.message = CorpusMessage(corpus)
+        else:
+            self.message = PreEncodedMessage()
+        self.sequence = 0
+        self.receives = 0
         self.target = target if target is not None else "examples"
         # Use the handlers property to add some default handshaking
         # behaviour.
@@ -43,49 +62,81 @@ class Perfy:
         self.receiver = None
         self.count = count
         self._sends = count
+        self._unsent = count
         self.start_time = None
         self.stop_time = None
         self.last_send_time = None
-        self.total_ack_latency = 0.0
-        self.total_tx_latency = 0.0
+        self.ack_latency = LatencyHistogram()
+        self.rx_latency = LatencyHistogram()
+        self.sequences = SequenceChecker()
+        self.histogram_out = histogram_out
 
     def _send_message(self, link):
         now = time.time()
-        self.message.body = {'tx-timestamp': now}
+        self.message.stamp(now, self.sequence)
+        self.sequence += 1
         self.last_send_time = now
+        self._unsent -= 1
+        # settled as it is sent if the link is presettled (AtMostOnce)
         dlv = link.send(self.message)
 
+    def _report(self, now):
+        self.stop_time = now
+        if self.reporter:
+            self.reporter.stop(now)
+        duration = self.stop_time - self.start_time
+        if self.json_out:
+            # the receiver shares the connection, so has the same duration
+            results = perf_results('perf-reactor', self.count, duration,
+                                   self.receives, duration,
+                                   self.ack_latency, self.rx_latency,
+                                   sequence=self.sequences.counts())
+            print(json.dumps(results, sort_keys=True))
+        else:
+            thru = self.count / duration
+            permsg = duration / self.count
+            print("Stats:\n"
+                  " TX Avg Calls/Sec: %f Per Call: %f"
+                  % (thru, permsg))
+            print(self.sequences.report())
+            print("\n".join(self.ack_latency.report("Ack Latency")))
+            print("\n".join(self.rx_latency.report("RX Latency")))
+        if self.histogram_out:
+            save_histograms(self.histogram_out,
+                            {'ack': self.ack_latency,
+                             'rx': self.rx_latency})
+
     def on_delivery(self, event):
         now = time.time()
         link = event.link
         if link.is_sender:
             dlv = event.delivery
-            if dlv.settled:
-                self.total_ack_latency += now - self.last_send_time
+            if dlv.settled and not self.presettled:
+                self.ack_latency.record(now - self.last_send_time)
                 dlv.settle()
                 if self._sends:
                     self._send_message(link)
                 else:
-                    self.stop_time = now
                     link.close()
-                    duration = self.stop_time - self.start_time
-                    thru = self.count / duration
-                    permsg = duration / self.count
-                    ack = self.total_ack_latency / self.count
-                    lat = self.total_tx_latency / self.count
-                    print("Stats:\n"
-                          " TX Avg Calls/Sec: %f Per Call: %f Ack Latency %f\n"
-                          " RX Latency: %f" % (thru, permsg, ack, lat))
+                    self._report(now)
         else:
             msg = Message()
             dlv = msg.recv(link)
             if dlv:
                 dlv.update(dlv.ACCEPTED)
                 dlv.settle()
-                self.total_tx_latency += now - msg.body['tx-timestamp']
+                self.sequences.record(msg)
+                self.receives += 1
+                sent = PreEncodedMessage.sent_at(msg)
+                if sent is not None:
+                    self.rx_latency.record(now - sent)
                 self._sends -= 1
                 if self._sends == 0:
                     link.close()
+                    if self.presettled:
+                        # no acks: the last receive ends the test
+                        self.sender.close()
+                        self._report(now)
 
 
     def on_link_remote_close(self, event):
@@ -109,24 +160,62 @@ class Perfy:
         if link.is_receiver:
             self.sender = self.ssn.sender("Perfy-TX")
             self.sender.target.address = self.target
-            AtLeastOnce().apply(self.sender)
+            if self.presettled:
+                AtMostOnce().apply(self.sender)
+            else:
+                AtLeastOnce().apply(self.sender)
             self.sender.open()
 
     def on_link_flow(self, event):
         if self.start_time is None and self.sender.credit > 0:
             self.start_time = time.time()
-            self._send_message(event.link)
+            if self.reporter:
+                self._start_reporter(event.reactor)
+            self._send_message(self.sender)
+        if self.presettled:
+            # nothing to wait for: send as far as credit allows (a count of
+            # 0 sends forever)
+            while self.sender.credit > 0 and (not self.count or
+                                              self._unsent > 0):
+                self._send_message(self.sender)
+
+    def _start_reporter(self, reactor):
+        reporter = self.reporter
+        reporter.counter('tx_msgs', lambda: self.sequence)
+        reporter.counter('tx_bytes',
+                         lambda: self.sequence * len(self.message))
+        reporter.counter('acked_msgs', lambda: self.ack_latency.count)
+        reporter.counter('rx_msgs', lambda: self.receives)
+        reporter.gauge('in_flight', lambda: self.sender.unsettled)
+        reporter.gauge('credit', lambda: self.sender.credit)
+        reporter.histograms('ack_latency', lambda: [self.ack_latency])
+        reporter.histograms('rx_latency', lambda: [self.rx_latency])
+        reporter.begin(self.start_time)
+        reactor.schedule(reporter.interval, self)
+
+    def on_timer_task(self, event):
+        # the interval report timer
+        if self.stop_time is None:
+            self.reporter.report()
+            event.reactor.schedule(self.reporter.interval, self)
 
     def on_transport_error(self, event):
-        print event.transport.condition
+        print(event.transport.condition)
 
 
 class Program:
 
-    def __init__(self, url, node, count):
+    def __init__(self, url, node, count, histogram_out=None,
+                 presettled=False, json_out=False, corpus=None,
+                 reporter=None):
+        self.reporter = reporter
+        self.corpus = corpus
+        self.json_out = json_out
+        self.presettled = presettled
         self.url = url
         self.node = node
         self.count = count
+        self.histogram_out = histogram_out
 
     def on_reactor_init(self, event):
         # You can use the connection method to create AMQP connections.
@@ -136,7 +225,12 @@ class Program:
         # going to the reactor. If you were to omit the Send object,
         # all the events would go to the reactor.
         event.reactor.connection_to_host(self.url.host, self.url.port,
-                                         Perfy(self.node, self.count))
+                                         Perfy(self.node, self.count,
+                                               self.histogram_out,
+                                               self.presettled,
+                                               self.json_out,
+                                               self.corpus,
+                                               self.reporter))
 
 
 
@@ -149,7 +243,35 @@ parser.add_option("--node", type='string', default='amq.topic',
                   help='Name of source/target node')
 parser.add_option("--count", type='int', default=100,
                   help='Send N messages (send forever if N==0)')
+parser.add_option("--settle-mode", type='choice',
+                  choices=['presettled', 'at-least-once'],
+                  default='at-least-once',
+                  help='Send presettled (at-most-once) or at-least-once'
+                  ' [at-least-once]')
+parser.add_option("--histogram-out", type='string',
+                  help='Save the latency histograms to this JSON file')
+parser.add_option("--corpus", type='string',
+                  help='Replay the messages of this corpus (see corpus.py)'
+                  ' instead of sending a synthetic message')
+parser.add_option("--json", action="store_true",
+                  help='Print the results as JSON instead of text')
+parser.add_option("--interval", type='float', default=0,
+                  help='Also report the rates, messages in flight, credit'
+                  ' and latency every N seconds [off]')
+parser.add_option("--interval-output", type='string',
+                  help='Write the interval reports to this file [stdout]')
+parser.add_option("--interval-format", type='choice',
+                  choices=['text', 'csv', 'json'], default='text',
+                  help='Interval report format: text, csv or json (lines)'
+                  ' [text]')
 
 opts, _ = parser.parse_args(args=sys.argv)
-r = Reactor(Program(Url(opts.server), opts.node, opts.count))
+r = Reactor(Program(Url(opts.server), opts.node, opts.count,
+                    opts.histogram_out,
+                    opts.settle_mode == 'presettled',
+                    opts.json,
+                    Corpus(opts.corpus) if opts.corpus else None,
+                    IntervalReporter(opts.interval, opts.interval_output,
+                                     opts.interval_format)
+                    if opts.interval else None))
 r.run()
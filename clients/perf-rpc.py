@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+"""RPC (request/reply) benchmark.
+
+Sends calls to --target, each with a reply_to address (by default the
+dynamic address of the client's reply link) and a correlation_id, keeping up
+to --outstanding calls in flight.  The replies are matched to their calls by
+correlation_id, and the calls completed per second and the round trip time
+percentiles are reported.  Run server.py --echo to answer the calls, or
+point the client at a router that routes --target to an RPC server.
+"""
+
+import json
+import logging
+import optparse
+import sys
+import time
+import uuid
+
+from proton import Message
+from proton import ulong
+import pyngus
+
+from metrics import add_metrics_options
+from metrics import metrics_exporter
+from metrics import Registry
+from utils import connect_socket
+from utils import EventLoop
+from utils import get_host_port
+from utils import IntervalReporter
+from utils import LatencyHistogram
+
+LOG = logging.getLogger()
+LOG.addHandler(logging.StreamHandler())
+
+
+class CallTable(object):
+    """The calls in flight, indexed by correlation id.
+
+    The table has a fixed number of slots.  A call's correlation id is
+    generation * size + slot, so a reply finds its call in one lookup, and
+    a late reply to a call whose slot has since been reused does not match.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._ids = [None] * size
+        self._starts = [0.0] * size
+        self._generations = [0] * size
+        self._free = list(range(size - 1, -1, -1))
+
+    def __len__(self):
+        return self.size - len(self._free)
+
+    @property
+    def full(self):
+        return not self._free
+
+    def add(self, now):
+        """Start a call at time now, return its correlation id."""
+        slot = self._free.pop()
+        call_id = self._generations[slot] * self.size + slot
+        self._generations[slot] += 1
+        self._ids[slot] = call_id
+        self._starts[slot] = now
+        return call_id
+
+    def complete(self, call_id):
+        """Return the start time of the call, None if it is not in flight."""
+        slot = call_id % self.size
+        if self._ids[slot] != call_id:
+            return None
+        self._ids[slot] = None
+        self._free.append(slot)
+        return self._starts[slot]
+
+    def expire(self, started_before):
+        """Drop the calls started before the given time, return how many."""
+        count = 0
+        for slot, call_id in enumerate(self._ids):
+            if call_id is not None and self._starts[slot] < started_before:
+                self._ids[slot] = None
+                self._free.append(slot)
+                count += 1
+        return count
+
+
+class RpcClient(pyngus.ConnectionEventHandler,
+                pyngus.SenderEventHandler,
+                pyngus.ReceiverEventHandler):
+    """Make calls on one connection until 'count' calls have been made
+    (forever if 0) or 'duration' seconds have passed, then wait for the
+    outstanding replies.
+    """
+    def __init__(self, opts, conn_properties):
+        host, port = get_host_port(opts.server)
+        self.socket = connect_socket(host, port, blocking=False)
+        self.container = pyngus.Container(uuid.uuid4().hex)
+        self.connection = self.container.create_connection(
+            "rpc-client", self, conn_properties)
+        self.loop = EventLoop()
+        self.loop.add(self.connection, self.socket)
+        self.calls = CallTable(opts.outstanding)
+        self._count = opts.count
+        self._duration = opts.duration
+        self._timeout = opts.timeout
+        self.sent = 0
+        self.completed = 0
+        self.timed_out = 0
+        self.stale = 0
+        self.rtt = LatencyHistogram()
+        self.error = None
+        self.done = False
+        self.start_time = None
+        self.stop_time = None
+
+        # one Message is re-used for all the calls: pyngus encodes it when
+        # it is sent, and it is only sent when the link has credit
+        self._request = Message()
+        self._request.body = b"x" * opts.size
+        # the calls are pre-settled: the reply is the acknowledgement
+        self.sender = self.connection.create_sender(
+            opts.target, opts.target, self, name="rpc-calls",
+            properties={"snd-settle-mode": "settled"})
+        # a None source asks the peer for a dynamic reply address
+        self.receiver = self.connection.create_receiver(
+            "rpc-replies", opts.reply_to, self, name="rpc-replies")
+        self.connection.open()
+        self.sender.open()
+        self.receiver.open()
+
+    def _more(self, now):
+        if self._count and self.sent >= self._count:
+            return False
+        return not self._duration or now - self.start_time < self._duration
+
+    def _send_calls(self):
+        if self.start_time is None or self.stop_time is not None:
+            return
+        now = time.time()
+        while (self.sender.credit > 0 and not self.calls.full and
+               self._more(now)):
+            self._request.correlation_id = ulong(self.calls.add(now))
+            self.sender.send(self._request)
+            self.sent += 1
+        if not self.calls and not self._more(now):
+            self._finish()
+
+    def _finish(self, error=None):
+        if self.stop_time is None:
+            self.stop_time = time.time()
+            self.error = error
+            self.connection.close()
+
+    def _check_timeouts(self):
+        if self.stop_time is not None:
+            return
+        expired = self.calls.expire(time.time() - self._timeout)
+        if expired:
+            LOG.debug("%d calls timed out", expired)
+            self.timed_out += expired
+            self._send_calls()
+            self.loop.wakeup(self.connection)
+        self.loop.call_later(min(self._timeout, 1.0), self._check_timeouts)
+
+    def run(self):
+        try:
+            while not self.done:
+                self.loop.process()
+        except KeyboardInterrupt:
+            self._finish()
+        if self.start_time is None:
+            self.start_time = self.stop_time
+
+    def close(self):
+        self.loop.close()
+        self.sender.destroy()
+        self.receiver.destroy()
+        self.connection.destroy()
+        self.container.destroy()
+        self.socket.close()
+
+    # Connection events
+
+    def connection_closed(self, connection):
+        self.done = True
+
+    def connection_failed(self, connection, error):
+        self._finish(error or "connection failed")
+        self.done = True
+
+    def connection_remote_closed(self, connection, pn_condition):
+        self._finish("connection closed by peer: %s" % pn_condition)
+        connection.close()
+
+    # Link events
+
+    def sender_remote_closed(self, sender_link, pn_condition):
+        self._finish("calls link closed by peer: %s" % pn_condition)
+
+    def receiver_remote_closed(self, receiver_link, pn_condition):
+        self._finish("replies link closed by peer: %s" % pn_condition)
+
+    def sender_failed(self, sender_link, error):
+        self._finish(error or "calls link failed")
+
+    def receiver_failed(self, receiver_link, error):
+        self._finish(error or "replies link failed")
+
+    def credit_granted(self, sender_link):
+        self._send_calls()
+
+    def receiver_active(self, receiver_link):
+        reply_to = receiver_link.source_address
+        if not reply_to:
+            self._finish("no reply address assigned")
+            return
+        LOG.debug("Reply address: %s", reply_to)
+        self._request.reply_to = reply_to
+        receiver_link.add_capacity(self.calls.size)
+        self.start_time = time.time()
+        if self._timeout:
+            self.loop.call_later(min(self._timeout, 1.0),
+                                 self._check_timeouts)
+        self._send_calls()
+
+    def message_received(self, receiver_link, message, handle):
+        receiver_link.message_accepted(handle)
+        start = None
+        try:
+            start = self.calls.complete(int(message.correlation_id))
+        except (TypeError, ValueError):
+            pass
+        if start is None:
+            # timed out, or not a reply to one of our calls
+            self.stale += 1
+        else:
+            self.completed += 1
+            self.rtt.record(time.time() - start)
+        capacity = receiver_link.capacity
+        if capacity * 2 <= self.calls.size:
+            receiver_link.add_capacity(self.calls.size - capacity)
+        self._send_calls()
+
+    # Results
+
+    def _rate(self, count):
+        duration = self.stop_time - self.start_time
+        return count / duration if duration > 0 else 0.0
+
+    def results(self):
+        return {'tool': 'rpc',
+                'duration': self.stop_time - self.start_time,
+                'calls': self.completed,
+                'calls_per_sec': self._rate(self.completed),
+                'timed_out': self.timed_out,
+                'stale_replies': self.stale,
+                'outstanding': self.calls.size,
+                'error': self.error,
+                'rtt': self.rtt.summary_dict()}
+
+    def report(self):
+        lines = [" Calls: %d (%d timed out, %d stale replies) in %f secs"
+                 % (self.completed, self.timed_out, self.stale,
+                    self.stop_time - self.start_time),
+                 " Calls/Sec: %f with up to %d outstanding"
+                 % (self._rate(self.completed), self.calls.size)]
+        lines.extend(self.rtt.report("Round Trip Time"))
+        return lines
+
+    def metrics(self, metrics):
+        metrics.counter('calls_total', 'Calls that got a reply',
+                        self.completed)
+        metrics.counter('calls_sent_total', 'Calls sent', self.sent)
+        metrics.counter('timed_out_total', 'Calls that got no reply in time',
+                        self.timed_out)
+        metrics.counter('stale_replies_total',
+                        'Replies to calls that had already timed out',
+                        self.stale)
+        metrics.gauge('in_flight', 'Calls waiting for a reply',
+                      len(self.calls))
+        metrics.gauge('credit', 'Credit granted by the peer for calls',
+                      self.sender.credit)
+        metrics.summary('rtt_seconds', 'Time from sending a call until its'
+                        ' reply arrives', self.rtt)
+
+
+def main(argv=None):
+
+    _usage = """Usage: %prog [options]"""
+    parser = optparse.OptionParser(usage=_usage)
+    parser.add_option("-a", dest="server", type="string",
+                      default="amqp://0.0.0.0:5672",
+                      help="The address of the server [amqp://0.0.0.0:5672]")
+    parser.add_option("--target", type='string',
+                      default='openstack.org/om/rpc/anycast/perf',
+                      help='Address the calls are sent to'
+                      ' [openstack.org/om/rpc/anycast/perf]')
+    parser.add_option("--reply-to", type='string',
+                      help='Address to receive the replies from [dynamic]')
+    parser.add_option("--count", type='int', default=10000,
+                      help='Make N calls in total (0 for no limit) [10000]')
+    parser.add_option("--duration", type='float', default=0,
+                      help='Stop making new calls after N seconds'
+                      ' [no limit]')
+    parser.add_option("--outstanding", type='int', default=100,
+                      help='Calls in flight at once [100]')
+    parser.add_option("--size", type='int', default=0,
+                      help='Bytes in the body of each call [0]')
+    parser.add_option("--timeout", type='float', default=30.0,
+                      help='Give up on a reply after N seconds, 0 to wait'
+                      ' forever [30]')
+    parser.add_option("--json", action="store_true",
+                      help='Print the results as JSON instead of text')
+    parser.add_option("--interval", type='float', default=0,
+                      help='Also report the rates and latency every N'
+                      ' seconds [off]')
+    parser.add_option("--interval-output", type='string',
+                      help='Write the interval reports to this file [stdout]')
+    parser.add_option("--interval-format", type='choice',
+                      choices=['text', 'csv', 'json'], default='text',
+                      help='Interval report format: text, csv or json'
+                      ' (lines) [text]')
+    parser.add_option("--idle-timeout", type="int", default=0,
+                      help="Idle timeout for connections (seconds).")
+    parser.add_option("--ca",
+                      help="Certificate Authority PEM file")
+    parser.add_option("--ssl-cert-file",
+                      help="Self-identifying certificate (PEM file)")
+    parser.add_option("--ssl-key-file",
+                      help="Key for self-identifying certificate (PEM file)")
+    parser.add_option("--ssl-key-password",
+                      help="Password to unlock SSL key file")
+    parser.add_option("--username", type="string",
+                      help="User Id for authentication")
+    parser.add_option("--password", type="string",
+                      help="User password for authentication")
+    parser.add_option("--sasl-mechs", type="string",
+                      help="The list of acceptable SASL mechs")
+    parser.add_option("--sasl-config-dir", type="string",
+                      help="Path to directory containing sasl config")
+    parser.add_option("--sasl-config-name", type="string",
+                      help="Name of the sasl config file (without '.config')")
+    add_metrics_options(parser)
+    parser.add_option("--debug", dest="debug", action="store_true",
+                      help="enable debug logging")
+    parser.add_option("--trace", dest="trace", action="store_true",
+                      help="enable protocol tracing")
+
+    opts, _ = parser.parse_args(args=argv)
+    if opts.outstanding < 1:
+        parser.error("--outstanding must be at least 1")
+    if opts.size < 0:
+        parser.error("--size cannot be negative")
+    if not opts.count and not opts.duration:
+        LOG.warning("No --count or --duration: running until interrupted")
+    if opts.debug:
+        LOG.setLevel(logging.DEBUG)
+
+    host, _ = get_host_port(opts.server)
+    conn_properties = {'hostname': host,
+                       'x-server': False}
+    if opts.trace:
+        conn_properties["x-trace-protocol"] = True
+    if opts.ca:
+        conn_properties["x-ssl-ca-file"] = opts.ca
+    if opts.ssl_cert_file:
+        conn_properties["x-ssl-identity"] = (opts.ssl_cert_file,
+                                             opts.ssl_key_file,
+                                             opts.ssl_key_password)
+    if opts.idle_timeout:
+        conn_properties["idle-time-out"] = opts.idle_timeout
+    if opts.username:
+        conn_properties['x-username'] = opts.username
+    if opts.password:
+        conn_properties['x-password'] = opts.password
+    if opts.sasl_mechs:
+        conn_properties['x-sasl-mechs'] = opts.sasl_mechs
+    if opts.sasl_config_dir:
+        conn_properties["x-sasl-config-dir"] = opts.sasl_config_dir
+    if opts.sasl_config_name:
+        conn_properties["x-sasl-config-name"] = opts.sasl_config_name
+
+    client = RpcClient(opts, conn_properties)
+    reporter = None
+    if opts.interval:
+        reporter = IntervalReporter(opts.interval, opts.interval_output,
+                                    opts.interval_format)
+        reporter.counter('calls', lambda: client.completed)
+        reporter.counter('timed_out', lambda: client.timed_out)
+        reporter.gauge('in_flight', lambda: len(client.calls))
+        reporter.histograms('rtt', lambda: [client.rtt])
+        reporter.start(client.loop)
+    registry = Registry("rpc_")
+    registry.register(client.metrics)
+    exporter = metrics_exporter(opts, registry)
+    if exporter:
+        exporter.start(client.loop)
+    client.run()
+    if reporter:
+        reporter.stop()
+    if exporter:
+        exporter.stop()
+    client.close()
+
+    if client.error:
+        LOG.error("RPC client failed: %s", client.error)
+    if opts.json:
+        print(json.dumps(client.results(), sort_keys=True))
+    else:
+        print("Stats:")
+        print("\n".join(client.report()))
+    return 0 if client.completed and not client.error else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,6 +19,7 @@
 #
 """ Minimal message receive example code."""
 
+import json
 import logging
 import optparse
 import sys
@@ -28,9 +29,21 @@ import uuid
 import pyngus
 from proton import Message
 
+from metrics import add_metrics_options
+from metrics import collect_perf_links
+from metrics import metrics_exporter
+from metrics import Registry
 from utils import connect_socket
+from utils import Corpus
+from utils import CorpusMessage
+from utils import EventLoop
 from utils import get_host_port
-from utils import process_connection
+from utils import IntervalReporter
+from utils import LatencyHistogram
+from utils import perf_results
+from utils import PreEncodedMessage
+from utils import save_histograms
+from utils import SequenceChecker
 
 LOG = logging.getLogger()
 LOG.addHandler(logging.StreamHandler())
@@ -53,36 +66,77 @@ class ConnectionEventHandler(pyngus.ConnectionEventHandler):
 
 
 class SenderHandler(pyngus.SenderEventHandler):
-    def __init__(self, count):
+    """Send messages, keeping up to 'window' unacked deliveries in flight.
+
+    A window of 1 is strict stop-and-wait.  Larger windows are further bounded
+    by the credit granted by the peer.  If presettled there are no acks to
+    wait for, so the window is ignored and only credit limits the sender.
+    """
+    def __init__(self, count, window=1, presettled=False, corpus=None):
+        self._presettled = presettled
         self._count = count
-        self._msg = Message()
+        self._forever = not count
+        self._unsent = count
+        self._window = window
+        if corpus is not None:
+            self._msg = CorpusMessage(corpus)
+        else:
+            self._msg = PreEncodedMessage()
+        self.message_size = len(self._msg)
+        self.sequence = 0
+        self.outstanding = 0
         self.calls = 0
-        self.total_ack_latency = 0.0
+        self.ack_latency = LatencyHistogram()
         self.stop_time = None
         self.start_time = None
 
     def credit_granted(self, sender_link):
         if self.start_time is None:
             self.start_time = time.time()
-            self._send_message(sender_link)
+        self._send_messages(sender_link)
 
-    def _send_message(self, link):
-        now = time.time()
-        self._msg.body = {'tx-timestamp': now}
-        self._last_send = now
-        link.send(self._msg, self)
+    def _send_messages(self, link):
+        while (self.outstanding < self._window and link.credit > 0 and
+               (self._forever or self._unsent)):
+            self._send_message(link)
 
-    def __call__(self, link, handle, status, error):
+    def _send_message(self, link):
         now = time.time()
-        self.total_ack_latency += now - self._last_send
+        self._msg.stamp(now, self.sequence)
+        self.sequence += 1
+        if self._unsent:
+            self._unsent -= 1
+        if self._presettled:
+            # no callback: pyngus settles the delivery as it is sent
+            link.send(self._msg)
+            if self._completed(now):
+                link.close()
+            return
+        self.outstanding += 1
+        # the send time is passed back as the handle in the ack callback, so
+        # latency is correct with many deliveries outstanding:
+        link.send(self._msg, self, handle=now)
+
+    def _completed(self, now):
+        """Account for a finished message.  Returns True once all messages
+        are done.
+        """
         self.calls += 1
         if self._count:
             self._count -= 1
             if self._count == 0:
                 self.stop_time = now
-                link.close()
-                return
-        self._send_message(link)
+                return True
+        return False
+
+    def __call__(self, link, handle, status, error):
+        now = time.time()
+        self.ack_latency.record(now - handle)
+        self.outstanding -= 1
+        if self._completed(now):
+            link.close()
+            return
+        self._send_messages(link)
 
     def sender_remote_closed(self, sender_link, pn_condition):
         LOG.debug("Sender peer_closed condition=%s", pn_condition)
@@ -100,7 +154,8 @@ class ReceiverHandler(pyngus.ReceiverEventHandler):
         self._capacity = capacity
         self._msg = Message()
         self.receives = 0
-        self.tx_total_latency = 0.0
+        self.rx_latency = LatencyHistogram()
+        self.sequences = SequenceChecker()
 
     def receiver_active(self, receiver_link):
         receiver_link.add_capacity(self._capacity)
@@ -118,7 +173,10 @@ class ReceiverHandler(pyngus.ReceiverEventHandler):
     def message_received(self, receiver, message, handle):
         now = time.time()
         receiver.message_accepted(handle)
-        self.tx_total_latency += now - message.body['tx-timestamp']
+        self.sequences.record(message)
+        sent = PreEncodedMessage.sent_at(message)
+        if sent is not None:
+            self.rx_latency.record(now - sent)
         self.receives += 1
         if self._count:
             self._count -= 1
@@ -142,12 +200,38 @@ def main(argv=None):
                       help='Name of source/target node')
     parser.add_option("--count", type='int', default=100,
                       help='Send N messages (send forever if N==0)')
+    parser.add_option("--window", type='int', default=1,
+                      help='Max unacked messages in flight [1]')
+    parser.add_option("--settle-mode", type='choice',
+                      choices=['presettled', 'at-least-once'],
+                      default='at-least-once',
+                      help='Send presettled (at-most-once, no acks, ignores'
+                      ' --window) or at-least-once [at-least-once]')
+    parser.add_option("--corpus", type='string',
+                      help='Replay the messages of this corpus (see'
+                      ' corpus.py) instead of sending a synthetic message')
+    parser.add_option("--histogram-out", type='string',
+                      help='Save the latency histograms to this JSON file')
+    parser.add_option("--json", action="store_true",
+                      help='Print the results as JSON instead of text')
+    parser.add_option("--interval", type='float', default=0,
+                      help='Also report the rates, messages in flight, credit'
+                      ' and latency every N seconds [off]')
+    parser.add_option("--interval-output", type='string',
+                      help='Write the interval reports to this file [stdout]')
+    parser.add_option("--interval-format", type='choice',
+                      choices=['text', 'csv', 'json'], default='text',
+                      help='Interval report format: text, csv or json'
+                      ' (lines) [text]')
+    add_metrics_options(parser)
     parser.add_option("--debug", dest="debug", action="store_true",
                       help="enable debug logging")
     parser.add_option("--trace", dest="trace", action="store_true",
                       help="enable protocol tracing")
 
     opts, _ = parser.parse_args(args=argv)
+    if opts.window < 1:
+        parser.error("--window must be at least 1")
     if opts.debug:
         LOG.setLevel(logging.DEBUG)
     host, port = get_host_port(opts.server)
@@ -169,35 +253,84 @@ def main(argv=None):
     r_handler = ReceiverHandler(opts.count, opts.count or 1000)
     receiver = connection.create_receiver(opts.node, opts.node, r_handler)
 
-    s_handler = SenderHandler(opts.count)
-    sender = connection.create_sender(opts.node, opts.node, s_handler)
+    presettled = opts.settle_mode == 'presettled'
+    corpus = Corpus(opts.corpus) if opts.corpus else None
+    s_handler = SenderHandler(opts.count, opts.window, presettled, corpus)
+    sender = connection.create_sender(
+        opts.node, opts.node, s_handler,
+        properties={'snd-settle-mode':
+                    'settled' if presettled else 'unsettled'})
 
     connection.open()
+    loop = EventLoop()
+    loop.add(connection, my_socket)
     receiver.open()
     while not receiver.active:
-        process_connection(connection, my_socket)
+        loop.process()
 
     sender.open()
+    loop.wakeup(connection)
+
+    reporter = None
+    if opts.interval:
+        reporter = IntervalReporter(opts.interval, opts.interval_output,
+                                    opts.interval_format)
+        reporter.counter('tx_msgs', lambda: s_handler.sequence)
+        reporter.counter('tx_bytes',
+                         lambda: s_handler.sequence * s_handler.message_size)
+        reporter.counter('acked_msgs', lambda: s_handler.calls)
+        reporter.counter('rx_msgs', lambda: r_handler.receives)
+        reporter.gauge('in_flight', lambda: s_handler.outstanding)
+        reporter.gauge('credit', lambda: sender.credit)
+        reporter.histograms('ack_latency', lambda: [s_handler.ack_latency])
+        reporter.histograms('rx_latency', lambda: [r_handler.rx_latency])
+        reporter.start(loop)
+    registry = Registry("perf_tool_")
+    registry.register(lambda metrics: collect_perf_links(
+        metrics, [(sender, s_handler)], [(receiver, r_handler)]))
+    exporter = metrics_exporter(opts, registry)
+    if exporter:
+        exporter.start(loop)
 
     # Run until all messages transfered
     while not sender.closed or not receiver.closed:
-        process_connection(connection, my_socket)
+        loop.process()
+    if reporter:
+        reporter.stop()
+    if exporter:
+        exporter.stop()
     connection.close()
+    loop.wakeup(connection)
     while not connection.closed:
-        process_connection(connection, my_socket)
-
-    thru = s_handler.calls / (s_handler.stop_time - s_handler.start_time)
-    ack = s_handler.total_ack_latency / s_handler.calls
-    lat = r_handler.tx_total_latency / r_handler.receives
-    print("Stats:\n"
-          " TX Avg Calls/Sec: %f  Ack Latency %f\n"
-          " RX Latency: %f" % (thru, ack, lat))
+        loop.process()
+
+    duration = s_handler.stop_time - s_handler.start_time
+    if opts.json:
+        results = perf_results('perf-tool', s_handler.calls, duration,
+                               r_handler.receives, None,
+                               s_handler.ack_latency, r_handler.rx_latency,
+                               sequence=r_handler.sequences.counts())
+        print(json.dumps(results, sort_keys=True))
+    else:
+        thru = s_handler.calls / duration
+        print("Stats:\n"
+              " TX Avg Calls/Sec: %f" % thru)
+        print(" RX Msgs: %d" % r_handler.receives)
+        print(r_handler.sequences.report())
+        print("\n".join(s_handler.ack_latency.report("Ack Latency")))
+        print("\n".join(r_handler.rx_latency.report("RX Latency")))
+    if opts.histogram_out:
+        save_histograms(opts.histogram_out, {'ack': s_handler.ack_latency,
+                                             'rx': r_handler.rx_latency})
 
     sender.destroy()
     receiver.destroy()
+    loop.close()
     connection.destroy()
     container.destroy()
     my_socket.close()
+    if corpus:
+        corpus.close()
     return 0
 
 
@@ -22,12 +22,14 @@
 import logging
 import optparse
 import sys
+import time
 import uuid
 
 import pyngus
 from utils import connect_socket
+from utils import EventLoop
 from utils import get_host_port
-from utils import process_connection
+from utils import SequenceChecker
 
 LOG = logging.getLogger()
 LOG.addHandler(logging.StreamHandler())
@@ -50,10 +52,19 @@ class ConnectionEventHandler(pyngus.ConnectionEventHandler):
 
 
 class ReceiverEventHandler(pyngus.ReceiverEventHandler):
-    def __init__(self):
+    """Accept and count messages as they arrive, keeping the first.
+
+    If refill is set the credit is topped back up to capacity whenever it
+    drops below half (as receiver.c does), otherwise receiving is done after
+    the first message.
+    """
+    def __init__(self, capacity=1, refill=False):
         self.done = False
         self.message = None
-        self.handle = None
+        self.received = 0
+        self.sequences = SequenceChecker()
+        self._capacity = capacity
+        self._refill = refill
 
     def receiver_remote_closed(self, receiver_link, pn_condition):
         """Peer has closed its end of the link."""
@@ -68,9 +79,17 @@ class ReceiverEventHandler(pyngus.ReceiverEventHandler):
         self.done = True
 
     def message_received(self, receiver, message, handle):
-        self.done = True
-        self.message = message
-        self.handle = handle
+        # accepting from the callback means the dispositions for everything
+        # read in one I/O wakeup are written out together
+        receiver.message_accepted(handle)
+        self.received += 1
+        self.sequences.record(message)
+        if self.message is None:
+            self.message = message
+        if not self._refill:
+            self.done = True
+        elif receiver.capacity < self._capacity / 2:
+            receiver.add_capacity(self._capacity - receiver.capacity)
 
 
 def main(argv=None):
@@ -93,6 +112,11 @@ def main(argv=None):
                       help="enable protocol tracing")
     parser.add_option("-f","--forever", action="store_true",
                       help="don't stop receiving")
+    parser.add_option("--capacity", type="int", default=100,
+                      help="Credit (prefetch) window with --forever [100]")
+    parser.add_option("--interval", type="float", default=1.0,
+                      help="Seconds between rate summaries with --forever"
+                      " [1.0]")
     parser.add_option("--ca",
                       help="Certificate Authority PEM file")
     parser.add_option("--ssl-cert-file",
@@ -113,6 +137,10 @@ def main(argv=None):
                       help="Name of the sasl config file (without '.config')")
 
     opts, extra = parser.parse_args(args=argv)
+    if opts.capacity < 1:
+        parser.error("--capacity must be at least 1")
+    if opts.interval <= 0:
+        parser.error("--interval must be greater than 0")
     if opts.debug:
         LOG.setLevel(logging.DEBUG)
     host, port = get_host_port(opts.server)
@@ -149,47 +177,64 @@ def main(argv=None):
                                              c_handler,
                                              conn_properties)
     connection.open()
+    loop = EventLoop()
+    loop.add(connection, my_socket)
 
     target_address = opts.target_addr or uuid.uuid4().hex
-    cb = ReceiverEventHandler()
+    capacity = opts.capacity if opts.forever else 1
+    cb = ReceiverEventHandler(capacity, refill=opts.forever)
     receiver = connection.create_receiver(target_address,
                                           opts.source_addr,
                                           cb)
-    receiver.add_capacity(1)
+    receiver.add_capacity(capacity)
     receiver.open()
 
-
-    while True:
-
-        # Poll connection until something arrives
-        while not cb.done:
-            process_connection(connection, my_socket)
-            if c_handler.error:
-                break
-            if connection.closed:
-                break
-
-        if cb.done:
-            print("Receive done, message=%s" % str(cb.message) if cb.message
-                  else "ERROR: no message received")
-            if cb.handle:
-                receiver.message_accepted(cb.handle)
-        else:
-            print("Receive failed due to connection failure: %s" %
-                  c_handler.error or "remote closed unexpectedly")
-            break
-
-        if not opts.forever:
-            break
-
-        cb.done = False
-        receiver.add_capacity(1)
+    start = time.time()
+    last = {'time': start, 'received': 0}
+
+    def report():
+        # a summary line per interval rather than a line per message
+        now = time.time()
+        count = cb.received - last['received']
+        print("Received %d msgs in %.3f secs (%.1f msgs/sec), %d total"
+              % (count, now - last['time'], count / (now - last['time']),
+                 cb.received))
+        last.update(time=now, received=cb.received)
+        loop.call_later(opts.interval, report)
+
+    if opts.forever:
+        loop.call_later(opts.interval, report)
+
+    # Poll connection until done (or interrupted when receiving forever)
+    try:
+        while not (cb.done or c_handler.error or connection.closed):
+            loop.process()
+    except KeyboardInterrupt:
+        pass
+
+    if c_handler.error or connection.closed:
+        print("Receive failed due to connection failure: %s" %
+              (c_handler.error or "remote closed unexpectedly"))
+    elif opts.forever:
+        duration = time.time() - start
+        print("Received %d msgs in %.3f secs (%.1f msgs/sec)"
+              % (cb.received, duration, cb.received / duration))
+    else:
+        print("Receive done, message=%s" % str(cb.message) if cb.message
+              else "ERROR: no message received")
+    if cb.sequences.counts()['senders']:
+        print(cb.sequences.report())
+
+    receiver.close()
+    connection.close()
+    loop.wakeup(connection)
 
     # Poll connection until close completes:
     while not c_handler.error and not connection.closed:
-        process_connection(connection, my_socket)
+        loop.process()
 
     receiver.destroy()
+    loop.close()
     connection.destroy()
     container.destroy()
     my_socket.close()
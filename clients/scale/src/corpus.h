@@ -0,0 +1,130 @@
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ *
+ */
+
+/* Read-only access to a message corpus built by clients/corpus.py (see
+ * utils.Corpus).  PATH.dat holds the pre-encoded messages back to back and
+ * PATH.idx is an 8 byte magic, the message count, then count + 1 offsets
+ * into PATH.dat, all little-endian 64 bit.  Both files are memory-mapped so
+ * messages are passed to pn_link_send() straight from the page cache.
+ */
+
+#ifndef CORPUS_H
+#define CORPUS_H
+
+#include <endian.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#define CORPUS_MAGIC "AMQPCRP1"
+
+typedef struct {
+    const char *data;        // mapped PATH.dat
+    size_t data_len;
+    const uint64_t *offsets; // count + 1 entries, little-endian
+    const void *index;       // mapped PATH.idx
+    size_t index_len;
+    uint64_t count;          // # messages
+} corpus_t;
+
+// map a whole file read-only, returns NULL on failure
+static inline const void *corpus_map(const char *path, size_t *len)
+{
+    int fd = open(path, O_RDONLY);
+    if (fd < 0) {
+        perror(path);
+        return NULL;
+    }
+    struct stat st;
+    if (fstat(fd, &st) < 0 || st.st_size == 0) {
+        fprintf(stderr, "%s: cannot map an empty file\n", path);
+        close(fd);
+        return NULL;
+    }
+    void *p = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (p == MAP_FAILED) {
+        perror(path);
+        return NULL;
+    }
+    *len = st.st_size;
+    return p;
+}
+
+static inline void corpus_close(corpus_t *c)
+{
+    if (c->data)
+        munmap((void *)c->data, c->data_len);
+    if (c->index)
+        munmap((void *)c->index, c->index_len);
+    memset(c, 0, sizeof(*c));
+}
+
+// open the corpus at path (without the .dat/.idx suffix), returns 0 on
+// success
+static inline int corpus_open(corpus_t *c, const char *path)
+{
+    char name[4096];
+    memset(c, 0, sizeof(*c));
+
+    snprintf(name, sizeof(name), "%s.idx", path);
+    c->index = corpus_map(name, &c->index_len);
+    if (!c->index)
+        return -1;
+    if (c->index_len < 16 || memcmp(c->index, CORPUS_MAGIC, 8) != 0) {
+        fprintf(stderr, "%s: not a corpus index\n", name);
+        corpus_close(c);
+        return -1;
+    }
+    uint64_t count;
+    memcpy(&count, (const char *)c->index + 8, sizeof(count));
+    c->count = le64toh(count);
+    if (c->count == 0 || c->index_len != 16 + (c->count + 1) * 8) {
+        fprintf(stderr, "%s: bad message count\n", name);
+        corpus_close(c);
+        return -1;
+    }
+    c->offsets = (const uint64_t *)((const char *)c->index + 16);
+
+    snprintf(name, sizeof(name), "%s.dat", path);
+    c->data = corpus_map(name, &c->data_len);
+    if (!c->data || le64toh(c->offsets[c->count]) != c->data_len) {
+        if (c->data)
+            fprintf(stderr, "%s: size does not match the index\n", name);
+        corpus_close(c);
+        return -1;
+    }
+    return 0;
+}
+
+// the encoded message i, its length is returned in *len
+static inline const char *corpus_message(const corpus_t *c, uint64_t i,
+                                         size_t *len)
+{
+    uint64_t start = le64toh(c->offsets[i]);
+    *len = le64toh(c->offsets[i + 1]) - start;
+    return c->data + start;
+}
+
+#endif
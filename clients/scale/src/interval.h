@@ -0,0 +1,217 @@
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ *
+ */
+
+/* Periodic reports of a client's progress: one row per interval with the
+ * message and byte rates, the messages in flight, the link credit and the
+ * latency percentiles of the interval, like utils.IntervalReporter in the
+ * Python clients.  The client keeps its usual running totals and calls
+ * interval_poll() from its main loop, so nothing is added per message.
+ */
+
+#ifndef INTERVAL_H
+#define INTERVAL_H
+
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <sys/time.h>
+
+#include "latency.h"
+
+typedef enum {
+    INTERVAL_TEXT,
+    INTERVAL_CSV,
+    INTERVAL_JSON
+} interval_format_t;
+
+// the running totals and gauges of a client, sampled once per interval
+typedef struct {
+    uint64_t msgs;
+    uint64_t bytes;
+    uint64_t acked;
+    int in_flight;
+    int credit;
+    const latency_hist_t *latency;  // ack latency, NULL if not measured
+} interval_sample_t;
+
+typedef struct {
+    FILE *out;
+    interval_format_t format;
+    const char *prefix;     // "tx" or "rx"
+    uint64_t period;        // usecs, 0 = off
+    uint64_t start;
+    uint64_t last;          // time of the last report
+    uint64_t next;          // time the next report is due
+    int rows;               // rows written, the CSV header goes first
+    interval_sample_t prev; // sampled at the last report
+    latency_hist_t prev_latency;
+    latency_hist_t latency; // latency during the interval
+} interval_t;
+
+// open the report: seconds between reports, the output file (NULL or "-"
+// for stdout) and the format name.  Returns 0 on success
+static inline int interval_open(interval_t *iv, double seconds,
+                                const char *path, const char *format,
+                                const char *prefix)
+{
+    memset(iv, 0, sizeof(*iv));
+    iv->period = (uint64_t)(seconds * 1e6);
+    iv->prefix = prefix;
+    if (!format || !strcmp(format, "text"))
+        iv->format = INTERVAL_TEXT;
+    else if (!strcmp(format, "csv"))
+        iv->format = INTERVAL_CSV;
+    else if (!strcmp(format, "json"))
+        iv->format = INTERVAL_JSON;
+    else {
+        fprintf(stderr, "Unknown interval report format '%s'\n", format);
+        return -1;
+    }
+    iv->out = stdout;
+    if (path && strcmp(path, "-")) {
+        iv->out = fopen(path, "w");
+        if (!iv->out) {
+            perror(path);
+            return -1;
+        }
+    }
+    return 0;
+}
+
+// start the first interval
+static inline void interval_begin(interval_t *iv, const interval_sample_t *s)
+{
+    iv->start = iv->last = now_usecs();
+    iv->next = iv->start + iv->period;
+    iv->prev = *s;
+    if (s->latency)
+        iv->prev_latency = *s->latency;
+}
+
+// wall clock time, for the time column
+static inline double interval_wall_time(void)
+{
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1e6;
+}
+
+// write the row for the interval ending now
+static inline void interval_report(interval_t *iv, const interval_sample_t *s,
+                                   uint64_t now)
+{
+    double elapsed = (now - iv->last) / 1e6;
+    double msgs = elapsed > 0 ? (s->msgs - iv->prev.msgs) / elapsed : 0.0;
+    double bytes = elapsed > 0 ? (s->bytes - iv->prev.bytes) / elapsed : 0.0;
+    double acked = elapsed > 0 ? (s->acked - iv->prev.acked) / elapsed : 0.0;
+    const char *p = iv->prefix;
+    FILE *out = iv->out;
+
+    if (s->latency) {
+        hist_since(&iv->latency, s->latency, &iv->prev_latency);
+        iv->prev_latency = *s->latency;
+    }
+    const latency_hist_t *lat = &iv->latency;
+    double p50 = hist_percentile(lat, 50.0) / 1e6;
+    double p90 = hist_percentile(lat, 90.0) / 1e6;
+    double p99 = hist_percentile(lat, 99.0) / 1e6;
+    double max = lat->max / 1e6;
+    double total = (now - iv->start) / 1e6;
+
+    switch (iv->format) {
+    case INTERVAL_CSV:
+        if (!iv->rows) {
+            fprintf(out, "time,elapsed,%s_msgs_per_sec,%s_bytes_per_sec", p, p);
+            if (s->latency)
+                fprintf(out, ",acked_msgs_per_sec");
+            fprintf(out, ",in_flight,credit");
+            if (s->latency)
+                fprintf(out, ",ack_latency_samples,ack_latency_p50"
+                        ",ack_latency_p90,ack_latency_p99,ack_latency_max");
+            fprintf(out, "\n");
+        }
+        fprintf(out, "%f,%f,%f,%f", interval_wall_time(), total, msgs, bytes);
+        if (s->latency)
+            fprintf(out, ",%f", acked);
+        fprintf(out, ",%d,%d", s->in_flight, s->credit);
+        if (s->latency)
+            fprintf(out, ",%llu,%f,%f,%f,%f",
+                    (unsigned long long)lat->count, p50, p90, p99, max);
+        fprintf(out, "\n");
+        break;
+    case INTERVAL_JSON:
+        fprintf(out, "{\"time\": %f, \"elapsed\": %f, \"%s_msgs_per_sec\": %f,"
+                " \"%s_bytes_per_sec\": %f",
+                interval_wall_time(), total, p, msgs, p, bytes);
+        if (s->latency)
+            fprintf(out, ", \"acked_msgs_per_sec\": %f", acked);
+        fprintf(out, ", \"in_flight\": %d, \"credit\": %d",
+                s->in_flight, s->credit);
+        if (s->latency)
+            fprintf(out, ", \"ack_latency_samples\": %llu,"
+                    " \"ack_latency_p50\": %f, \"ack_latency_p90\": %f,"
+                    " \"ack_latency_p99\": %f, \"ack_latency_max\": %f",
+                    (unsigned long long)lat->count, p50, p90, p99, max);
+        fprintf(out, "}\n");
+        break;
+    default:
+        fprintf(out, "elapsed=%g %s_msgs_per_sec=%g %s_bytes_per_sec=%g",
+                total, p, msgs, p, bytes);
+        if (s->latency)
+            fprintf(out, " acked_msgs_per_sec=%g", acked);
+        fprintf(out, " in_flight=%d credit=%d", s->in_flight, s->credit);
+        if (s->latency)
+            fprintf(out, " ack_latency_samples=%llu ack_latency_p50=%g"
+                    " ack_latency_p90=%g ack_latency_p99=%g"
+                    " ack_latency_max=%g",
+                    (unsigned long long)lat->count, p50, p90, p99, max);
+        fprintf(out, "\n");
+        break;
+    }
+    fflush(out);
+    iv->rows++;
+    iv->prev = *s;
+    iv->last = now;
+}
+
+// report if an interval has ended.  Returns the msecs until the next report
+// is due, to bound the time the caller waits for events
+static inline int interval_poll(interval_t *iv, const interval_sample_t *s)
+{
+    uint64_t now = now_usecs();
+    if (now >= iv->next) {
+        interval_report(iv, s, now);
+        while (iv->next <= now)  // skip any intervals missed
+            iv->next += iv->period;
+    }
+    return (int)((iv->next - now + 999) / 1000);
+}
+
+// report the final (partial) interval
+static inline void interval_close(interval_t *iv, const interval_sample_t *s)
+{
+    uint64_t now = now_usecs();
+    if (now > iv->last)
+        interval_report(iv, s, now);
+    if (iv->out != stdout)
+        fclose(iv->out);
+}
+
+#endif
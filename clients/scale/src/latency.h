@@ -0,0 +1,154 @@
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ *
+ */
+
+/* A log-bucketed latency histogram with a fixed size array of counters, the
+ * same layout as utils.LatencyHistogram in the Python clients.  Samples are
+ * in microseconds: values below 2^HIST_SUB_BITS are counted exactly, larger
+ * values are grouped into 2^(HIST_SUB_BITS-1) linear buckets per power of
+ * two.
+ */
+
+#ifndef LATENCY_H
+#define LATENCY_H
+
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+#include <time.h>
+
+#define HIST_SUB_BITS 7
+#define HIST_HALF     (1 << (HIST_SUB_BITS - 1))
+#define HIST_MAX_BITS 36   // ~19 hours in usecs
+#define HIST_BUCKETS  ((HIST_MAX_BITS - HIST_SUB_BITS + 1) * HIST_HALF + HIST_HALF)
+
+typedef struct {
+    uint64_t counts[HIST_BUCKETS];
+    uint64_t count;
+    uint64_t total;    // usecs
+    uint64_t max;      // usecs
+} latency_hist_t;
+
+static inline int hist_bits(uint64_t value)
+{
+    return value ? 64 - __builtin_clzll(value) : 0;
+}
+
+static inline int hist_index(uint64_t usecs)
+{
+    int shift = hist_bits(usecs) - HIST_SUB_BITS;
+    if (shift <= 0)
+        return (int)usecs;
+    int index = shift * HIST_HALF + (int)(usecs >> shift);
+    return index < HIST_BUCKETS ? index : HIST_BUCKETS - 1;
+}
+
+// highest value counted by the bucket at index
+static inline uint64_t hist_high(int index)
+{
+    if (index < 2 * HIST_HALF)
+        return index;
+    int shift = index / HIST_HALF - 1;
+    uint64_t low = (uint64_t)(index - shift * HIST_HALF) << shift;
+    return low + (1ULL << shift) - 1;
+}
+
+static inline void hist_clear(latency_hist_t *hist)
+{
+    memset(hist, 0, sizeof(*hist));
+}
+
+static inline void hist_record(latency_hist_t *hist, uint64_t usecs)
+{
+    hist->counts[hist_index(usecs)]++;
+    hist->count++;
+    hist->total += usecs;
+    if (usecs > hist->max)
+        hist->max = usecs;
+}
+
+static inline void hist_merge(latency_hist_t *hist, const latency_hist_t *other)
+{
+    for (int i = 0; i < HIST_BUCKETS; ++i)
+        hist->counts[i] += other->counts[i];
+    hist->count += other->count;
+    hist->total += other->total;
+    if (other->max > hist->max)
+        hist->max = other->max;
+}
+
+// the samples recorded in hist since earlier (a copy of hist) into out; the
+// max is only as exact as the buckets
+static inline void hist_since(latency_hist_t *out, const latency_hist_t *hist,
+                              const latency_hist_t *earlier)
+{
+    out->max = 0;
+    for (int i = 0; i < HIST_BUCKETS; ++i) {
+        out->counts[i] = hist->counts[i] - earlier->counts[i];
+        if (out->counts[i])
+            out->max = hist_high(i);
+    }
+    if (out->max > hist->max)
+        out->max = hist->max;
+    out->count = hist->count - earlier->count;
+    out->total = hist->total - earlier->total;
+}
+
+// value (usecs) at or below which pct percent of the samples fall
+static inline uint64_t hist_percentile(const latency_hist_t *hist, double pct)
+{
+    if (!hist->count)
+        return 0;
+    uint64_t target = (uint64_t)(hist->count * pct / 100.0 + 0.999999);
+    if (target == 0)
+        target = 1;
+    uint64_t seen = 0;
+    for (int i = 0; i < HIST_BUCKETS; ++i) {
+        seen += hist->counts[i];
+        if (seen >= target) {
+            uint64_t high = hist_high(i);
+            return high < hist->max ? high : hist->max;
+        }
+    }
+    return hist->max;
+}
+
+// print the percentiles in seconds, like the Python clients
+static inline void hist_print(FILE *out, const char *title,
+                              const latency_hist_t *hist)
+{
+    fprintf(out, " %s (%llu samples): mean %f p50 %f p90 %f p99 %f p99.9 %f max %f\n",
+            title, (unsigned long long)hist->count,
+            hist->count ? hist->total / 1e6 / hist->count : 0.0,
+            hist_percentile(hist, 50.0) / 1e6,
+            hist_percentile(hist, 90.0) / 1e6,
+            hist_percentile(hist, 99.0) / 1e6,
+            hist_percentile(hist, 99.9) / 1e6,
+            hist->max / 1e6);
+}
+
+// monotonic clock in microseconds
+static inline uint64_t now_usecs(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000 + ts.tv_nsec / 1000;
+}
+
+#endif
@@ -23,6 +23,9 @@
 #include <string.h>
 #include <unistd.h>
 #include <time.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdint.h>
 
 
 #include "proton/reactor.h"
@@ -34,34 +37,64 @@
 #include "proton/event.h"
 #include "proton/handlers.h"
 
+#include "corpus.h"
+
+// Counters for the connections of one thread, on a cache line of their own
+// so threads never share (and bounce) a line.  Only the owning thread writes
+// them, so they are updated with plain relaxed loads and stores rather than
+// locked instructions; the reporter thread samples them.
+//
+typedef struct {
+    _Atomic uint64_t sent;      // messages sent
+    _Atomic uint64_t accepted;  // deliveries accepted by the peer
+    _Atomic uint64_t failed;    // deliveries rejected, released or modified
+} __attribute__((aligned(64))) counters_t;
+
+static inline void counter_add(_Atomic uint64_t *counter, uint64_t n)
+{
+    uint64_t value = atomic_load_explicit(counter, memory_order_relaxed);
+    atomic_store_explicit(counter, value + n, memory_order_relaxed);
+}
+
 // Example application data.  This data will be instantiated in the event
 // handler, and is available during event processing.  In this example it
-// holds configuration and state information.
+// holds configuration and state information.  There is one instance per
+// connection.
 //
 typedef struct {
-    int count;          // # messages to send
+    int count;          // # messages to send on this connection
     int anon;           // use anonymous link if true
     int presettle;      // send all pre settled
-    int sent;           // # messages sent
+    int links;          // # sending links on this connection
+    int sent;           // # messages sent, also the last delivery tag
+    int acked;          // # messages acked (or not) by the peer
+    int closing;        // the connection has been closed
     char *target;       // name of destination target
-    char *msg_data;     // pre-encoded outbound message
+    char *msg_data;     // pre-encoded outbound message, shared
     int msg_len;        // bytes in msg_data
+    corpus_t corpus;    // if corpus.count, send these messages in turn
+    counters_t *counters;  // of the thread running this connection
 } app_data_t;
 
+// A sending thread: its own reactor driving several connections
+//
+typedef struct {
+    counters_t counters;
+    pthread_t thread;
+    int index;
+} worker_t;
+
 // helper to pull pointer to app_data_t instance out of the pn_handler_t
 //
 #define GET_APP_DATA(handler) ((app_data_t *)pn_handler_mem(handler))
 
-// Called when reactor exits to clean up app_data
-//
-static void delete_handler(pn_handler_t *handler)
-{
-    app_data_t *d = GET_APP_DATA(handler);
-    if (d->msg_data) {
-        free(d->msg_data);
-        d->msg_data = NULL;
-    }
-}
+// settings shared by all threads, read only once the threads start
+static app_data_t defaults;
+static char *address = "localhost:5672";
+static char *container = "SendExample";
+static int threads = 1;
+static int connections = 1;  // per thread
+static atomic_int running;
 
 /* Process each event posted by the reactor.
  */
@@ -80,34 +113,47 @@ static void event_handler(pn_handler_t *handler,
         pn_connection_open(conn);
         pn_session_t *ssn = pn_session(conn);
         pn_session_open(ssn);
-        pn_link_t *sender = pn_sender(ssn, "MySender");
-        pn_link_set_snd_settle_mode(sender, (data->presettle) ? PN_SND_SETTLED : PN_SND_UNSETTLED);
-        if (!data->anon) {
-            pn_terminus_set_address(pn_link_target(sender), data->target);
+        for (int i = 0; i < data->links; ++i) {
+            char name[32];
+            snprintf(name, sizeof(name), "MySender-%d", i);
+            pn_link_t *sender = pn_sender(ssn, name);
+            pn_link_set_snd_settle_mode(sender, (data->presettle) ? PN_SND_SETTLED : PN_SND_UNSETTLED);
+            if (!data->anon) {
+                pn_terminus_set_address(pn_link_target(sender), data->target);
+            }
+            pn_link_open(sender);
         }
-        pn_link_open(sender);
     } break;
 
     case PN_LINK_FLOW: {
         // the remote has given us some credit, now we can send messages
         //
-        static long tag = 0;  // a simple tag generator
         pn_link_t *sender = pn_event_link(event);
         int credit = pn_link_credit(sender);
+        int sent = 0;
         while (credit > 0 && (data->count == 0 ||
                               data->sent < data->count)) {
             --credit;
-            ++data->sent;
-            ++tag;
+            ++sent;
+            long tag = ++data->sent;
             pn_delivery_t *delivery;
             delivery = pn_delivery(sender,
                                    pn_dtag((const char *)&tag, sizeof(tag)));
-            pn_link_send(sender, data->msg_data, data->msg_len);
+            if (data->corpus.count) {
+                size_t len;
+                const char *msg = corpus_message(&data->corpus,
+                                                 (tag - 1) % data->corpus.count,
+                                                 &len);
+                pn_link_send(sender, msg, len);
+            } else {
+                pn_link_send(sender, data->msg_data, data->msg_len);
+            }
             pn_link_advance(sender);
             if (data->presettle) {
                 pn_delivery_settle(delivery);
             }
         }
+        counter_add(&data->counters->sent, sent);
     } break;
 
     case PN_DELIVERY: {
@@ -121,11 +167,15 @@ static void event_handler(pn_handler_t *handler,
                 break;
             case PN_ACCEPTED:
                 pn_delivery_settle(dlv);
+                ++data->acked;
+                counter_add(&data->counters->accepted, 1);
                 break;
             case PN_REJECTED:
             case PN_RELEASED:
             case PN_MODIFIED:
                 pn_delivery_settle(dlv);
+                ++data->acked;
+                counter_add(&data->counters->failed, 1);
                 fprintf(stderr, "Message not accepted - code:0x%lX\n", (unsigned long)rs);
                 break;
             default:
@@ -133,13 +183,13 @@ static void event_handler(pn_handler_t *handler,
                 break;
             }
 
-            if (data->count == data->sent) {
-                // initiate clean shutdown of the endpoints
+            if (data->count && data->acked == data->count && !data->closing) {
+                // everything sent has been acked, initiate clean shutdown
+                // of the endpoints
                 pn_link_t *link = pn_delivery_link(dlv);
-                pn_link_close(link);
                 pn_session_t *ssn = pn_link_session(link);
-                pn_session_close(ssn);
                 pn_connection_close(pn_session_connection(ssn));
+                data->closing = 1;
             }
         }
     } break;
@@ -149,51 +199,148 @@ static void event_handler(pn_handler_t *handler,
     }
 }
 
+// Run one reactor with this thread's connections until they all close
+//
+static void *worker_main(void *arg)
+{
+    worker_t *worker = (worker_t *)arg;
+    app_data_t **conn_data = calloc(connections, sizeof(app_data_t *));
+    pn_connection_t **conns = calloc(connections, sizeof(pn_connection_t *));
+    pn_reactor_t *reactor = pn_reactor();
+
+    for (int i = 0; i < connections; ++i) {
+        /* Create a handler for the connection's events.  event_handler()
+         * will be called for each event.  The handler will allocate an
+         * app_data_t instance which can be accessed when the event_handler
+         * is called.
+         */
+        pn_handler_t *handler = pn_handler_new(event_handler,
+                                               sizeof(app_data_t),
+                                               NULL);
+        app_data_t *data = GET_APP_DATA(handler);
+        memcpy(data, &defaults, sizeof(app_data_t));
+        data->counters = &worker->counters;
+        conn_data[i] = data;
+
+        /* Attach the pn_handshaker() handler.  This handler deals with
+         * endpoint events from the peer so we don't have to.
+         */
+        pn_handler_add(handler, pn_handshaker());
+
+        pn_connection_t *conn = pn_reactor_connection(reactor, handler);
+        conns[i] = conn;
+
+        // the container name should be unique for each client
+        if (threads * connections > 1) {
+            char name[256];
+            snprintf(name, sizeof(name), "%s-%d-%d",
+                     container, worker->index, i);
+            pn_connection_set_container(conn, name);
+        } else {
+            pn_connection_set_container(conn, container);
+        }
+        pn_connection_set_hostname(conn, address);  // FIXME
+    }
+
+    pn_reactor_set_timeout(reactor, 1000);
+    pn_reactor_start(reactor);
+
+    while (pn_reactor_process(reactor)) {
+        /* Returns 'true' until the connections are shut down */
+        for (int i = 0; i < connections; ++i) {
+            app_data_t *data = conn_data[i];
+            if (data->presettle && data->count && !data->closing
+                && data->sent == data->count) {
+                // sent everything pre-settled and no disposition updates
+                // expected, so close the connection
+                pn_connection_close(conns[i]);
+                data->closing = 1;
+            }
+        }
+    }
+    pn_reactor_free(reactor);
+    free(conns);
+    free(conn_data);
+    return NULL;
+}
+
+static void sum_counters(const worker_t *workers, uint64_t *sent,
+                         uint64_t *accepted, uint64_t *failed)
+{
+    *sent = *accepted = *failed = 0;
+    for (int i = 0; i < threads; ++i) {
+        const counters_t *c = &workers[i].counters;
+        *sent += atomic_load_explicit(&c->sent, memory_order_relaxed);
+        *accepted += atomic_load_explicit(&c->accepted, memory_order_relaxed);
+        *failed += atomic_load_explicit(&c->failed, memory_order_relaxed);
+    }
+}
+
+// Print the rates summed over all threads once a second
+//
+static void *reporter_main(void *arg)
+{
+    const worker_t *workers = (const worker_t *)arg;
+    uint64_t last_sent = 0, last_accepted = 0;
+    struct timespec next;
+
+    clock_gettime(CLOCK_MONOTONIC, &next);
+    for (;;) {
+        next.tv_sec += 1;
+        while (clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &next, NULL))
+            ;
+        if (!atomic_load(&running))
+            break;
+        uint64_t sent, accepted, failed;
+        sum_counters(workers, &sent, &accepted, &failed);
+        printf("sent %llu msgs/sec accepted %llu msgs/sec"
+               " (total sent %llu accepted %llu failed %llu)\n",
+               (unsigned long long)(sent - last_sent),
+               (unsigned long long)(accepted - last_accepted),
+               (unsigned long long)sent, (unsigned long long)accepted,
+               (unsigned long long)failed);
+        fflush(stdout);
+        last_sent = sent;
+        last_accepted = accepted;
+    }
+    return NULL;
+}
+
 static void usage(void)
 {
   printf("Usage: punisher <options> <message>\n");
   printf("-a      \tThe host address [localhost:5672]\n");
-  printf("-c      \t# of messages to send, 0=forever [1] \n");
+  printf("-c      \t# of messages to send per connection, 0=forever [1] \n");
   printf("-t      \tTarget address [examples]\n");
   printf("-i      \tContainer name [SendExample]\n");
   printf("-u      \tSend all messages pre-settled [off]\n");
   printf("-n      \tUse anonymous link [off]\n");
+  printf("-R      \tSend the messages of this corpus (see corpus.py) in turn instead of <message>\n");
+  printf("-T      \t# of sending threads, each with its own reactor [1]\n");
+  printf("-C      \t# of connections per thread [1]\n");
+  printf("-L      \t# of sending links per connection [1]\n");
   printf("message \tA text string to send.\n");
   exit(1);
 }
 
 int main(int argc, char** argv)
 {
-    char *address = "localhost:5672";
     char *msgtext = "Hello World!";
-    char *container = "SendExample";
+    char *corpus = NULL;
     int c;
     struct timespec start;
     struct timespec end;
 
-    /* Create a handler for the connection's events.  event_handler() will be
-     * called for each event and delete_handler will be called when the
-     * connection is released.  The handler will allocate an app_data_t
-     * instance which can be accessed when the event_handler is called.
-     */
-    pn_handler_t *handler = pn_handler_new(event_handler,
-                                           sizeof(app_data_t),
-                                           delete_handler);
-
     /* set up the application data with defaults */
-    app_data_t *app_data = GET_APP_DATA(handler);
+    app_data_t *app_data = &defaults;
     memset(app_data, 0, sizeof(app_data_t));
     app_data->count = 1;
+    app_data->links = 1;
     app_data->target = "examples";
 
-    /* Attach the pn_handshaker() handler.  This handler deals with endpoint
-     * events from the peer so we don't have to.
-     */
-    pn_handler_add(handler, pn_handshaker());
-
     /* command line options */
     opterr = 0;
-    while((c = getopt(argc, argv, "i:a:c:t:nhu")) != -1) {
+    while((c = getopt(argc, argv, "i:a:c:t:nhuR:T:C:L:")) != -1) {
         switch(c) {
         case 'h':
             printf("%s: inflict an unreasonably high message load\n", argv[0]);
@@ -208,6 +355,19 @@ int main(int argc, char** argv)
         case 'n': app_data->anon = 1; break;
         case 'i': container = optarg; break;
         case 'u': app_data->presettle = 1; break;
+        case 'R': corpus = optarg; break;
+        case 'T':
+            threads = atoi(optarg);
+            if (threads < 1) usage();
+            break;
+        case 'C':
+            connections = atoi(optarg);
+            if (connections < 1) usage();
+            break;
+        case 'L':
+            app_data->links = atoi(optarg);
+            if (app_data->links < 1) usage();
+            break;
         default:
             usage();
             break;
@@ -216,64 +376,84 @@ int main(int argc, char** argv)
     if (optind < argc) msgtext = argv[optind];
 
 
-    // create a single message and pre-encode it so we only have to do that
-    // once.  All transmits will use the same pre-encoded message simply for
-    // speed.
-    //
-    pn_message_t *message = pn_message();
-    pn_message_set_address(message, app_data->target);
-    pn_data_t *body = pn_message_body(message);
-    pn_data_clear(body);
-
-    // This message's body contains a single string
-    if (pn_data_fill(body, "S", msgtext)) {
-        fprintf(stderr, "Error building message!\n");
-        exit(1);
-    }
-    pn_data_rewind(body);
-    {
-        // encode the message, expanding the encode buffer as needed
+    if (corpus) {
+        if (corpus_open(&app_data->corpus, corpus))
+            exit(1);
+    } else {
+        // create a single message and pre-encode it so we only have to do that
+        // once.  All transmits will use the same pre-encoded message simply for
+        // speed.
         //
-        size_t len = 128;
-        char *buf = (char *)malloc(len);
-        int rc = 0;
-        do {
-            rc = pn_message_encode(message, buf, &len);
-            if (rc == PN_OVERFLOW) {
-                free(buf);
-                len *= 2;
-                buf = malloc(len);
-            }
-        } while (rc == PN_OVERFLOW);
-        app_data->msg_len = len;
-        app_data->msg_data = buf;
-    }
-    pn_decref(message);   // message no longer needed
+        pn_message_t *message = pn_message();
+        pn_message_set_address(message, app_data->target);
+        pn_data_t *body = pn_message_body(message);
+        pn_data_clear(body);
 
-    pn_reactor_t *reactor = pn_reactor();
-    pn_connection_t *conn = pn_reactor_connection(reactor, handler);
-
-    // the container name should be unique for each client
-    pn_connection_set_container(conn, container);
-    pn_connection_set_hostname(conn, address);  // FIXME
+        // This message's body contains a single string
+        if (pn_data_fill(body, "S", msgtext)) {
+            fprintf(stderr, "Error building message!\n");
+            exit(1);
+        }
+        pn_data_rewind(body);
+        {
+            // encode the message, expanding the encode buffer as needed
+            //
+            size_t len = 128;
+            char *buf = (char *)malloc(len);
+            int rc = 0;
+            do {
+                rc = pn_message_encode(message, buf, &len);
+                if (rc == PN_OVERFLOW) {
+                    free(buf);
+                    len *= 2;
+                    buf = malloc(len);
+                }
+            } while (rc == PN_OVERFLOW);
+            app_data->msg_len = len;
+            app_data->msg_data = buf;
+        }
+        pn_decref(message);   // message no longer needed
+    }
 
-    pn_reactor_set_timeout(reactor, 1000);
-    pn_reactor_start(reactor);
-    clock_gettime(CLOCK_REALTIME, &start);
+    // cache line aligned, see counters_t
+    worker_t *workers;
+    if (posix_memalign((void **)&workers, 64, threads * sizeof(worker_t))) {
+        fprintf(stderr, "Out of memory!\n");
+        exit(1);
+    }
+    memset(workers, 0, threads * sizeof(worker_t));
+    atomic_store(&running, 1);
+    clock_gettime(CLOCK_MONOTONIC, &start);
 
-    while (pn_reactor_process(reactor)) {
-        /* Returns 'true' until the connection is shut down */
-        if (app_data->presettle && app_data->sent == app_data->count) {
-            // sent everything pre-settled and no disposition updates expected,
-            // so close the connection
-            pn_connection_close(conn);
+    for (int i = 0; i < threads; ++i) {
+        workers[i].index = i;
+        if (pthread_create(&workers[i].thread, NULL, worker_main, &workers[i])) {
+            perror("pthread_create");
+            exit(1);
         }
     }
-    clock_gettime(CLOCK_REALTIME, &end);
+    pthread_t reporter;
+    if (pthread_create(&reporter, NULL, reporter_main, workers)) {
+        perror("pthread_create");
+        exit(1);
+    }
+    for (int i = 0; i < threads; ++i)
+        pthread_join(workers[i].thread, NULL);
+    clock_gettime(CLOCK_MONOTONIC, &end);
+    atomic_store(&running, 0);
+    pthread_join(reporter, NULL);
+
+    uint64_t sent, accepted, failed;
+    sum_counters(workers, &sent, &accepted, &failed);
+    double diff = (end.tv_sec - start.tv_sec)
+        + (end.tv_nsec - start.tv_nsec) / 1e9;
+    printf("Thruput %.0f (%llu messages in %f seconds, %d threads x %d connections x %d links)\n",
+           (diff > 0) ? sent / diff : (double)sent,
+           (unsigned long long)sent, diff,
+           threads, connections, app_data->links);
 
-    long diff = end.tv_sec - start.tv_sec;
-    printf("Thruput %ld (%d messages in %ld seconds)\n",
-           (diff > 0) ? app_data->count / diff : app_data->count,
-           app_data->count, diff);
+    free(workers);
+    free(app_data->msg_data);
+    corpus_close(&app_data->corpus);
     return 0;
 }
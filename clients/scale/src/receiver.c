@@ -33,6 +33,9 @@
 #include "proton/event.h"
 #include "proton/handlers.h"
 
+#include "interval.h"
+#include "sequence.h"
+
 static int quiet = 0;
 
 #define MAX_SIZE 512
@@ -46,6 +49,14 @@ typedef struct {
     int credit;         // max credit window
     char *source;       // name of the source node to receive from
     pn_message_t *message;      // holds the received message
+    int check_sequence;         // track the senders' sequence numbers
+    seq_checker_t sequences;
+    char *buffer;               // holds the encoded message
+    size_t buffer_size;
+    uint64_t received;          // messages received so far
+    uint64_t bytes;             // bytes received so far
+    pn_link_t *receiver;        // the receiving link, for interval reports
+    int closing;                // shutdown has started, the link may be freed
 } app_data_t;
 
 // helper to pull pointer to app_data_t instance out of the pn_handler_t
@@ -61,6 +72,30 @@ static void delete_handler(pn_handler_t *handler)
         pn_decref(d->message);
         d->message = NULL;
     }
+    free(d->buffer);
+    d->buffer = NULL;
+    seq_checker_free(&d->sequences);
+}
+
+// read the delivery's message into data->message
+//
+static bool decode_message(app_data_t *data, pn_delivery_t *dlv)
+{
+    size_t pending = pn_delivery_pending(dlv);
+    if (pending > data->buffer_size) {
+        free(data->buffer);
+        data->buffer_size = pending * 2;
+        data->buffer = malloc(data->buffer_size);
+        if (!data->buffer) {
+            data->buffer_size = 0;
+            return false;
+        }
+    }
+    ssize_t len = pn_link_recv(pn_delivery_link(dlv), data->buffer, pending);
+    if (len < 0)
+        return false;
+    pn_message_clear(data->message);
+    return pn_message_decode(data->message, data->buffer, len) == PN_OK;
 }
 
 
@@ -86,6 +121,12 @@ static void event_handler(pn_handler_t *handler,
         pn_link_open(receiver);
         // cannot receive without granting credit:
         pn_link_flow(receiver, data->credit);
+        data->receiver = receiver;
+    } break;
+
+    case PN_CONNECTION_REMOTE_CLOSE: {
+        // the handshaker closes our end, the link will be freed
+        data->closing = 1;
     } break;
 
     case PN_DELIVERY: {
@@ -94,15 +135,31 @@ static void event_handler(pn_handler_t *handler,
         pn_delivery_t *dlv = pn_event_delivery(event);
         if (pn_delivery_readable(dlv) && !pn_delivery_partial(dlv)) {
             // A full message has arrived
-            if (!quiet && pn_delivery_pending(dlv) < MAX_SIZE) {
+            data->received++;
+            data->bytes += pn_delivery_pending(dlv);
+            bool show = !quiet && pn_delivery_pending(dlv) < MAX_SIZE;
+            bool decoded = false;
+            if (show || data->check_sequence) {
+                // decode the raw data into the message instance
+                decoded = decode_message(data, dlv);
+            }
+            if (decoded && data->check_sequence) {
+                // the message-id is the sender's sequence number, and the
+                // group-id identifies the sender
+                pn_atom_t id = pn_message_get_id(data->message);
+                const char *sender = pn_message_get_group_id(data->message);
+                if (id.type == PN_ULONG) {
+                    seq_checker_record(&data->sequences,
+                                       sender ? sender : "",
+                                       sender ? strlen(sender) : 0,
+                                       id.u.as_ulong);
+                }
+            }
+            if (show) {
                 // try to decode the message body
                 pn_bytes_t bytes;
                 bool found = false;
-                static char buffer[MAX_SIZE];
-                size_t len = pn_link_recv(pn_delivery_link(dlv), buffer, MAX_SIZE);
-                pn_message_clear(data->message);
-                // decode the raw data into the message instance
-                if (pn_message_decode(data->message, buffer, len) == PN_OK) {
+                if (decoded) {
                     // Assuming the message came from the sender example, try
                     // to parse out a single string from the payload
                     //
@@ -138,6 +195,7 @@ static void event_handler(pn_handler_t *handler,
 
             if (data->count && --data->count == 0) {
                 // done receiving, close the endpoints
+                data->closing = 1;
                 pn_link_close(link);
                 pn_session_t *ssn = pn_link_session(link);
                 pn_session_close(ssn);
@@ -160,6 +218,10 @@ static void usage(void)
   printf("-i      \tContainer name [ReceiveExample]\n");
   printf("-q      \tQuiet - turn off stdout\n");
   printf("-f      \tCredit window [100]\n");
+  printf("-S      \tCheck the message sequence numbers of each sender [off]\n");
+  printf("-I      \tReport the rates, queued messages and credit every N seconds [off]\n");
+  printf("-o      \tWrite the interval reports to this file [stdout]\n");
+  printf("-F      \tInterval report format: text, csv or json [text]\n");
   exit(1);
 }
 
@@ -167,6 +229,9 @@ int main(int argc, char** argv)
 {
     char *address = "localhost";
     char *container = "ReceiveExample";
+    double interval_secs = 0;
+    char *interval_out = NULL;
+    char *interval_format = "text";
 
     /* create a handler for the connection's events.
      * event_handler will be called for each event.  The handler will allocate
@@ -193,7 +258,7 @@ int main(int argc, char** argv)
     /* command line options */
     opterr = 0;
     int c;
-    while((c = getopt(argc, argv, "i:a:c:s:qhf:")) != -1) {
+    while((c = getopt(argc, argv, "i:a:c:s:qhf:SI:o:F:")) != -1) {
         switch(c) {
         case 'h': usage(); break;
         case 'a': address = optarg; break;
@@ -204,6 +269,13 @@ int main(int argc, char** argv)
         case 's': app_data->source = optarg; break;
         case 'i': container = optarg; break;
         case 'q': quiet = 1; break;
+        case 'S': app_data->check_sequence = 1; break;
+        case 'I':
+            interval_secs = atof(optarg);
+            if (interval_secs <= 0) usage();
+            break;
+        case 'o': interval_out = optarg; break;
+        case 'F': interval_format = optarg; break;
         case 'f':
             app_data->credit = atoi(optarg);
             if (app_data->credit <= 0) usage();
@@ -225,6 +297,17 @@ int main(int argc, char** argv)
     // pn_reactor_process()
     pn_reactor_set_timeout(reactor, 5000);
 
+    // in_flight is the number of messages received but not yet processed
+    static interval_t interval;
+    interval_sample_t sample;
+    memset(&sample, 0, sizeof(sample));
+    if (interval_secs > 0) {
+        if (interval_open(&interval, interval_secs, interval_out,
+                          interval_format, "rx"))
+            exit(1);
+        interval_begin(&interval, &sample);
+    }
+
     pn_reactor_start(reactor);
 
     while (pn_reactor_process(reactor)) {
@@ -235,7 +318,28 @@ int main(int argc, char** argv)
          * pending I/O and events. Once the connection has closed,
          * pn_reactor_process() will return false.
          */
+        if (interval.period) {
+            sample.msgs = app_data->received;
+            sample.bytes = app_data->bytes;
+            if (app_data->receiver && !app_data->closing) {
+                sample.in_flight = pn_link_queued(app_data->receiver);
+                sample.credit = pn_link_credit(app_data->receiver);
+            } else {
+                sample.in_flight = sample.credit = 0;
+            }
+            // wake up in time for the next report
+            pn_reactor_set_timeout(reactor, interval_poll(&interval, &sample));
+        }
     }
+    if (interval.period) {
+        sample.msgs = app_data->received;
+        sample.bytes = app_data->bytes;
+        sample.in_flight = sample.credit = 0;
+        interval_close(&interval, &sample);
+    }
+
+    if (app_data->check_sequence)
+        seq_checker_print(stdout, &app_data->sequences);
 
     return 0;
 }
@@ -33,6 +33,10 @@
 #include "proton/event.h"
 #include "proton/handlers.h"
 
+#include "corpus.h"
+#include "interval.h"
+#include "latency.h"
+
 static int quiet = 0;
 
 // Example application data.  This data will be instantiated in the event
@@ -47,6 +51,17 @@ typedef struct {
     char *target;       // name of destination target
     char *msg_data;     // pre-encoded outbound message
     int msg_len;        // bytes in msg_data
+    int seq_offset;     // offset of the message-id (sequence) in msg_data
+    corpus_t corpus;    // if corpus.count, send these messages in turn
+    long sent;          // messages sent so far, also the last delivery tag
+    uint64_t bytes;     // bytes sent so far
+    uint64_t settled;   // deliveries settled by the peer so far
+    double rate;        // open loop send rate (msgs/sec), 0 = send on credit
+    uint64_t start;     // usecs, monotonic time the paced run started
+    int timer_pending;  // a pacing timer has been scheduled
+    pn_link_t *sender;  // the sending link, for the pacing timer
+    int closing;        // shutdown has started, the link may be freed
+    latency_hist_t latency;  // ack latency from the intended send time
 } app_data_t;
 
 // helper to pull pointer to app_data_t instance out of the pn_handler_t
@@ -62,6 +77,75 @@ static void delete_handler(pn_handler_t *handler)
         free(d->msg_data);
         d->msg_data = NULL;
     }
+    corpus_close(&d->corpus);
+}
+
+// when message n (starting at 0) should be sent in rate mode
+//
+static uint64_t intended_time(const app_data_t *data, long n)
+{
+    return data->start + (uint64_t)(n * 1000000.0 / data->rate);
+}
+
+// send the next message, the delivery tag is the message's sequence number
+//
+static void send_message(app_data_t *data, pn_link_t *sender)
+{
+    long tag = ++data->sent;
+    --data->count;
+    uint64_t seq = tag - 1;
+    pn_delivery_t *delivery;
+    delivery = pn_delivery(sender, pn_dtag((const char *)&tag, sizeof(tag)));
+    if (data->corpus.count) {
+        // replay the corpus as it is, no sequence numbers
+        size_t len;
+        const char *msg = corpus_message(&data->corpus,
+                                         seq % data->corpus.count, &len);
+        pn_link_send(sender, msg, len);
+        data->bytes += len;
+    } else {
+        // stamp the sequence number (starting at 0) into the message-id
+        for (int i = 7; i >= 0; --i, seq >>= 8)
+            data->msg_data[data->seq_offset + i] = (char)(seq & 0xFF);
+        pn_link_send(sender, data->msg_data, data->msg_len);
+        data->bytes += data->msg_len;
+    }
+    pn_link_advance(sender);
+    if (data->unsettled) {
+        // leave all messages unsettled
+    } else if (data->count > 0) {
+        // send pre-settled until the last one, then wait for an ack on
+        // the last sent message. This allows the sender to send
+        // messages as fast as possible and then exit when the consumer
+        // has dealt with the last one.
+        //
+        pn_delivery_settle(delivery);
+    }
+}
+
+// Rate mode: send every message whose intended time has passed (as far as
+// credit allows) and schedule a timer for the next one.  If credit runs out
+// the schedule is restarted by the next PN_LINK_FLOW, and messages that fell
+// behind are sent immediately - their latency still counts from when they
+// should have been sent.
+//
+static void send_due(pn_handler_t *handler, pn_reactor_t *reactor,
+                     app_data_t *data)
+{
+    pn_link_t *sender = data->sender;
+    uint64_t now = now_usecs();
+    if (!data->start)
+        data->start = now;
+    while (data->count > 0 && pn_link_credit(sender) > 0
+           && intended_time(data, data->sent) <= now) {
+        send_message(data, sender);
+    }
+    data->timer_pending = 0;
+    if (data->count > 0 && pn_link_credit(sender) > 0) {
+        uint64_t delay = intended_time(data, data->sent) - now;
+        data->timer_pending = 1;
+        pn_reactor_schedule(reactor, (int)((delay + 999) / 1000), handler);
+    }
 }
 
 /* Process each event posted by the reactor.
@@ -88,36 +172,36 @@ static void event_handler(pn_handler_t *handler,
             pn_terminus_set_address(pn_link_target(sender), data->target);
         }
         pn_link_open(sender);
+        data->sender = sender;
     } break;
 
     case PN_LINK_FLOW: {
         // the remote has given us some credit, now we can send messages
         //
-        static long tag = 0;  // a simple tag generator
         pn_link_t *sender = pn_event_link(event);
+        if (data->rate > 0) {
+            if (!data->timer_pending)
+                send_due(handler, pn_event_reactor(event), data);
+            break;
+        }
         int credit = pn_link_credit(sender);
         while (credit > 0 && data->count > 0) {
             --credit;
-            --data->count;
-            ++tag;
-            pn_delivery_t *delivery;
-            delivery = pn_delivery(sender,
-                                   pn_dtag((const char *)&tag, sizeof(tag)));
-            pn_link_send(sender, data->msg_data, data->msg_len);
-            pn_link_advance(sender);
-            if (data->unsettled) {
-                // leave all messages unsettled
-            } else if (data->count > 0) {
-                // send pre-settled until the last one, then wait for an ack on
-                // the last sent message. This allows the sender to send
-                // messages as fast as possible and then exit when the consumer
-                // has dealt with the last one.
-                //
-                pn_delivery_settle(delivery);
-            }
+            send_message(data, sender);
         }
     } break;
 
+    case PN_CONNECTION_REMOTE_CLOSE: {
+        // the handshaker closes our end, the link will be freed
+        data->closing = 1;
+    } break;
+
+    case PN_TIMER_TASK: {
+        // time to send the next message(s) in rate mode
+        //
+        send_due(handler, pn_event_reactor(event), data);
+    } break;
+
     case PN_DELIVERY: {
         // Since the example sends all messages but the last pre-settled
         // (pre-acked), only the last message's delivery will get updated with
@@ -126,6 +210,17 @@ static void event_handler(pn_handler_t *handler,
         pn_delivery_t *dlv = pn_event_delivery(event);
         if (pn_delivery_updated(dlv) && pn_delivery_remote_state(dlv)) {
             uint64_t rs = pn_delivery_remote_state(dlv);
+            if (data->rate > 0 && rs != PN_RECEIVED) {
+                // latency is measured from when the message should have been
+                // sent, not when it was, so a stalled sender is not hidden
+                long tag = 0;
+                pn_delivery_tag_t dtag = pn_delivery_tag(dlv);
+                if (dtag.size == sizeof(tag))
+                    memcpy(&tag, dtag.start, sizeof(tag));
+                uint64_t now = now_usecs();
+                uint64_t intended = intended_time(data, tag - 1);
+                hist_record(&data->latency, now > intended ? now - intended : 0);
+            }
             switch (rs) {
             case PN_RECEIVED:
                 // This is not a terminal state - it is informational, and the
@@ -151,8 +246,12 @@ static void event_handler(pn_handler_t *handler,
                 break;
             }
 
+            if (rs != PN_RECEIVED)
+                ++data->settled;
+
             if (data->acked == 0) {
                 // initiate clean shutdown of the endpoints
+                data->closing = 1;
                 pn_link_t *link = pn_delivery_link(dlv);
                 pn_link_close(link);
                 pn_session_t *ssn = pn_link_session(link);
@@ -177,6 +276,11 @@ static void usage(void)
   printf("-i      \tContainer name [SendExample]\n");
   printf("-q      \tQuiet - turn off stdout\n");
   printf("-u      \tSend all messages unsettled\n");
+  printf("-r      \tSend at a fixed rate (msgs/sec) and report ack latency, implies -u [off]\n");
+  printf("-R      \tSend the messages of this corpus (see corpus.py) in turn instead of <message>\n");
+  printf("-I      \tReport the rates, in flight, credit and ack latency every N seconds [off]\n");
+  printf("-o      \tWrite the interval reports to this file [stdout]\n");
+  printf("-F      \tInterval report format: text, csv or json [text]\n");
   printf("message \tA text string to send.\n");
   exit(1);
 }
@@ -186,6 +290,10 @@ int main(int argc, char** argv)
     char *address = "localhost";
     char *msgtext = "Hello World!";
     char *container = "SendExample";
+    char *corpus = NULL;
+    double interval_secs = 0;
+    char *interval_out = NULL;
+    char *interval_format = "text";
     int c;
 
     /* Create a handler for the connection's events.  event_handler() will be
@@ -211,7 +319,7 @@ int main(int argc, char** argv)
 
     /* command line options */
     opterr = 0;
-    while((c = getopt(argc, argv, "i:a:c:t:nhqu")) != -1) {
+    while((c = getopt(argc, argv, "i:a:c:t:nhqur:R:I:o:F:")) != -1) {
         switch(c) {
         case 'h': usage(); break;
         case 'a': address = optarg; break;
@@ -224,6 +332,18 @@ int main(int argc, char** argv)
         case 'i': container = optarg; break;
         case 'q': quiet = 1; break;
         case 'u': app_data->unsettled = 1; break;
+        case 'r':
+            app_data->rate = atof(optarg);
+            if (app_data->rate <= 0) usage();
+            app_data->unsettled = 1;
+            break;
+        case 'R': corpus = optarg; break;
+        case 'I':
+            interval_secs = atof(optarg);
+            if (interval_secs <= 0) usage();
+            break;
+        case 'o': interval_out = optarg; break;
+        case 'F': interval_format = optarg; break;
         default:
             usage();
             break;
@@ -235,40 +355,75 @@ int main(int argc, char** argv)
 
     if (optind < argc) msgtext = argv[optind];
 
+    if (corpus) {
+        if (corpus_open(&app_data->corpus, corpus))
+            exit(1);
+        if (!quiet)
+            fprintf(stdout, "Sending %llu messages from %s\n",
+                    (unsigned long long)app_data->corpus.count, corpus);
+    } else {
+        // create a single message and pre-encode it so we only have to do that
+        // once.  All transmits will use the same pre-encoded message simply for
+        // speed.
+        //
+        pn_message_t *message = pn_message();
+        pn_message_set_address(message, app_data->target);
 
-    // create a single message and pre-encode it so we only have to do that
-    // once.  All transmits will use the same pre-encoded message simply for
-    // speed.
-    //
-    pn_message_t *message = pn_message();
-    pn_message_set_address(message, app_data->target);
-    pn_data_t *body = pn_message_body(message);
-    pn_data_clear(body);
+        // The message-id carries the sequence number, patched into the encoded
+        // message for each send, and the group-id identifies this sender so
+        // receivers can check the sequence (see receiver -S).  Encode a
+        // placeholder id so it can be located in the encoded message.
+        static const char seq_mark[8] = {'S', 'E', 'Q', 'U', 'E', 'N', 'C', 'E'};
+        pn_atom_t id;
+        id.type = PN_ULONG;
+        id.u.as_ulong = 0;
+        for (int i = 0; i < 8; ++i)
+            id.u.as_ulong = (id.u.as_ulong << 8) | (uint8_t)seq_mark[i];
+        pn_message_set_id(message, id);
+        pn_message_set_group_id(message, container);
+        pn_data_t *body = pn_message_body(message);
+        pn_data_clear(body);
 
-    // This message's body contains a single string
-    if (pn_data_fill(body, "S", msgtext)) {
-        fprintf(stderr, "Error building message!\n");
-        exit(1);
-    }
-    pn_data_rewind(body);
-    {
-        // encode the message, expanding the encode buffer as needed
-        //
-        size_t len = 128;
-        char *buf = (char *)malloc(len);
-        int rc = 0;
-        do {
-            rc = pn_message_encode(message, buf, &len);
-            if (rc == PN_OVERFLOW) {
-                free(buf);
-                len *= 2;
-                buf = malloc(len);
+        // This message's body contains a single string
+        if (pn_data_fill(body, "S", msgtext)) {
+            fprintf(stderr, "Error building message!\n");
+            exit(1);
+        }
+        pn_data_rewind(body);
+        {
+            // encode the message, expanding the encode buffer as needed
+            //
+            size_t len = 128;
+            char *buf = (char *)malloc(len);
+            int rc = 0;
+            do {
+                rc = pn_message_encode(message, buf, &len);
+                if (rc == PN_OVERFLOW) {
+                    free(buf);
+                    len *= 2;
+                    buf = malloc(len);
+                }
+            } while (rc == PN_OVERFLOW);
+            app_data->msg_len = len;
+            app_data->msg_data = buf;
+        }
+        {
+            // find the ulong (type code 0x80) placeholder message-id
+            app_data->seq_offset = -1;
+            for (int i = 0; i + 9 <= app_data->msg_len; ++i) {
+                if ((uint8_t)app_data->msg_data[i] == 0x80 &&
+                    memcmp(app_data->msg_data + i + 1, seq_mark, 8) == 0) {
+                    app_data->seq_offset = i + 1;
+                    break;
+                }
+            }
+            if (app_data->seq_offset < 0) {
+                fprintf(stderr, "Cannot locate the message-id in the encoded message!\n");
+                exit(1);
             }
-        } while (rc == PN_OVERFLOW);
-        app_data->msg_len = len;
-        app_data->msg_data = buf;
+        }
+        pn_decref(message);   // message no longer needed
     }
-    pn_decref(message);   // message no longer needed
 
     pn_reactor_t *reactor = pn_reactor();
     pn_connection_t *conn = pn_reactor_connection(reactor, handler);
@@ -281,6 +436,17 @@ int main(int argc, char** argv)
     // pn_reactor_process()
     pn_reactor_set_timeout(reactor, 5000);
 
+    static interval_t interval;
+    interval_sample_t sample;
+    memset(&sample, 0, sizeof(sample));
+    sample.latency = &app_data->latency;
+    if (interval_secs > 0) {
+        if (interval_open(&interval, interval_secs, interval_out,
+                          interval_format, "tx"))
+            exit(1);
+        interval_begin(&interval, &sample);
+    }
+
     pn_reactor_start(reactor);
 
     while (pn_reactor_process(reactor)) {
@@ -291,6 +457,36 @@ int main(int argc, char** argv)
          * pending I/O and events. Once the connection has closed,
          * pn_reactor_process() will return false.
          */
+        if (interval.period) {
+            sample.msgs = app_data->sent;
+            sample.bytes = app_data->bytes;
+            sample.acked = app_data->settled;
+            if (app_data->sender && !app_data->closing) {
+                sample.in_flight = pn_link_unsettled(app_data->sender);
+                sample.credit = pn_link_credit(app_data->sender);
+            } else {
+                sample.in_flight = sample.credit = 0;
+            }
+            // wake up in time for the next report
+            pn_reactor_set_timeout(reactor, interval_poll(&interval, &sample));
+        }
+    }
+    if (interval.period) {
+        sample.msgs = app_data->sent;
+        sample.bytes = app_data->bytes;
+        sample.acked = app_data->settled;
+        sample.in_flight = sample.credit = 0;
+        interval_close(&interval, &sample);
+    }
+
+    if (app_data->rate > 0) {
+        double duration = (now_usecs() - app_data->start) / 1e6;
+        fprintf(stdout, "Sent %ld messages at %f msgs/sec (target %f)\n",
+                app_data->sent,
+                duration > 0 ? app_data->sent / duration : 0.0,
+                app_data->rate);
+        hist_print(stdout, "Ack latency from intended send time",
+                   &app_data->latency);
     }
 
     return 0;
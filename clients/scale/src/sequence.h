@@ -0,0 +1,153 @@
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one
+ * or more contributor license agreements.  See the NOTICE file
+ * distributed with this work for additional information
+ * regarding copyright ownership.  The ASF licenses this file
+ * to you under the Apache License, Version 2.0 (the
+ * "License"); you may not use this file except in compliance
+ * with the License.  You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ *
+ */
+
+/* Check the sequence numbers (message-id) received from each sender
+ * (group-id) for loss, duplication and reordering, like
+ * utils.SequenceChecker in the Python clients.
+ *
+ * Only a sliding window of the most recent SEQ_WINDOW sequence numbers is
+ * remembered per sender, one bit each, so memory is bounded and each check is
+ * O(1).  A number arriving after the window has moved past it is counted as
+ * 'late' (it may be a duplicate), and remains counted as a gap.
+ */
+
+#ifndef SEQUENCE_H
+#define SEQUENCE_H
+
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define SEQ_WINDOW      65536
+#define SEQ_MAX_SENDERS 64
+#define SEQ_MAX_ID      64
+
+typedef struct {
+    uint64_t received;
+    uint64_t gaps;        // skipped and not (yet) received
+    uint64_t duplicates;
+    uint64_t out_of_order;
+    uint64_t late;
+} seq_counts_t;
+
+typedef struct {
+    char id[SEQ_MAX_ID];  // the sender's group-id
+    uint64_t next;        // one past the highest sequence seen
+    seq_counts_t counts;
+    uint8_t bits[SEQ_WINDOW / 8];
+} seq_tracker_t;
+
+typedef struct {
+    int senders;
+    uint64_t untracked;   // messages from senders beyond SEQ_MAX_SENDERS
+    seq_tracker_t *trackers[SEQ_MAX_SENDERS];
+} seq_checker_t;
+
+static inline void seq_tracker_record(seq_tracker_t *t, uint64_t seq)
+{
+    uint64_t index = seq % SEQ_WINDOW;
+    uint8_t mask = 1 << (index & 7);
+    t->counts.received++;
+    if (seq >= t->next) {
+        uint64_t skipped = seq - t->next;
+        if (skipped) {
+            t->counts.gaps += skipped;
+            if (skipped >= SEQ_WINDOW) {
+                memset(t->bits, 0, sizeof(t->bits));
+            } else {
+                // forget whatever these bits held a window ago
+                for (uint64_t s = t->next; s < seq; ++s) {
+                    uint64_t i = s % SEQ_WINDOW;
+                    t->bits[i >> 3] &= ~(1 << (i & 7));
+                }
+            }
+        }
+        t->bits[index >> 3] |= mask;
+        t->next = seq + 1;
+    } else if (t->next > SEQ_WINDOW && seq < t->next - SEQ_WINDOW) {
+        t->counts.late++;
+    } else if (t->bits[index >> 3] & mask) {
+        t->counts.duplicates++;
+    } else {
+        t->bits[index >> 3] |= mask;
+        t->counts.out_of_order++;
+        t->counts.gaps--;
+    }
+}
+
+// check seq from the sender identified by id (size bytes, not terminated)
+static inline void seq_checker_record(seq_checker_t *c, const char *id,
+                                      size_t size, uint64_t seq)
+{
+    if (size >= SEQ_MAX_ID)
+        size = SEQ_MAX_ID - 1;
+    for (int i = 0; i < c->senders; ++i) {
+        seq_tracker_t *t = c->trackers[i];
+        if (strlen(t->id) == size && memcmp(t->id, id, size) == 0) {
+            seq_tracker_record(t, seq);
+            return;
+        }
+    }
+    if (c->senders == SEQ_MAX_SENDERS) {
+        c->untracked++;
+        return;
+    }
+    seq_tracker_t *t = calloc(1, sizeof(seq_tracker_t));
+    if (!t) {
+        c->untracked++;
+        return;
+    }
+    memcpy(t->id, id, size);
+    c->trackers[c->senders++] = t;
+    seq_tracker_record(t, seq);
+}
+
+static inline void seq_checker_print(FILE *out, const seq_checker_t *c)
+{
+    seq_counts_t total;
+    memset(&total, 0, sizeof(total));
+    for (int i = 0; i < c->senders; ++i) {
+        const seq_counts_t *counts = &c->trackers[i]->counts;
+        total.received += counts->received;
+        total.gaps += counts->gaps;
+        total.duplicates += counts->duplicates;
+        total.out_of_order += counts->out_of_order;
+        total.late += counts->late;
+    }
+    fprintf(out, " Sequence: senders %d received %llu gaps %llu duplicates %llu"
+            " out-of-order %llu late %llu untracked %llu\n",
+            c->senders,
+            (unsigned long long)total.received,
+            (unsigned long long)total.gaps,
+            (unsigned long long)total.duplicates,
+            (unsigned long long)total.out_of_order,
+            (unsigned long long)total.late,
+            (unsigned long long)c->untracked);
+}
+
+static inline void seq_checker_free(seq_checker_t *c)
+{
+    for (int i = 0; i < c->senders; ++i)
+        free(c->trackers[i]);
+    c->senders = 0;
+}
+
+#endif
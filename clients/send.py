@@ -19,16 +19,20 @@
 #
 """ Minimal message send example code."""
 
+import collections
 import optparse
 import logging
 import sys
+import time
 import uuid
 
 from proton import Message
+from proton import ulong
 import pyngus
 from utils import connect_socket
+from utils import EventLoop
 from utils import get_host_port
-from utils import process_connection
+from utils import read_records
 from utils import SEND_STATUS
 
 LOG = logging.getLogger()
@@ -62,6 +66,94 @@ class SenderEventHandler(pyngus.SenderEventHandler):
         sender_link.close()
 
 
+class StreamSender(SenderEventHandler):
+    """Send each record from an iterator as the body of a message, keeping
+    up to 'window' unsettled deliveries in flight.  The messages carry a
+    sequence number (message-id) and a sender id (group-id), see
+    utils.SequenceChecker.
+    """
+    def __init__(self, records, window):
+        self._records = records
+        self._window = window
+        self._group_id = uuid.uuid4().hex
+        self.sequence = 0
+        self.outstanding = 0
+        self.exhausted = False
+        self.status = collections.Counter()  # since the last report
+
+    @property
+    def done(self):
+        return self.exhausted and not self.outstanding
+
+    def credit_granted(self, sender_link):
+        self.send_messages(sender_link)
+
+    def send_messages(self, link):
+        while (not self.exhausted and self.outstanding < self._window and
+               link.credit > 0):
+            try:
+                record = next(self._records)
+            except StopIteration:
+                self.exhausted = True
+                break
+            msg = Message()
+            msg.body = record
+            msg.id = ulong(self.sequence)
+            msg.group_id = self._group_id
+            self.sequence += 1
+            self.outstanding += 1
+            link.send(msg, self)
+
+    def __call__(self, link, handle, status, error):
+        self.outstanding -= 1
+        self.status[status] += 1
+        self.send_messages(link)
+
+
+def stream(opts, loop, sender, handler, c_handler, connection):
+    """Run the StreamSender handler until done.  Returns the total of each
+    send status.
+    """
+    totals = collections.Counter()
+    start = time.time()
+    last = {'time': start}
+
+    def report():
+        now = time.time()
+        counts = handler.status
+        handler.status = collections.Counter()
+        totals.update(counts)
+        sent = sum(counts.values())
+        print("Sent %d msgs in %.3f secs (%.1f msgs/sec), %d in flight: %s"
+              % (sent, now - last['time'], sent / (now - last['time']),
+                 handler.outstanding,
+                 ", ".join("%s %d" % (SEND_STATUS.get(status, "???"), n)
+                           for status, n in sorted(counts.items()))))
+        last['time'] = now
+
+    def periodic_report():
+        report()
+        loop.call_later(opts.interval, periodic_report)
+
+    loop.call_later(opts.interval, periodic_report)
+    handler.send_messages(sender)
+    loop.wakeup(connection)
+    try:
+        while not (handler.done or c_handler.error or connection.closed):
+            loop.process()
+    except KeyboardInterrupt:
+        pass
+    report()
+    duration = time.time() - start
+    total = sum(totals.values())
+    print("Total: %d msgs in %.3f secs (%.1f msgs/sec)"
+          % (total, duration, total / duration))
+    if c_handler.error or connection.closed:
+        print("Send failed due to connection failure: %s" %
+              (c_handler.error or "remote closed unexpectedly"))
+    return totals
+
+
 def main(argv=None):
 
     _usage = """Usage: %prog [options] [message content string]"""
@@ -82,6 +174,19 @@ def main(argv=None):
                       help="enable protocol tracing")
     parser.add_option("-f", "--forever", action="store_true",
                       help="Keep sending forever")
+    parser.add_option("--input", type="string",
+                      help="Stream a message for each record in this file"
+                      " ('-' for stdin) instead of sending the argument")
+    parser.add_option("--record-format", type="choice",
+                      choices=["lines", "length-prefixed"], default="lines",
+                      help="Records in --input are text lines, or binary"
+                      " prefixed with a 4 byte big-endian length [lines]")
+    parser.add_option("--window", type="int", default=100,
+                      help="Max unacked messages in flight with --input"
+                      " [100]")
+    parser.add_option("--interval", type="float", default=1.0,
+                      help="Seconds between status summaries with --input"
+                      " [1.0]")
     parser.add_option("--ca",
                       help="Certificate Authority PEM file")
     parser.add_option("--ssl-cert-file",
@@ -102,6 +207,10 @@ def main(argv=None):
                       help="Name of the sasl config file (without '.config')")
 
     opts, payload = parser.parse_args(args=argv)
+    if opts.window < 1:
+        parser.error("--window must be at least 1")
+    if opts.interval <= 0:
+        parser.error("--interval must be greater than 0")
     if not payload:
         payload = "Hi There!"
     if opts.debug:
@@ -142,9 +251,23 @@ def main(argv=None):
                                              c_handler,
                                              conn_properties)
     connection.open()
+    loop = EventLoop()
+    loop.add(connection, my_socket)
+
+    input_file = None
+    if opts.input == '-':
+        # the records are binary, bypass any text decoding:
+        input_file = getattr(sys.stdin, 'buffer', sys.stdin)
+    elif opts.input:
+        input_file = open(opts.input, 'rb')
 
     source_address = opts.source_addr or uuid.uuid4().hex
-    s_handler = SenderEventHandler()
+    if input_file:
+        s_handler = StreamSender(read_records(input_file,
+                                              opts.record_format),
+                                 opts.window)
+    else:
+        s_handler = SenderEventHandler()
     sender = connection.create_sender(source_address,
                                       opts.target_addr,
                                       s_handler)
@@ -159,44 +282,52 @@ def main(argv=None):
             self.done = True
             self.status = status
 
-    while True:
+    if input_file:
+        stream(opts, loop, sender, s_handler, c_handler, connection)
+        if input_file is not getattr(sys.stdin, 'buffer', sys.stdin):
+            input_file.close()
+    else:
+        while True:
 
-        # Send a single message:
-        msg = Message()
-        msg.body = str(payload)
+            # Send a single message:
+            msg = Message()
+            msg.body = str(payload)
 
-        cb = SendCallback()
-        sender.send(msg, cb)
+            cb = SendCallback()
+            sender.send(msg, cb)
+            loop.wakeup(connection)
 
-        # Poll connection until SendCallback is invoked:
-        while not cb.done:
-            process_connection(connection, my_socket)
-            if c_handler.error:
-                break
-            if connection.closed:
-                break
+            # Poll connection until SendCallback is invoked:
+            while not cb.done:
+                loop.process()
+                if c_handler.error:
+                    break
+                if connection.closed:
+                    break
 
-        if cb.done:
-            print("Send done, status=%s" % SEND_STATUS.get(cb.status,
-                                                       "???"))
-        else:
-            print("Send failed due to connection failure: %s" %
-                  c_handler.error or "remote closed unexpectedly")
-            break
+            if cb.done:
+                print("Send done, status=%s" % SEND_STATUS.get(cb.status,
+                                                           "???"))
+            else:
+                print("Send failed due to connection failure: %s" %
+                      c_handler.error or "remote closed unexpectedly")
+                break
 
-        if not opts.forever:
-            break
+            if not opts.forever:
+                break
 
     if not sender.closed:
         sender.close()
     if not connection.closed:
         connection.close()
+    loop.wakeup(connection)
 
     # Poll connection until close completes:
     while not c_handler.error and not connection.closed:
-        process_connection(connection, my_socket)
+        loop.process()
 
     sender.destroy()
+    loop.close()
     connection.destroy()
     container.destroy()
     my_socket.close()
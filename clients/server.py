@@ -17,11 +17,40 @@
 # specific language governing permissions and limitations
 # under the License.
 #
-"""A simple server that consumes and produces messages."""
+"""A simple server that consumes and produces messages.
 
+Links receiving from the server are sent messages as fast as their credit
+allows: each grant of credit is filled in one burst from a pre-encoded
+message, stamped with a send time and sequence number (see utils.
+PreEncodedMessage), so a consumer attached through a router is limited by
+the router rather than by the server.
+
+Counters for the server, each connection and each link (messages, bytes,
+credit and the outcomes of the messages sent) can be scraped over HTTP or
+written to a file, see the --metrics-* options.
+
+With --broker it acts as a simple in-memory broker instead: messages sent to
+an address are queued, and links receiving from that address are sent the
+queued messages, as the credit they grant allows.
+
+With --echo it answers requests instead: each message received that has a
+reply_to address is sent back to that address, with the same body and
+correlation_id.  The replies go to the local queue of that address if it
+has consumers (the client is connected to this server), otherwise on a link
+to that address (e.g. the reply address a router assigned to the client).
+"""
+
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
 import logging
 import optparse
+import os
 import select
+import signal
+import socket
 import sys
 import time
 import uuid
@@ -29,30 +58,106 @@ import uuid
 from proton import Message
 import pyngus
 
+from metrics import add_metrics_options
+from metrics import metrics_exporter
+from metrics import Registry
 from utils import get_host_port
+from utils import PreEncodedMessage
+from utils import raise_fd_limit
+from utils import run_workers
 from utils import server_socket
+from utils import SSLConfig
 
 LOG = logging.getLogger()
 LOG.addHandler(logging.StreamHandler())
 
+# names of the outcomes reported to the delivery callbacks of sender links
+OUTCOMES = {pyngus.SenderLink.ACCEPTED: "accepted",
+            pyngus.SenderLink.REJECTED: "rejected",
+            pyngus.SenderLink.RELEASED: "released",
+            pyngus.SenderLink.MODIFIED: "modified",
+            pyngus.SenderLink.ABORTED: "aborted",
+            pyngus.SenderLink.TIMED_OUT: "timed_out",
+            pyngus.SenderLink.UNKNOWN: "unknown"}
+
+
+class ServerStats(object):
+    """Counters kept by a server process."""
+    FIELDS = ("connections", "sender_links", "receiver_links",
+              "messages_sent", "messages_received", "messages_dropped",
+              "ssl_resumed")
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+        self.duration = 0.0
+        self.cpu = 0.0  # user + system seconds
+
+    def to_dict(self):
+        values = dict((field, getattr(self, field)) for field in self.FIELDS)
+        values["duration"] = self.duration
+        values["cpu"] = self.cpu
+        return values
+
+    def merge(self, values):
+        """Add the counters from another ServerStats' to_dict()."""
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + values[field])
+        self.duration = max(self.duration, values["duration"])
+        self.cpu += values["cpu"]
+
+    def report(self, title):
+        counts = " ".join("%s=%d" % (field, getattr(self, field))
+                          for field in self.FIELDS)
+        rate = 0.0
+        if self.duration:
+            rate = (self.messages_sent +
+                    self.messages_received) / self.duration
+        per_conn = self.cpu / self.connections if self.connections else 0.0
+        return ("%s: %s duration=%f msgs/sec=%f cpu=%f cpu/connection=%f"
+                % (title, counts, self.duration, rate, self.cpu, per_conn))
+
 
 class SocketConnection(pyngus.ConnectionEventHandler):
     """Associates a pyngus Connection with a python network socket"""
 
-    def __init__(self, container, socket_, name, properties):
+    def __init__(self, container, socket_, name, properties, stats,
+                 ssl_config=None, broker=None, source=None):
         """Create a Connection using socket_."""
+        self.name = name
+        self.stats = stats
+        self.broker = broker
+        self.source = source or Source()
+        stats.connections += 1
         self.socket = socket_
         self.connection = container.create_connection(name,
                                                       self,  # handler
                                                       properties)
         self.connection.user_context = self
+        self.ssl = None
+        if ssl_config:
+            self.ssl = ssl_config.configure(self.connection)
         self.connection.open()
 
         self.sender_links = set()
         self.receiver_links = set()
+        self.reply_links = {}  # ReplySenderLinks indexed by address
         self._error = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # messages of the links that have been destroyed:
+        self.messages_sent = 0
+        self.messages_received = 0
+
+        # edge-triggered I/O state: set when epoll reports the socket ready,
+        # cleared when the socket would block
+        self.readable = False
+        self.writable = False
+        # the deadline currently scheduled in the timer heap
+        self.deadline = None
 
     def destroy(self):
+        self.deadline = None
         for link in self.sender_links.copy():
             link.destroy()
         for link in self.receiver_links.copy():
@@ -71,34 +176,101 @@ class SocketConnection(pyngus.ConnectionEventHandler):
                 self.connection.closed)
 
     def fileno(self):
-        """Allows use of a SocketConnection in a select() call."""
         return self.socket.fileno()
 
+    @property
+    def needs_service(self):
+        """True if I/O can be done without waiting for another edge."""
+        return ((self.readable and self.connection.needs_input > 0) or
+                (self.writable and self.connection.has_output > 0))
+
     def process_input(self):
-        """Called when socket is read-ready"""
-        try:
-            pyngus.read_socket_input(self.connection, self.socket)
-        except Exception as e:
-            self._error = "Exception on socket read: %s" % str(e)
-            LOG.error(self._error)
-            self.connection.close_input()
-            self.connection.close()
-        self.connection.process(time.time())
+        """Read until the socket would block or the Connection is full."""
+        while self.readable and self.connection.needs_input > 0:
+            try:
+                rc = pyngus.read_socket_input(self.connection, self.socket)
+            except Exception as e:
+                self._error = "Exception on socket read: %s" % str(e)
+                LOG.error(self._error)
+                self.connection.close_input()
+                self.connection.close()
+                rc = pyngus.Connection.EOS
+            if rc <= 0:
+                # drained (or closed) - wait for the next edge
+                self.readable = False
+            else:
+                self.bytes_in += rc
 
     def send_output(self):
-        """Called when socket is write-ready"""
-        try:
-            pyngus.write_socket_output(self.connection,
-                                       self.socket)
-        except Exception as e:
-            self._error = "Exception on socket write: %s" % str(e)
-            LOG.error(self._error)
-            self.connection.close_output()
-            self.connection.close()
-        self.connection.process(time.time())
+        """Write until the socket would block or no output is left."""
+        while self.writable and self.connection.has_output > 0:
+            try:
+                rc = pyngus.write_socket_output(self.connection,
+                                                self.socket)
+            except Exception as e:
+                self._error = "Exception on socket write: %s" % str(e)
+                LOG.error(self._error)
+                self.connection.close_output()
+                self.connection.close()
+                rc = pyngus.Connection.EOS
+            if rc <= 0:
+                self.writable = False
+            else:
+                self.bytes_out += rc
+
+    def metrics(self, metrics):
+        """Add the metrics of this connection and its links."""
+        sent = self.messages_sent
+        received = self.messages_received
+        for link in self.sender_links:
+            link.metrics(metrics, self.name)
+            sent += link.sent
+        for link in self.receiver_links:
+            link.metrics(metrics, self.name)
+            received += link.received
+        for direction, messages, count in (("out", sent, self.bytes_out),
+                                           ("in", received, self.bytes_in)):
+            metrics.counter("connection_messages_total",
+                            "Messages sent or received on a connection",
+                            messages, connection=self.name,
+                            direction=direction)
+            metrics.counter("connection_bytes_total",
+                            "Bytes written to or read from the socket of a"
+                            " connection", count, connection=self.name,
+                            direction=direction)
+
+    def wake(self):
+        """Service this connection on the next pass of the main loop, e.g.
+        after another connection queued messages for its links.
+        """
+        self.broker.woken.add(self)
+
+    def reply(self, message):
+        """Send message to its address, see --echo."""
+        queue = self.broker.queues.get(message.address)
+        if queue is not None and queue.consumers:
+            queue.put(message)
+            return
+        link = self.reply_links.get(message.address)
+        if link is None:
+            link = ReplySenderLink(self, message.address)
+            self.reply_links[message.address] = link
+            self.sender_links.add(link)
+        link.send(message)
+        self.wake()
+
+    def service(self, now):
+        """Do all pending input, processing and output."""
+        self.process_input()
+        self.connection.process(now)
+        self.send_output()
 
     # ConnectionEventHandler callbacks:
 
+    def connection_active(self, connection):
+        if self.ssl and self.ssl.resume_status() == self.ssl.RESUME_REUSED:
+            self.stats.ssl_resumed += 1
+
     def connection_remote_closed(self, connection, reason):
         LOG.debug("Connection: remote closed!")
         # The remote has closed its end of the Connection.  Close my end to
@@ -120,8 +292,13 @@ class SocketConnection(pyngus.ConnectionEventHandler):
             # the peer has requested us to create a source node. Pretend we do
             # this, and supply a dummy name
             requested_source = uuid.uuid4().hex
-        sender = MySenderLink(self, link_handle, requested_source)
+        if self.broker:
+            queue = self.broker.queue(requested_source)
+            sender = QueueSenderLink(self, link_handle, queue)
+        else:
+            sender = MySenderLink(self, link_handle, requested_source)
         self.sender_links.add(sender)
+        self.stats.sender_links += 1
 
     def receiver_requested(self, connection, link_handle,
                            name, requested_target, properties):
@@ -130,8 +307,17 @@ class SocketConnection(pyngus.ConnectionEventHandler):
             # the peer has requested us to create a target node. Pretend we do
             # this, and supply a dummy name
             requested_target = uuid.uuid4().hex
-        receiver = MyReceiverLink(self, link_handle, requested_target)
+        if self.broker and self.broker.echo:
+            receiver = EchoReceiverLink(self, link_handle, requested_target,
+                                        self.broker.credit)
+        elif self.broker:
+            queue = self.broker.queue(requested_target)
+            receiver = QueueReceiverLink(self, link_handle, queue,
+                                         self.broker.credit)
+        else:
+            receiver = MyReceiverLink(self, link_handle, requested_target)
         self.receiver_links.add(receiver)
+        self.stats.receiver_links += 1
 
     # SASL callbacks:
 
@@ -144,33 +330,101 @@ class SocketConnection(pyngus.ConnectionEventHandler):
         LOG.debug("SASL done callback, result=%s", str(result))
 
 
-class MySenderLink(pyngus.SenderEventHandler):
+class Source(object):
+    """How the server generates the messages it sends: the payload size,
+    and whether they are sent pre-settled (so are never acknowledged).
+    """
+    def __init__(self, payload_size=0, presettled=False):
+        self.payload_size = payload_size
+        self.presettled = presettled
+
+    def message(self):
+        """A new PreEncodedMessage, with its own group-id."""
+        template = Message()
+        if self.payload_size:
+            template.body = {'payload': b'x' * self.payload_size}
+        return PreEncodedMessage(template)
+
+
+class SenderStats(object):
+    """The counters of a sender link, for the metrics."""
+    # bytes in each message sent, None if they vary
+    message_size = None
+
+    def init_stats(self):
+        self.sent = 0
+        self.outcomes = collections.Counter()  # indexed by pyngus status
+
+    def metrics(self, metrics, connection):
+        link = self.sender_link
+        labels = {'connection': connection, 'link': link.name,
+                  'address': link.source_address or "", 'direction': "out"}
+        metrics.counter("link_messages_total",
+                        "Messages sent or received on a link", self.sent,
+                        **labels)
+        if self.message_size is not None:
+            metrics.counter("link_bytes_total",
+                            "Bytes of the messages sent on a link",
+                            self.sent * self.message_size, **labels)
+        metrics.gauge("link_credit",
+                      "Credit granted by the peer to a sender link, or by"
+                      " a receiver link to the peer", link.credit, **labels)
+        metrics.gauge("link_unsettled",
+                      "Messages sent on a link and not yet settled",
+                      link.pending, **labels)
+        for status, count in self.outcomes.items():
+            metrics.counter("link_outcomes_total",
+                            "Outcomes of the messages sent (or accepted) on"
+                            " a link", count,
+                            outcome=OUTCOMES.get(status, str(status)),
+                            **labels)
+
+
+class MySenderLink(SenderStats, pyngus.SenderEventHandler):
     """Send messages until credit runs out."""
     def __init__(self, socket_conn, handle, src_addr=None):
         self.socket_conn = socket_conn
+        self.presettled = socket_conn.source.presettled
+        self._msg = socket_conn.source.message()
+        self.message_size = len(self._msg)
+        self.sequence = 0
+        self.init_stats()
         sl = socket_conn.connection.accept_sender(handle,
                                                   source_override=src_addr,
                                                   event_handler=self)
         self.sender_link = sl
         self.sender_link.open()
-        print("New Sender link created, name=%s" % sl.name)
+        LOG.debug("New Sender link created, name=%s", sl.name)
 
     @property
     def closed(self):
         return self.sender_link.closed
 
     def destroy(self):
-        print("Sender link destroyed, name=%s" % self.sender_link.name)
+        LOG.debug("Sender link destroyed, name=%s", self.sender_link.name)
         self.socket_conn.sender_links.discard(self)
+        self.socket_conn.messages_sent += self.sent
         self.socket_conn = None
         self.sender_link.destroy()
         self.sender_link = None
 
     def send_message(self):
-        msg = Message()
-        msg.body = "Hi There!"
-        LOG.debug("Sender: Sending message...")
-        self.sender_link.send(msg, self)
+        """Use all the credit the peer has granted."""
+        link = self.sender_link
+        count = link.credit
+        now = time.time()
+        for _ in range(count):
+            self._msg.stamp(now, self.sequence)
+            self.sequence += 1
+            if self.presettled:
+                # no callback: pyngus settles the delivery as it is sent
+                link.send(self._msg)
+            else:
+                link.send(self._msg, self)
+        self.sent += count
+        if self.presettled:
+            self.socket_conn.stats.messages_sent += count
+        LOG.debug("Sender: sent %d messages", count)
 
     # SenderEventHandler callbacks:
 
@@ -185,44 +439,65 @@ class MySenderLink(pyngus.SenderEventHandler):
 
     def credit_granted(self, sender_link):
         LOG.debug("Sender: credit granted")
-        # Send a single message:
         if sender_link.credit > 0:
             self.send_message()
 
-    # 'message sent' callback:
+    # 'message sent' callback: only counts, more messages are sent when the
+    # peer grants more credit
     def __call__(self, sender, handle, status, error=None):
-        print("Message sent on Sender link %s, status=%s" %
-              (self.sender_link.name, status))
-        if self.sender_link.credit > 0:
-            # send another message:
-            self.send_message()
+        self.outcomes[status] += 1
+        if self.socket_conn:
+            self.socket_conn.stats.messages_sent += 1
 
 
 class MyReceiverLink(pyngus.ReceiverEventHandler):
     """Receive messages, and drop them."""
     def __init__(self, socket_conn, handle, rx_addr=None):
         self.socket_conn = socket_conn
+        self.received = 0
         rl = socket_conn.connection.accept_receiver(handle,
                                                     target_override=rx_addr,
                                                     event_handler=self)
         self.receiver_link = rl
         self.receiver_link.open()
-        self.receiver_link.add_capacity(1)
-        print("New Receiver link created, name=%s" % rl.name)
+        self.replenish()
+        LOG.debug("New Receiver link created, name=%s", rl.name)
 
     @property
     def closed(self):
         return self.receiver_link.closed
 
     def destroy(self):
-        print("Receiver link destroyed, name=%s" % self.receiver_link.name)
+        LOG.debug("Receiver link destroyed, name=%s", self.receiver_link.name)
         self.socket_conn.receiver_links.discard(self)
+        self.socket_conn.messages_received += self.received
         self.socket_conn = None
         self.receiver_link.destroy()
         self.receiver_link = None
 
+    def metrics(self, metrics, connection):
+        link = self.receiver_link
+        labels = {'connection': connection, 'link': link.name,
+                  'address': link.target_address or "", 'direction': "in"}
+        metrics.counter("link_messages_total",
+                        "Messages sent or received on a link",
+                        self.received, **labels)
+        metrics.gauge("link_credit",
+                      "Credit granted by the peer to a sender link, or by"
+                      " a receiver link to the peer", link.capacity,
+                      **labels)
+        # the server accepts every message it receives
+        metrics.counter("link_outcomes_total",
+                        "Outcomes of the messages sent (or accepted) on a"
+                        " link", self.received, outcome="accepted", **labels)
+
     # ReceiverEventHandler callbacks:
 
+    def replenish(self):
+        """Grant the peer credit to send more messages."""
+        if self.receiver_link.capacity < 1:
+            self.receiver_link.add_capacity(1)
+
     def receiver_active(self, receiver_link):
         LOG.debug("Receiver: Active")
 
@@ -232,10 +507,463 @@ class MyReceiverLink(pyngus.ReceiverEventHandler):
 
     def message_received(self, receiver_link, message, handle):
         self.receiver_link.message_accepted(handle)
-        print("Message received on Receiver link %s, message=%s"
-              % (self.receiver_link.name, str(message)))
-        if receiver_link.capacity < 1:
-            receiver_link.add_capacity(1)
+        self.received += 1
+        self.socket_conn.stats.messages_received += 1
+        LOG.debug("Message received on Receiver link %s, message=%s",
+                  self.receiver_link.name, message)
+        self.replenish()
+
+
+class MessageQueue(object):
+    """A FIFO of at most 'depth' messages, kept in a ring buffer.
+
+    The policy applies when the queue is full: "block" stops granting
+    credit to the producers until there is room, "drop-oldest" discards
+    the message at the head of the queue, and "drop-newest" discards the
+    message being queued.  Queued messages are handed to the consumers
+    with credit in turn.
+    """
+    POLICIES = ("block", "drop-oldest", "drop-newest")
+
+    def __init__(self, name, depth, policy, stats):
+        self.name = name
+        self.policy = policy
+        self.stats = stats
+        self._slots = [None] * depth
+        self._head = 0
+        self._count = 0
+        # credit granted to the producers but not yet used:
+        self.credit = 0
+        self.producers = set()  # QueueReceiverLinks
+        self.consumers = collections.deque()  # QueueSenderLinks
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def free(self):
+        """Room left for messages not already covered by granted credit."""
+        return len(self._slots) - self._count - self.credit
+
+    def put(self, message):
+        if self._count == len(self._slots):
+            self.stats.messages_dropped += 1
+            if self.policy == "drop-newest":
+                return
+            # drop-oldest, or a "block" producer sent more than its credit
+            self._pop()
+        tail = (self._head + self._count) % len(self._slots)
+        self._slots[tail] = message
+        self._count += 1
+        self.dispatch()
+
+    def _pop(self):
+        message = self._slots[self._head]
+        self._slots[self._head] = None
+        self._head = (self._head + 1) % len(self._slots)
+        self._count -= 1
+        return message
+
+    def dispatch(self):
+        """Send queued messages to the consumers that have credit."""
+        sent = False
+        idle = 0
+        while self._count and idle < len(self.consumers):
+            consumer = self.consumers[0]
+            self.consumers.rotate(-1)
+            link = consumer.sender_link
+            # a closing link still has credit, but pyngus would only abort
+            # what is sent on it
+            if link.active and link.credit > 0:
+                consumer.deliver(self._pop())
+                sent = True
+                idle = 0
+            else:
+                idle += 1
+        if sent and self.policy == "block":
+            for producer in self.producers:
+                producer.replenish()
+
+
+class Broker(object):
+    """The MessageQueues of a server, created on first use.  If echo, the
+    messages received are answered instead of queued (see --echo).
+    """
+    def __init__(self, depth, policy, credit, echo, stats):
+        self.depth = depth
+        self.policy = policy
+        self.credit = credit  # credit window of each producer link
+        self.echo = echo
+        self.stats = stats
+        self.queues = {}
+        # SocketConnections with work to do because of other connections:
+        self.woken = set()
+
+    def queue(self, name):
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = MessageQueue(name, self.depth, self.policy, self.stats)
+            self.queues[name] = queue
+            LOG.debug("Queue %s created", name)
+        return queue
+
+    def release(self, queue):
+        """Forget queue if it is empty and no longer used, e.g. the queue of
+        a dynamic reply address.
+        """
+        if not (len(queue) or queue.producers or queue.consumers):
+            self.queues.pop(queue.name, None)
+
+
+class QueueReceiverLink(MyReceiverLink):
+    """Receive messages into a MessageQueue."""
+    def __init__(self, socket_conn, handle, queue, window):
+        self.queue = queue
+        self.window = window
+        self.credit = 0  # granted and not yet used
+        queue.producers.add(self)
+        super(QueueReceiverLink, self).__init__(socket_conn, handle,
+                                                queue.name)
+
+    def destroy(self):
+        self.queue.producers.discard(self)
+        self.queue.credit -= self.credit
+        self.credit = 0
+        self.socket_conn.broker.release(self.queue)
+        super(QueueReceiverLink, self).destroy()
+
+    def replenish(self):
+        """Top up the credit window once half of it has been used, limited
+        to the room left in a blocking queue.
+        """
+        if self.receiver_link is None or self.credit * 2 > self.window:
+            return
+        amount = self.window - self.credit
+        if self.queue.policy == "block":
+            amount = min(amount, self.queue.free)
+        if amount > 0:
+            self.credit += amount
+            self.queue.credit += amount
+            self.receiver_link.add_capacity(amount)
+            self.socket_conn.wake()
+
+    def message_received(self, receiver_link, message, handle):
+        self.credit -= 1
+        self.queue.credit -= 1
+        self.receiver_link.message_accepted(handle)
+        self.received += 1
+        self.socket_conn.stats.messages_received += 1
+        self.queue.put(message)
+        self.replenish()
+
+
+class QueueSenderLink(MySenderLink):
+    """Send the messages of a MessageQueue."""
+    def __init__(self, socket_conn, handle, queue):
+        self.queue = queue
+        super(QueueSenderLink, self).__init__(socket_conn, handle,
+                                              queue.name)
+        self.message_size = None
+        queue.consumers.append(self)
+
+    def _detach(self):
+        """Stop consuming: called before the link's unsettled messages are
+        aborted, so they are requeued to the other consumers.
+        """
+        if self in self.queue.consumers:
+            self.queue.consumers.remove(self)
+
+    def destroy(self):
+        self._detach()
+        self.socket_conn.broker.release(self.queue)
+        super(QueueSenderLink, self).destroy()
+
+    def send_message(self):
+        self.queue.dispatch()
+
+    def deliver(self, message):
+        self.sender_link.send(message, self, message)
+        self.sent += 1
+        self.socket_conn.wake()
+
+    # 'message sent' callback:
+    def __call__(self, sender, message, status, error=None):
+        self.outcomes[status] += 1
+        if status in (pyngus.SenderLink.ACCEPTED,
+                      pyngus.SenderLink.REJECTED):
+            if self.socket_conn:
+                self.socket_conn.stats.messages_sent += 1
+        else:
+            # released, modified or aborted: give it to another consumer
+            self.queue.put(message)
+
+    def sender_remote_closed(self, sender_link, error):
+        self._detach()
+        super(QueueSenderLink, self).sender_remote_closed(sender_link, error)
+
+    def sender_closed(self, sender_link):
+        self._detach()
+
+    def sender_failed(self, sender_link, error):
+        self._detach()
+
+
+class EchoReceiverLink(MyReceiverLink):
+    """Receive requests and send them back to their reply_to address."""
+    def __init__(self, socket_conn, handle, rx_addr, window):
+        self.window = window
+        super(EchoReceiverLink, self).__init__(socket_conn, handle, rx_addr)
+
+    def replenish(self):
+        """Top up the credit window once half of it has been used."""
+        capacity = self.receiver_link.capacity
+        if capacity * 2 <= self.window:
+            self.receiver_link.add_capacity(self.window - capacity)
+
+    def message_received(self, receiver_link, message, handle):
+        self.receiver_link.message_accepted(handle)
+        self.received += 1
+        self.socket_conn.stats.messages_received += 1
+        if message.reply_to:
+            # the request becomes the reply: same body and correlation_id
+            message.address = message.reply_to
+            message.reply_to = None
+            self.socket_conn.reply(message)
+        self.replenish()
+
+
+class ReplySenderLink(SenderStats, pyngus.SenderEventHandler):
+    """A link opened by the server to send replies to an address."""
+    def __init__(self, socket_conn, address):
+        self.socket_conn = socket_conn
+        self.address = address
+        self.init_stats()
+        self.sender_link = socket_conn.connection.create_sender(
+            "", address, self, name="reply-%s" % uuid.uuid4().hex)
+        self.sender_link.open()
+
+    @property
+    def closed(self):
+        return self.sender_link.closed
+
+    def _forget(self):
+        # the next reply to this address opens a new link
+        if self.socket_conn.reply_links.get(self.address) is self:
+            del self.socket_conn.reply_links[self.address]
+
+    def destroy(self):
+        self.socket_conn.sender_links.discard(self)
+        self.socket_conn.messages_sent += self.sent
+        self._forget()
+        self.socket_conn = None
+        self.sender_link.destroy()
+        self.sender_link = None
+
+    def send(self, message):
+        # queued by pyngus until the peer grants credit
+        self.sender_link.send(message, self)
+        self.sent += 1
+
+    def sender_remote_closed(self, sender_link, error):
+        LOG.debug("Reply link to %s closed: %s", self.address, error)
+        self._forget()
+        self.sender_link.close()
+
+    def sender_failed(self, sender_link, error):
+        self.sender_remote_closed(sender_link, error)
+
+    # 'message sent' callback:
+    def __call__(self, sender, handle, status, error=None):
+        self.outcomes[status] += 1
+        if self.socket_conn and status == pyngus.SenderLink.ACCEPTED:
+            self.socket_conn.stats.messages_sent += 1
+
+
+def collect_metrics(metrics, stats, socket_connections, broker):
+    """Add the metrics of a server (see metrics.Registry)."""
+    for field in ServerStats.FIELDS:
+        metrics.counter(field + "_total",
+                        "Total %s" % field.replace("_", " "),
+                        getattr(stats, field))
+    metrics.gauge("connections_open", "Connections currently open",
+                  len(socket_connections))
+    for sconn in socket_connections.values():
+        sconn.metrics(metrics)
+    if broker:
+        for queue in broker.queues.values():
+            metrics.gauge("queue_depth", "Messages in a --broker queue",
+                          len(queue), queue=queue.name)
+            metrics.gauge("queue_consumers", "Links sending from a queue",
+                          len(queue.consumers), queue=queue.name)
+            metrics.gauge("queue_producers", "Links receiving into a queue",
+                          len(queue.producers), queue=queue.name)
+
+
+def serve(my_socket, container_name, conn_properties, broker_opts=None,
+          source=None, exporter=None):
+    """Run the server on my_socket until SIGINT or SIGTERM is received.
+    broker_opts, if given, is the (depth, policy, credit, echo) of --broker
+    or --echo mode.  source is the Source of the messages sent by the
+    server.  exporter(registry), if given, returns the metrics Exporter of
+    the server's Registry.  Returns the ServerStats for the run.
+    """
+    stats = ServerStats()
+    broker = None
+    if broker_opts:
+        broker = Broker(*(broker_opts + (stats,)))
+    start = time.time()
+    cpu_start = sum(os.times()[:2])
+
+    # all the connections share one SSL context, so clients can resume
+    # their TLS sessions:
+    ssl_config, conn_properties = SSLConfig.split(conn_properties)
+
+    # create an AMQP container that will 'provide' the Server service
+    #
+    container = pyngus.Container(container_name)
+    socket_connections = {}  # indexed by fileno
+
+    registry = Registry("server_")
+    registry.register(lambda metrics: collect_metrics(
+        metrics, stats, socket_connections, broker))
+    metrics = exporter(registry) if exporter else None
+
+    # All sockets are registered once, edge-triggered.  Each pass only
+    # touches the connections that epoll reports, whose timers expire, or
+    # that still had I/O to do at the end of the previous pass.
+    #
+    poller = select.epoll()
+    poller.register(my_socket.fileno(), select.EPOLLIN | select.EPOLLET)
+
+    # signals are delivered via a pipe so they can wake up epoll:
+    signal_rfd, signal_wfd = os.pipe()
+    for fd in (signal_rfd, signal_wfd):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    old_wakeup_fd = signal.set_wakeup_fd(signal_wfd)
+    old_handlers = [(signum, signal.signal(signum, lambda *args: None))
+                    for signum in (signal.SIGINT, signal.SIGTERM)]
+    poller.register(signal_rfd, select.EPOLLIN)
+
+    conn_events = (select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP |
+                   select.EPOLLET)
+    read_events = (select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLHUP |
+                   select.EPOLLERR)
+    write_events = select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR
+    timers = []  # heap of (deadline, sequence, SocketConnection)
+    sequence = itertools.count()
+    pending = set()
+
+    # Main loop: process I/O and timer events:
+    #
+    running = True
+    while running:
+        timeout = -1
+        if pending:
+            timeout = 0
+        elif timers:
+            timeout = max(timers[0][0] - time.time(), 0)
+        if metrics:
+            # snapshots are taken here, between passes:
+            wait = metrics.poll()
+            if timeout < 0 or wait < timeout:
+                timeout = wait
+
+        events = poller.poll(timeout)
+
+        active = pending
+        pending = set()
+        for fd, mask in events:
+            if fd == signal_rfd:
+                running = False
+                continue
+
+            if fd == my_socket.fileno():
+                # new inbound connection request(s) received, create a new
+                # SocketConnection for each:
+                while True:
+                    try:
+                        client_socket, client_address = my_socket.accept()
+                    except socket.error as e:
+                        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            LOG.error("accept() failed: %s", str(e))
+                        break
+                    client_socket.setblocking(0)
+                    name = str(client_address)
+                    sconn = SocketConnection(container,
+                                             client_socket,
+                                             name,
+                                             conn_properties,
+                                             stats,
+                                             ssl_config,
+                                             broker,
+                                             source)
+                    socket_connections[sconn.fileno()] = sconn
+                    poller.register(sconn.fileno(), conn_events)
+                    LOG.debug("new connection created name=%s", name)
+                continue
+
+            sconn = socket_connections[fd]
+            if mask & read_events:
+                sconn.readable = True
+            if mask & write_events:
+                sconn.writable = True
+            active.add(sconn)
+
+        now = time.time()
+        while timers and timers[0][0] <= now:
+            deadline, _, sconn = heapq.heappop(timers)
+            if sconn.deadline == deadline:  # else stale entry
+                sconn.deadline = None
+                active.add(sconn)
+
+        closed = False
+        for sconn in active:
+            sconn.service(now)
+            # nuke any completed connections:
+            if sconn.closed:
+                fd = sconn.fileno()
+                poller.unregister(fd)
+                del socket_connections[fd]
+                sconn.destroy()
+                closed = True
+                continue
+
+            # can free any closed links now (optional):
+            for link in sconn.sender_links | sconn.receiver_links:
+                if link.closed:
+                    link.destroy()
+
+            if sconn.needs_service:
+                pending.add(sconn)
+            deadline = sconn.connection.deadline
+            if deadline and (sconn.deadline is None or
+                             deadline < sconn.deadline):
+                sconn.deadline = deadline
+                heapq.heappush(timers, (deadline, next(sequence), sconn))
+
+        if closed:
+            LOG.debug("%d active connections present", len(socket_connections))
+
+        if broker and broker.woken:
+            pending.update(sconn for sconn in broker.woken
+                           if sconn.connection is not None)
+            broker.woken.clear()
+
+    for signum, handler in old_handlers:
+        signal.signal(signum, handler)
+    signal.set_wakeup_fd(old_wakeup_fd)
+    os.close(signal_rfd)
+    os.close(signal_wfd)
+    if metrics:
+        metrics.stop()
+    for sconn in socket_connections.values():
+        sconn.destroy()
+    poller.close()
+    container.destroy()
+    stats.duration = time.time() - start
+    stats.cpu = sum(os.times()[:2]) - cpu_start
+    return stats
 
 
 def main(argv=None):
@@ -248,6 +976,30 @@ def main(argv=None):
     parser.add_option("--idle", dest="idle_timeout", type="float",
                       default=30,
                       help="timeout for an idle link, in seconds")
+    parser.add_option("--backlog", type="int", default=1024,
+                      help="listen backlog for inbound connections [1024]")
+    parser.add_option("--workers", type="int", default=1,
+                      help="number of server processes sharing the port [1]")
+    parser.add_option("--message-size", type="int", default=0,
+                      help="payload bytes in each message sent [0]")
+    parser.add_option("--presettle", action="store_true",
+                      help="send the messages pre-settled (no acks)")
+    parser.add_option("--broker", action="store_true",
+                      help="queue the messages received, and send them to"
+                      " the links receiving from the same address")
+    parser.add_option("--echo", action="store_true",
+                      help="send each message received back to its reply_to"
+                      " address, see --broker for the reply queues")
+    parser.add_option("--queue-depth", type="int", default=10000,
+                      help="maximum messages in each --broker queue [10000]")
+    parser.add_option("--queue-policy", type="choice",
+                      choices=MessageQueue.POLICIES, default="block",
+                      help="what to do when a --broker queue is full: %s"
+                      " [block]" % ", ".join(MessageQueue.POLICIES))
+    parser.add_option("--credit", type="int", default=100,
+                      help="credit window of each link sending to a"
+                      " --broker queue [100]")
+    add_metrics_options(parser)
     parser.add_option("--trace", dest="trace", action="store_true",
                       help="enable protocol tracing")
     parser.add_option("--debug", dest="debug", action="store_true",
@@ -270,113 +1022,74 @@ def main(argv=None):
                       help="Path to the SASL config file")
 
     opts, arguments = parser.parse_args(args=argv)
+    broker_opts = None
+    if opts.broker or opts.echo:
+        if opts.workers > 1:
+            # each worker would have its own queues
+            parser.error("--broker and --echo cannot be used with --workers")
+        if opts.queue_depth < 1 or opts.credit < 1:
+            parser.error("--queue-depth and --credit must be positive")
+        broker_opts = (opts.queue_depth, opts.queue_policy, opts.credit,
+                       bool(opts.echo))
+    if opts.message_size < 0:
+        parser.error("--message-size cannot be negative")
+    source = Source(opts.message_size, opts.presettle)
     if opts.debug:
         LOG.setLevel(logging.DEBUG)
 
-    # Create a socket for inbound connections
-    #
-    host, port = get_host_port(opts.address)
-    my_socket = server_socket(host, port)
-
-    # create an AMQP container that will 'provide' the Server service
-    #
-    container = pyngus.Container("Server")
-    socket_connections = set()
-
-    # Main loop: process I/O and timer events:
-    #
-    while True:
-        readers, writers, timers = container.need_processing()
-
-        # map pyngus Connections back to my SocketConnections:
-        readfd = [c.user_context for c in readers]
-        writefd = [c.user_context for c in writers]
-
-        timeout = None
-        if timers:
-            deadline = timers[0].next_tick  # [0] == next expiring timer
-            now = time.time()
-            timeout = 0 if deadline <= now else deadline - now
-
-        LOG.debug("select() start (t=%s)", str(timeout))
-        readfd.append(my_socket)
-        readable, writable, ignore = select.select(readfd, writefd,
-                                                   [], timeout)
-        LOG.debug("select() returned")
-
-        worked = set()
-        for r in readable:
-            if r is my_socket:
-                # new inbound connection request received,
-                # create a new SocketConnection for it:
-                client_socket, client_address = my_socket.accept()
-                # name = uuid.uuid4().hex
-                name = str(client_address)
-                conn_properties = {'x-server': True}
-                if opts.require_auth:
-                    conn_properties['x-require-auth'] = True
-                if opts.sasl_mechs:
-                    conn_properties['x-sasl-mechs'] = opts.sasl_mechs
-                if opts.sasl_cfg_name:
-                    conn_properties['x-sasl-config-name'] = opts.sasl_cfg_name
-                if opts.sasl_cfg_dir:
-                    conn_properties['x-sasl-config-dir'] = opts.sasl_cfg_dir
-                if opts.idle_timeout:
-                    conn_properties["idle-time-out"] = opts.idle_timeout
-                if opts.trace:
-                    conn_properties["x-trace-protocol"] = True
-                if opts.ca:
-                    conn_properties["x-ssl-server"] = True
-                    conn_properties["x-ssl-ca-file"] = opts.ca
-                    conn_properties["x-ssl-verify-mode"] = "verify-cert"
-                if opts.ssl_cert_file:
-                    conn_properties["x-ssl-server"] = True
-                    identity = (opts.ssl_cert_file, opts.ssl_key_file, opts.ssl_key_password)
-                    conn_properties["x-ssl-identity"] = identity
-
-                sconn = SocketConnection(container,
-                                         client_socket,
-                                         name,
-                                         conn_properties)
-                socket_connections.add(sconn)
-                LOG.debug("new connection created name=%s", name)
+    conn_properties = {'x-server': True}
+    if opts.require_auth:
+        conn_properties['x-require-auth'] = True
+    if opts.sasl_mechs:
+        conn_properties['x-sasl-mechs'] = opts.sasl_mechs
+    if opts.sasl_cfg_name:
+        conn_properties['x-sasl-config-name'] = opts.sasl_cfg_name
+    if opts.sasl_cfg_dir:
+        conn_properties['x-sasl-config-dir'] = opts.sasl_cfg_dir
+    if opts.idle_timeout:
+        conn_properties["idle-time-out"] = opts.idle_timeout
+    if opts.trace:
+        conn_properties["x-trace-protocol"] = True
+    if opts.ca:
+        conn_properties["x-ssl-server"] = True
+        conn_properties["x-ssl-ca-file"] = opts.ca
+        conn_properties["x-ssl-verify-mode"] = "verify-cert"
+    if opts.ssl_cert_file:
+        conn_properties["x-ssl-server"] = True
+        identity = (opts.ssl_cert_file, opts.ssl_key_file, opts.ssl_key_password)
+        conn_properties["x-ssl-identity"] = identity
 
-            else:
-                assert isinstance(r, SocketConnection)
-                r.process_input()
-                worked.add(r)
-
-        for t in timers:
-            now = time.time()
-            if t.next_tick > now:
-                break
-            t.process(now)
-            sc = t.user_context
-            assert isinstance(sc, SocketConnection)
-            worked.add(sc)
-
-        for w in writable:
-            assert isinstance(w, SocketConnection)
-            w.send_output()
-            worked.add(w)
+    raise_fd_limit()
+    host, port = get_host_port(opts.address)
 
-        closed = False
-        while worked:
-            sc = worked.pop()
-            # nuke any completed connections:
-            if sc.closed:
-                socket_connections.discard(sc)
-                sc.destroy()
-                closed = True
-            else:
-                # can free any closed links now (optional):
-                for link in sc.sender_links | sc.receiver_links:
-                    if link.closed:
-                        link.destroy()
+    if opts.workers <= 1:
+        # Create a socket for inbound connections
+        #
+        my_socket = server_socket(host, port, opts.backlog)
+        stats = serve(my_socket, "Server", conn_properties, broker_opts,
+                      source, lambda registry: metrics_exporter(opts,
+                                                                registry))
+        my_socket.close()
+        print(stats.report("Stats"))
+        return 0
 
-        if closed:
-            LOG.debug("%d active connections present", len(socket_connections))
+    def worker(index):
+        # each worker has its own Container and listening socket, the kernel
+        # spreads inbound connections across the sockets:
+        my_socket = server_socket(host, port, opts.backlog, reuseport=True)
+        stats = serve(my_socket, "Server-%d" % index, conn_properties,
+                      source=source,
+                      exporter=lambda registry: metrics_exporter(
+                          opts, registry, index))
+        my_socket.close()
+        print(stats.report("Worker %d Stats" % index))
+        return stats.to_dict()
 
+    totals = ServerStats()
+    for result in run_workers(opts.workers, worker):
+        if result:
+            totals.merge(result)
+    print(totals.report("Total Stats (%d workers)" % opts.workers))
     return 0
 
 
@@ -18,13 +18,34 @@
 #
 """Utilities used by the Examples"""
 
+import array
+import base64
+import binascii
 import errno
+import heapq
+import itertools
+import json
 import logging
+import math
+import mmap
+import os
 import re
+import resource
+import selectors
+import signal
 import socket
-import select
+import ssl
+import struct
+import sys
 import time
+import uuid
 
+from proton import Message
+from proton import SSL
+from proton import SSLDomain
+from proton import SSLException
+from proton import SSLSessionDetails
+from proton import ulong
 import pyngus
 
 LOG = logging.getLogger()
@@ -59,14 +80,29 @@ def connect_socket(host, port, blocking=True):
     return my_socket
 
 
-def server_socket(host, port, backlog=10):
-    """Create a TCP listening socket for a server."""
+def raise_fd_limit():
+    """Raise the open file limit to the maximum allowed."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def server_socket(host, port, backlog=10, reuseport=False):
+    """Create a TCP listening socket for a server.  If reuseport is set
+    several processes can each bind a socket to the same port, and the kernel
+    will distribute inbound connections across them.
+    """
     addr = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
     if not addr:
         raise Exception("Could not translate address '%s:%s'"
                         % (host, str(port)))
     my_socket = socket.socket(addr[0][0], addr[0][1], addr[0][2])
     my_socket.setblocking(0)  # 0=non-blocking
+    # allow a restarted server to bind while old connections are in TIME_WAIT
+    my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
         my_socket.bind(addr[0][4])
         my_socket.listen(backlog)
@@ -76,55 +112,735 @@ def server_socket(host, port, backlog=10):
     return my_socket
 
 
-def process_connection(connection, my_socket):
-    """Handle I/O and Timers on a single Connection."""
-    if connection.closed:
-        return False
-
-    work = False
-    readfd = []
-    writefd = []
-    if connection.needs_input > 0:
-        readfd = [my_socket]
-        work = True
-    if connection.has_output > 0:
-        writefd = [my_socket]
-        work = True
-
-    timeout = None
-    deadline = connection.next_tick
-    if deadline:
-        work = True
+def run_workers(count, target):
+    """Call target(index) in each of count forked worker processes.
+
+    target must return a JSON serializable result, which is passed back to
+    the parent over a pipe.  SIGINT and SIGTERM received by the parent are
+    forwarded to the workers.  Returns the list of results in worker order,
+    None for any worker that failed.
+    """
+    children = []
+    for index in range(count):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 1
+            try:
+                result = target(index)
+                with os.fdopen(wfd, 'w') as f:
+                    json.dump(result, f)
+                status = 0
+            except BaseException:
+                LOG.exception("Worker %d failed", index)
+            finally:
+                os._exit(status)
+        os.close(wfd)
+        children.append((pid, rfd))
+
+    def forward(signum, frame):
+        for pid, _ in children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    old_handlers = [(signum, signal.signal(signum, forward))
+                    for signum in (signal.SIGINT, signal.SIGTERM)]
+    results = []
+    try:
+        for pid, rfd in children:
+            with os.fdopen(rfd) as f:
+                data = f.read()
+            os.waitpid(pid, 0)
+            results.append(json.loads(data) if data else None)
+    finally:
+        for signum, handler in old_handlers:
+            signal.signal(signum, handler)
+    return results
+
+
+class SSLConfig(object):
+    """SSL for many Connections from one shared proton SSLDomain.
+
+    pyngus configures each Connection with its own SSLDomain (an OpenSSL
+    context), re-reading the certificate files every time and ruling out
+    TLS session resumption.  Create the Connection with the properties
+    returned by split() instead, then call configure() on it: the domain
+    is built once from the x-ssl-* properties, with the same semantics
+    as pyngus.  A client passing a session_id offers to resume the session
+    of the previous connection made with that id.
+    """
+    PROPERTIES = ('x-ssl', 'x-ssl-identity', 'x-ssl-ca-file',
+                  'x-ssl-verify-mode', 'x-ssl-server', 'x-ssl-peer-name',
+                  'x-ssl-allow-cleartext')
+    _VERIFY_MODES = {'verify-peer': SSLDomain.VERIFY_PEER_NAME,
+                     'verify-cert': SSLDomain.VERIFY_PEER,
+                     'no-verify': SSLDomain.ANONYMOUS_PEER}
+
+    def __init__(self, properties):
+        server = properties.get('x-ssl-server', properties.get('x-server'))
+        self.server = bool(server)
+        mode = SSLDomain.MODE_SERVER if server else SSLDomain.MODE_CLIENT
+        identity = properties.get('x-ssl-identity')
+        ca_file = properties.get('x-ssl-ca-file')
+        if not ca_file and properties.get('x-ssl'):
+            ca_file = ssl.get_default_verify_paths().cafile
+        self.peer_name = properties.get('x-ssl-peer-name',
+                                        properties.get('hostname'))
+        if not ca_file:
+            default = 'no-verify'
+        elif not self.peer_name:
+            default = 'verify-cert'
+        else:
+            default = 'verify-peer'
+        verify = properties.get('x-ssl-verify-mode', default)
+        if verify not in self._VERIFY_MODES:
+            raise SSLException("bad value for x-ssl-verify-mode: '%s'"
+                               % verify)
+        self.domain = SSLDomain(mode)
+        if identity:
+            self.domain.set_credentials(*identity)
+        if ca_file:
+            self.domain.set_trusted_ca_db(ca_file)
+        self.domain.set_peer_authentication(self._VERIFY_MODES[verify],
+                                            ca_file)
+        if server and properties.get('x-ssl-allow-cleartext'):
+            self.domain.allow_unsecured_client()
+
+    @classmethod
+    def split(cls, properties):
+        """Return (SSLConfig or None, properties without the x-ssl-* ones)."""
+        if not any(name in properties for name in cls.PROPERTIES):
+            return None, properties
+        others = dict((name, value) for name, value in properties.items()
+                      if name not in cls.PROPERTIES)
+        return cls(properties), others
+
+    def configure(self, connection, session_id=None):
+        """Enable SSL on a pyngus Connection.  Returns the proton SSL."""
+        details = SSLSessionDetails(session_id) if session_id else None
+        pn_ssl = SSL(connection.pn_transport, self.domain, details)
+        if self.peer_name and not self.server:
+            pn_ssl.peer_hostname = self.peer_name
+        return pn_ssl
+
+
+class EventLoop(object):
+    """Drive the I/O and timers of many Connections from a single selector.
+
+    Each Connection's socket is registered with the selector once.  The
+    selector's interest set is only modified when the Connection's
+    needs_input/has_output state changes.  On each wakeup all ready sockets
+    are read, then each ready Connection is processed exactly once, then the
+    pending output is written.  Callbacks can also be scheduled to run at a
+    given time.
+
+    Only the Connections that were ready, processed or woken are looked at
+    again, and the Connection deadlines are kept in a heap, so a wakeup does
+    not cost O(Connections).  Code that uses a Connection (or its links)
+    outside of its callbacks, e.g. from a timer callback or between calls to
+    process(), must call wakeup() so its new state is noticed.
+    """
+    class _Entry(object):
+        __slots__ = ('connection', 'socket', 'events', 'deadline')
+
+        def __init__(self, connection, socket_):
+            self.connection = connection
+            self.socket = socket_
+            self.events = 0
+            self.deadline = None  # as scheduled in the deadline heap
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._entries = {}  # indexed by Connection
+        self._registered = 0
+        self._dirty = set()  # _Entries to update before waiting
+        self._deadlines = []  # heap of (deadline, sequence, _Entry)
+        self._timers = []  # heap of (deadline, sequence, callback)
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, connection, socket_):
+        """Start driving connection using socket_."""
+        entry = EventLoop._Entry(connection, socket_)
+        self._entries[connection] = entry
+        self._dirty.add(entry)
+
+    def remove(self, connection):
+        """Stop driving connection.  Must be called before its socket is
+        closed.
+        """
+        entry = self._entries.pop(connection, None)
+        if entry:
+            self._dirty.discard(entry)
+            entry.deadline = None  # its heap entries are now stale
+            if entry.events:
+                self._selector.unregister(entry.socket)
+                self._registered -= 1
+
+    def wakeup(self, connection=None):
+        """Have process() look at connection again (all the Connections if
+        None) after it was used outside of its callbacks.
+        """
+        if connection is None:
+            self._dirty.update(self._entries.values())
+        else:
+            entry = self._entries.get(connection)
+            if entry:
+                self._dirty.add(entry)
+
+    def call_at(self, deadline, callback):
+        """Call callback() from process() once time.time() >= deadline."""
+        heapq.heappush(self._timers,
+                       (deadline, next(self._sequence), callback))
+
+    def call_later(self, delay, callback):
+        self.call_at(time.time() + delay, callback)
+
+    def close(self):
+        for connection in list(self._entries):
+            self.remove(connection)
+        self._selector.close()
+
+    def _update(self, entry):
+        connection = entry.connection
+        deadline = connection.deadline
+        if deadline and (entry.deadline is None or deadline < entry.deadline):
+            entry.deadline = deadline
+            heapq.heappush(self._deadlines,
+                           (deadline, next(self._sequence), entry))
+        events = 0
+        if connection.needs_input > 0:
+            events |= selectors.EVENT_READ
+        if connection.has_output > 0:
+            events |= selectors.EVENT_WRITE
+        if events == entry.events:
+            return
+        if not entry.events:
+            self._selector.register(entry.socket, events, entry)
+            self._registered += 1
+        elif not events:
+            self._selector.unregister(entry.socket)
+            self._registered -= 1
+        else:
+            self._selector.modify(entry.socket, events, entry)
+        entry.events = events
+
+    def _next_deadline(self):
+        """Drop the stale entries at the top of the deadline heap and return
+        the earliest deadline, or None.
+        """
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][2].deadline != deadlines[0][0]:
+            heapq.heappop(deadlines)
+        return deadlines[0][0] if deadlines else None
+
+    def process(self, timeout=None):
+        """Wait up to timeout seconds for I/O or timer events and process the
+        Connections that are ready.  Returns False if no Connection has any
+        work pending.
+        """
+        dirty, self._dirty = self._dirty, set()
+        for entry in dirty:
+            if self._entries.get(entry.connection) is entry:
+                self._update(entry)
+        deadline = self._next_deadline()
+        timer = self._timers[0][0] if self._timers else None
+
+        if not self._registered and deadline is None and timer is None:
+            return False
+
+        wait = None
+        if deadline is not None or timer is not None:
+            wait = max(min(t for t in (deadline, timer) if t is not None) -
+                       time.time(), 0)
+        if timeout is not None:
+            wait = timeout if wait is None else min(wait, timeout)
+
+        ready = self._selector.select(wait)
+
         now = time.time()
-        timeout = 0 if deadline <= now else deadline - now
+        expired = []
+        while self._timers and self._timers[0][0] <= now:
+            expired.append(heapq.heappop(self._timers)[2])
+        for callback in expired:
+            callback()
 
-    if not work:
-        return False
+        writers = []
+        active = set()
+        for key, mask in ready:
+            entry = key.data
+            if mask & selectors.EVENT_READ:
+                self._read(entry)
+            if mask & selectors.EVENT_WRITE:
+                writers.append(entry)
+            active.add(entry)
+
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            tick, _, entry = heapq.heappop(self._deadlines)
+            if entry.deadline == tick:  # else stale
+                entry.deadline = None
+                active.add(entry)
+        for entry in active:
+            if entry.connection in self._entries:
+                entry.connection.process(now)
+        self._dirty.update(active)
 
-    readable, writable, ignore = select.select(readfd,
-                                               writefd,
-                                               [],
-                                               timeout)
-    if readable:
+        for entry in writers:
+            closed = entry.connection.closed
+            self._write(entry)
+            if entry.connection.closed and not closed:
+                # the last write completed the close (e.g. the TLS
+                # close_notify): let the Connection report it
+                entry.connection.process(now)
+        return True
+
+    @staticmethod
+    def _read(entry):
         try:
-            pyngus.read_socket_input(connection, my_socket)
+            pyngus.read_socket_input(entry.connection, entry.socket)
         except Exception as e:
             # treat any socket error as
             LOG.error("Socket error on read: %s", str(e))
-            connection.close_input()
+            entry.connection.close_input()
             # make an attempt to cleanly close
-            connection.close()
+            entry.connection.close()
 
-    connection.process(time.time())
-    if writable:
+    @staticmethod
+    def _write(entry):
         try:
-            pyngus.write_socket_output(connection, my_socket)
+            pyngus.write_socket_output(entry.connection, entry.socket)
         except Exception as e:
             LOG.error("Socket error on write %s", str(e))
-            connection.close_output()
+            entry.connection.close_output()
             # this may not help, but it won't hurt:
-            connection.close()
-    return True
+            entry.connection.close()
+
+
+class PreEncodedMessage(object):
+    """A message that is encoded once and re-sent many times.
+
+    The send timestamp (the 'tx-timestamp' entry of the body map) and a
+    sequence number (the message-id, as a ulong) are patched in place at
+    fixed offsets of the encoded message.  Unless the message has one, the
+    group-id is set to a unique id, so receivers can tell the sequences of
+    different senders apart (see SequenceChecker).  Pass it instead of a
+    Message to pyngus' SenderLink.send(), which only calls encode(), or to
+    proton's Sender.send().  The encoded buffer is reused: stamp() must not
+    be called again until the previous send has been written to the link,
+    i.e. only send when the link has credit.
+    """
+    TIMESTAMP_KEY = 'tx-timestamp'
+    # placeholders used to locate the fields in the encoded message:
+    _TIMESTAMP_MARK = struct.unpack('>d', b'\x42\x7fTSTAMP')[0]
+    _SEQUENCE_MARK = struct.unpack('>Q', b'SEQUENCE')[0]
+
+    def __init__(self, message=None):
+        """Encode message (a proton Message with an optional dict body)."""
+        message = message or Message()
+        body = dict(message.body or {})
+        body[self.TIMESTAMP_KEY] = self._TIMESTAMP_MARK
+        message.body = body
+        message.id = ulong(self._SEQUENCE_MARK)
+        if not message.group_id:
+            message.group_id = uuid.uuid4().hex
+        self._buffer = bytearray(message.encode())
+        self._ts_offset = self._offset(b'\x82' +
+                                       struct.pack('>d', self._TIMESTAMP_MARK))
+        self._seq_offset = self._offset(b'\x80' +
+                                        struct.pack('>Q', self._SEQUENCE_MARK))
+
+    def _offset(self, encoded):
+        offset = self._buffer.find(encoded)
+        if offset < 0 or self._buffer.find(encoded, offset + 1) >= 0:
+            raise Exception("Cannot locate field in encoded message")
+        return offset + 1  # skip the type code
+
+    def __len__(self):
+        return len(self._buffer)
+
+    @classmethod
+    def sent_at(cls, message):
+        """Return the send timestamp of a received message, or None if it was
+        not sent from a PreEncodedMessage.
+        """
+        body = message.body
+        if isinstance(body, dict):
+            return body.get(cls.TIMESTAMP_KEY)
+        return None
+
+    def stamp(self, timestamp, sequence=0):
+        struct.pack_into('>d', self._buffer, self._ts_offset, timestamp)
+        struct.pack_into('>Q', self._buffer, self._seq_offset, sequence)
+
+    def encode(self):
+        return self._buffer
+
+    def send(self, sender, tag=None):
+        """Send on a proton Sender (see proton.Message.send)."""
+        dlv = sender.delivery(tag or sender.delivery_tag())
+        sender.stream(self._buffer)
+        sender.advance()
+        if sender.snd_settle_mode == sender.SND_SETTLED:
+            dlv.settle()
+        return dlv
+
+
+def read_records(stream, record_format='lines'):
+    """Generate the records in a binary stream: either text lines (without
+    the line ending), or binary records each preceded by its length as a 4
+    byte big-endian integer ('length-prefixed').
+    """
+    if record_format == 'lines':
+        for line in stream:
+            yield line.rstrip(b'\r\n').decode('utf-8', 'replace')
+        return
+    while True:
+        header = stream.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise Exception("Truncated record length")
+        size = struct.unpack('>I', header)[0]
+        data = stream.read(size)
+        if len(data) < size:
+            raise Exception("Truncated record: %d of %d bytes"
+                            % (len(data), size))
+        yield data
+
+
+class Corpus(object):
+    """A memory-mapped corpus of pre-encoded AMQP messages.
+
+    The corpus is two files: PATH.dat holds the encoded messages back to
+    back, and PATH.idx is an index of their offsets - an 8 byte magic, the
+    message count, then count + 1 offsets into PATH.dat, all little-endian
+    64 bit.  Message i is the bytes between offsets i and i + 1.  The same
+    files are read by scale/src/corpus.h.
+    """
+    MAGIC = b'AMQPCRP1'
+    _HEADER = struct.Struct('<8sQ')
+    _OFFSETS = struct.Struct('<QQ')
+
+    def __init__(self, path):
+        self.path = path
+        self._maps = []
+        self._data = self._map(path + '.dat')
+        self._index = self._map(path + '.idx')
+        if len(self._index) < self._HEADER.size:
+            raise Exception("%s.idx: not a corpus index" % path)
+        magic, self._count = self._HEADER.unpack_from(self._index, 0)
+        if (magic != self.MAGIC or len(self._index) <
+                self._HEADER.size + 8 * (self._count + 1)):
+            raise Exception("%s.idx: not a corpus index" % path)
+        self.data_size = len(self._data)
+        self._view = memoryview(self._data) if self._data else b''
+
+    def _map(self, path):
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(data)
+        return data
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        """Return message index as a zero-copy memoryview of the mapping."""
+        if not 0 <= index < self._count:
+            raise IndexError("corpus index out of range")
+        start, end = self._OFFSETS.unpack_from(self._index,
+                                               self._HEADER.size + 8 * index)
+        return self._view[start:end]
+
+    def close(self):
+        """Unmap the corpus.  A mapping with messages still referenced
+        (e.g. by a sender) is unmapped when the last of them is released.
+        """
+        self._view = b''
+        for data in self._maps:
+            try:
+                data.close()
+            except BufferError:
+                pass
+        self._maps = []
+
+
+class CorpusWriter(object):
+    """Build a Corpus from encoded messages."""
+    def __init__(self, path):
+        self.path = path
+        self._data = open(path + '.dat', 'wb')
+        self._offsets = array.array('Q', [0])
+
+    def append(self, encoded):
+        self._data.write(encoded)
+        self._offsets.append(self._offsets[-1] + len(encoded))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def close(self):
+        self._data.close()
+        offsets = self._offsets
+        if struct.pack('=H', 1) != struct.pack('<H', 1):
+            offsets = array.array('Q', offsets)
+            offsets.byteswap()
+        with open(self.path + '.idx', 'wb') as f:
+            f.write(Corpus._HEADER.pack(Corpus.MAGIC, len(self)))
+            f.write(offsets.tobytes())
+
+
+class CorpusMessage(object):
+    """Replay the messages of a Corpus, a drop-in for PreEncodedMessage.
+
+    stamp() selects the message to send next (sequence number modulo the
+    corpus size); the messages are sent exactly as recorded, straight from
+    the mapping, so they carry no timestamp or sequence number of their own.
+    len() is the average message size, for throughput figures.
+    """
+    def __init__(self, corpus):
+        if not len(corpus):
+            raise Exception("The corpus %s is empty" % corpus.path)
+        self._corpus = corpus
+        self._current = corpus[0]
+
+    def __len__(self):
+        return self._corpus.data_size // len(self._corpus)
+
+    def stamp(self, timestamp, sequence=0):
+        self._current = self._corpus[sequence % len(self._corpus)]
+
+    def encode(self):
+        return self._current
+
+    def send(self, sender, tag=None):
+        """Send on a proton Sender (see proton.Message.send)."""
+        dlv = sender.delivery(tag or sender.delivery_tag())
+        sender.stream(self._current)
+        sender.advance()
+        if sender.snd_settle_mode == sender.SND_SETTLED:
+            dlv.settle()
+        return dlv
+
+
+class SequenceTracker(object):
+    """Check the sequence numbers received from one sender for loss,
+    duplication and reordering.
+
+    Only a sliding window of the most recent sequence numbers is remembered,
+    one bit each, so memory is bounded and each check is O(1).  A number that
+    arrives after the window has moved past it is counted as 'late': it
+    cannot be told apart from a duplicate, and it is still counted as a gap.
+    The gaps are the numbers up to the highest seen that were not received,
+    so the trackers of one sender's messages at several receivers can be
+    merged (see merge()) before counting them.
+    """
+    def __init__(self, window=65536, first=0):
+        self._size = window
+        self._bits = bytearray(window // 8)
+        self._first = first
+        self._next = first  # one past the highest sequence seen
+        self.received = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.late = 0
+
+    @property
+    def gaps(self):
+        """Sequence numbers skipped and not (yet) received."""
+        distinct = self.received - self.duplicates - self.late
+        return self._next - self._first - distinct
+
+    def _clear(self, start, stop):
+        """Forget what the bits of the sequence numbers [start, stop) held a
+        window ago (stop - start < window).
+        """
+        lo = start % self._size
+        hi = lo + stop - start
+        if hi > self._size:
+            self._clear_bits(lo, self._size)
+            lo, hi = 0, hi - self._size
+        self._clear_bits(lo, hi)
+
+    def _clear_bits(self, lo, hi):
+        # the partial bytes at either end by mask, whole bytes by slice
+        bits = self._bits
+        first, last = lo >> 3, (hi - 1) >> 3
+        head = (0xff << (lo & 7)) & 0xff
+        tail = 0xff >> (7 - ((hi - 1) & 7))
+        if first == last:
+            bits[first] &= ~(head & tail) & 0xff
+        else:
+            bits[first] &= ~head & 0xff
+            bits[last] &= ~tail & 0xff
+            if last - first > 1:
+                bits[first + 1:last] = bytearray(last - first - 1)
+
+    def record(self, sequence):
+        self.received += 1
+        bits = self._bits
+        index = sequence % self._size
+        mask = 1 << (index & 7)
+        if sequence >= self._next:
+            skipped = sequence - self._next
+            if skipped >= self._size:
+                self._bits = bits = bytearray(len(bits))
+            elif skipped:
+                self._clear(self._next, sequence)
+            bits[index >> 3] |= mask
+            self._next = sequence + 1
+        elif sequence < self._next - self._size:
+            self.late += 1
+        elif bits[index >> 3] & mask:
+            self.duplicates += 1
+        else:
+            bits[index >> 3] |= mask
+            self.out_of_order += 1
+
+    def _window(self, start):
+        """The bits of the sequence numbers from start up to the highest
+        seen, as an int (bit N is the bit of sequence numbers N mod window).
+        """
+        count = self._next - start
+        if count <= 0:
+            return 0
+        value = int(binascii.hexlify(self._bits[::-1]), 16)
+        if count >= self._size:
+            return value
+        lo = start % self._size
+        mask = ((1 << count) - 1) << lo
+        if lo + count > self._size:
+            mask = (mask | (mask >> self._size)) & ((1 << self._size) - 1)
+        return value & mask
+
+    def merge(self, other):
+        """Add the sequence numbers that other received from the same sender,
+        e.g. at another receiver of a balanced address.  Numbers received by
+        both within the last window are counted as duplicates, earlier ones
+        cannot be told apart.
+        """
+        if other._size != self._size:
+            raise Exception("Cannot merge sequence windows of different"
+                            " sizes")
+        start = max(self._next, other._next) - self._size
+        mine = self._window(start)
+        theirs = other._window(start)
+        merged = "%x" % (mine | theirs)
+        merged = binascii.unhexlify(merged.zfill(len(self._bits) * 2))
+        self._bits = bytearray(merged[::-1])
+        self.duplicates += other.duplicates + bin(mine & theirs).count('1')
+        self.received += other.received
+        self.out_of_order += other.out_of_order
+        self.late += other.late
+        self._first = min(self._first, other._first)
+        self._next = max(self._next, other._next)
+
+    def to_dict(self):
+        return {'window': self._size,
+                'first': self._first,
+                'next': self._next,
+                'received': self.received,
+                'duplicates': self.duplicates,
+                'out_of_order': self.out_of_order,
+                'late': self.late,
+                'bits': base64.b64encode(bytes(self._bits)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, values):
+        tracker = cls(values['window'], values['first'])
+        tracker._next = values['next']
+        for name in ('received', 'duplicates', 'out_of_order', 'late'):
+            setattr(tracker, name, values[name])
+        tracker._bits = bytearray(base64.b64decode(values['bits']))
+        return tracker
+
+
+class SequenceChecker(object):
+    """Track the sequence numbers of many senders, each identified by the
+    group-id of its messages (see PreEncodedMessage).
+    """
+    COUNTS = ('senders', 'received', 'gaps', 'duplicates', 'out_of_order',
+              'late')
+
+    def __init__(self, window=65536):
+        self._window = window
+        self._trackers = {}
+
+    def record(self, message):
+        """Check a received message.  Messages without a sequence number or
+        a sender (group-id), e.g. replayed from a corpus, are ignored.
+        """
+        sequence = message.id
+        if (not isinstance(sequence, int) or sequence < 0 or
+                message.group_id is None):
+            return
+        tracker = self._trackers.get(message.group_id)
+        if tracker is None:
+            tracker = SequenceTracker(self._window)
+            self._trackers[message.group_id] = tracker
+        tracker.record(sequence)
+
+    def counts(self):
+        """Return the totals across all senders as a dict."""
+        counts = dict((name, 0) for name in self.COUNTS)
+        counts['senders'] = len(self._trackers)
+        for tracker in self._trackers.values():
+            for name in self.COUNTS[1:]:
+                counts[name] += getattr(tracker, name)
+        return counts
+
+    def merge(self, other):
+        """Merge the trackers of another SequenceChecker that received from
+        the same senders (see SequenceTracker.merge).
+        """
+        for group_id, tracker in other._trackers.items():
+            mine = self._trackers.get(group_id)
+            if mine is None:
+                mine = SequenceTracker(self._window)
+                self._trackers[group_id] = mine
+            mine.merge(tracker)
+        return self
+
+    def to_dict(self):
+        return {'window': self._window,
+                'senders': dict((group_id, tracker.to_dict())
+                                for group_id, tracker
+                                in self._trackers.items())}
+
+    @classmethod
+    def from_dict(cls, values):
+        checker = cls(values['window'])
+        for group_id, tracker in values['senders'].items():
+            checker._trackers[group_id] = SequenceTracker.from_dict(tracker)
+        return checker
+
+    @classmethod
+    def merge_counts(cls, counts, other):
+        """Add the counts from other into counts."""
+        for name in cls.COUNTS:
+            counts[name] = counts.get(name, 0) + other.get(name, 0)
+        return counts
+
+    @staticmethod
+    def format_counts(counts):
+        return (" Sequence: senders %d received %d gaps %d duplicates %d"
+                " out-of-order %d late %d"
+                % tuple(counts.get(name, 0)
+                        for name in SequenceChecker.COUNTS))
+
+    def report(self):
+        return self.format_counts(self.counts())
+
 
 # Map the send callback status to a string
 SEND_STATUS = {
@@ -136,3 +852,369 @@ SEND_STATUS = {
     pyngus.SenderLink.RELEASED: "RELEASED",
     pyngus.SenderLink.MODIFIED: "MODIFIED"
 }
+
+
+class LatencyHistogram(object):
+    """A log-bucketed (HDR style) histogram of latency samples.
+
+    Samples are given in seconds and stored as whole microseconds in a fixed
+    size array of counters.  Values below 2**sub_bits usecs are counted
+    exactly, larger values are grouped into 2**(sub_bits-1) linear buckets per
+    power of two, which bounds the relative error to 1/2**(sub_bits-1).
+    Samples larger than max_value are counted in the last bucket.
+    Histograms with the same configuration can be merged.
+    """
+    PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+    def __init__(self, sub_bits=7, max_value=3600.0):
+        self.sub_bits = sub_bits
+        self.max_value = max_value
+        self._half = 1 << (sub_bits - 1)
+        self._max_index = self._index(int(max_value * 1000000))
+        self._counts = array.array('L', [0]) * (self._max_index + 1)
+        self.count = 0
+        self.total = 0  # usecs
+        self.min = None  # usecs
+        self.max = 0  # usecs
+
+    def _index(self, usecs):
+        shift = usecs.bit_length() - self.sub_bits
+        if shift <= 0:
+            return usecs
+        return shift * self._half + (usecs >> shift)
+
+    def _bounds(self, index):
+        """Return the range of usec values [low, high] counted by index."""
+        if index < 2 * self._half:
+            return index, index
+        shift = index // self._half - 1
+        low = (index - shift * self._half) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, seconds):
+        usecs = max(int(seconds * 1000000), 0)
+        index = min(self._index(usecs), self._max_index)
+        self._counts[index] += 1
+        self.count += 1
+        self.total += usecs
+        if self.min is None or usecs < self.min:
+            self.min = usecs
+        if usecs > self.max:
+            self.max = usecs
+
+    def merge(self, other):
+        """Add the samples from other into this histogram."""
+        if (other.sub_bits != self.sub_bits or
+                len(other._counts) != len(self._counts)):
+            raise Exception("Cannot merge histograms with different layouts")
+        counts = self._counts
+        for index, n in enumerate(other._counts):
+            if n:
+                counts[index] += n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def copy(self):
+        hist = LatencyHistogram(self.sub_bits, self.max_value)
+        hist._counts = array.array(self._counts.typecode, self._counts)
+        hist.count = self.count
+        hist.total = self.total
+        hist.min = self.min
+        hist.max = self.max
+        return hist
+
+    def since(self, earlier):
+        """Return a histogram of the samples recorded after earlier, a copy()
+        of this histogram.  Its min and max are only as exact as the buckets.
+        """
+        hist = LatencyHistogram(self.sub_bits, self.max_value)
+        counts = hist._counts
+        low = high = None
+        for index, (n, m) in enumerate(zip(self._counts, earlier._counts)):
+            if n != m:
+                counts[index] = n - m
+                if low is None:
+                    low = index
+                high = index
+        hist.count = self.count - earlier.count
+        hist.total = self.total - earlier.total
+        if low is not None:
+            hist.min = self._bounds(low)[0]
+            hist.max = min(self._bounds(high)[1], self.max)
+        return hist
+
+    def reset(self):
+        for index in range(len(self._counts)):
+            self._counts[index] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @property
+    def mean(self):
+        return self.total / 1000000.0 / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        """Value (seconds) at or below which pct percent of samples fall."""
+        if not self.count:
+            return 0.0
+        target = max(int(math.ceil(self.count * pct / 100.0)), 1)
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if seen >= target:
+                high = min(self._bounds(index)[1], self.max)
+                return high / 1000000.0
+        return self.max / 1000000.0
+
+    def buckets(self):
+        """Yield (low, high, count) in seconds for each non-empty octave."""
+        octave = None
+        count = 0
+        for index, n in enumerate(self._counts):
+            if not n:
+                continue
+            low = self._bounds(index)[0]
+            # group sub-buckets by power of two:
+            key = low.bit_length()
+            if key != octave:
+                if count:
+                    yield self._octave(octave) + (count,)
+                octave = key
+                count = 0
+            count += n
+        if count:
+            yield self._octave(octave) + (count,)
+
+    @staticmethod
+    def _octave(bits):
+        low = (1 << (bits - 1)) if bits else 0
+        high = (1 << bits) if bits else 1
+        return low / 1000000.0, high / 1000000.0
+
+    @staticmethod
+    def _label(pct):
+        return "p%s" % ("%f" % pct).rstrip('0').rstrip('.')
+
+    def summary(self):
+        values = ["mean %f" % self.mean]
+        values.extend("%s %f" % (self._label(p), self.percentile(p))
+                      for p in self.PERCENTILES)
+        values.append("max %f" % (self.max / 1000000.0))
+        return " ".join(values)
+
+    def summary_dict(self):
+        """Return the summary statistics (seconds) as a JSON-friendly dict."""
+        values = {'samples': self.count,
+                  'mean': self.mean,
+                  'max': self.max / 1000000.0}
+        for p in self.PERCENTILES:
+            values[self._label(p)] = self.percentile(p)
+        return values
+
+    def report(self, title):
+        """Return a printable summary of the histogram as a list of lines."""
+        lines = [" %s (%d samples): %s" % (title, self.count, self.summary())]
+        cumulative = 0
+        for low, high, n in self.buckets():
+            cumulative += n
+            lines.append("   [%f, %f) %10d %7.3f%%"
+                         % (low, high, n, 100.0 * cumulative / self.count))
+        return lines
+
+    def to_dict(self):
+        """Return a JSON-friendly representation of the histogram."""
+        return {'sub_bits': self.sub_bits,
+                'max_value': self.max_value,
+                'count': self.count,
+                'total': self.total,
+                'min': self.min,
+                'max': self.max,
+                'counts': dict((str(i), n)
+                               for i, n in enumerate(self._counts) if n)}
+
+    @classmethod
+    def from_dict(cls, values):
+        hist = cls(values['sub_bits'], values['max_value'])
+        for index, n in values['counts'].items():
+            hist._counts[int(index)] = n
+        hist.count = values['count']
+        hist.total = values['total']
+        hist.min = values['min']
+        hist.max = values['max']
+        return hist
+
+
+class IntervalReporter(object):
+    """Report what happened in each interval of a run, one row per interval.
+
+    The values are sampled from the clients' own cumulative state - message
+    counters, gauges such as the messages in flight, and LatencyHistograms -
+    so nothing is added to the per-message path.  Counters are reported as
+    rates over the interval, and histograms as the percentiles of the
+    samples recorded during the interval.
+
+    Rows are written as text, CSV (with a header) or JSON lines to a file,
+    or to stdout if path is None.  Call start() to report from an EventLoop
+    timer, or call report() from another loop.
+    """
+    FORMATS = ('text', 'csv', 'json')
+    PERCENTILES = (50.0, 90.0, 99.0)
+
+    def __init__(self, interval=1.0, path=None, fmt='text', fields=None):
+        if fmt not in self.FORMATS:
+            raise Exception("Unknown interval report format '%s'" % fmt)
+        if interval <= 0:
+            raise Exception("The report interval must be greater than 0")
+        self.interval = interval
+        self._format = fmt
+        self._out = open(path, 'w') if path else sys.stdout
+        self._fields = fields or {}  # constant columns, e.g. a process index
+        self._counters = []
+        self._gauges = []
+        self._histograms = []
+        self._columns = None
+        self._start = None
+        self._last = None
+        self._stopped = False
+
+    def counter(self, name, sample):
+        """Report the rate of a counter: sample() returns its total."""
+        self._counters.append((name, sample, [0]))
+
+    def gauge(self, name, sample):
+        """Report the current value returned by sample()."""
+        self._gauges.append((name, sample))
+
+    def histograms(self, name, sample):
+        """Report the interval percentiles of the LatencyHistograms returned
+        by sample() (merged).
+        """
+        self._histograms.append((name, sample, {}))
+
+    def start(self, loop, now=None):
+        """Begin the interval timer on an EventLoop."""
+        self.begin(now)
+        self._schedule(loop, self._start + self.interval)
+
+    def begin(self, now=None):
+        """Start the first interval, and take the initial samples."""
+        self._start = self._last = now or time.time()
+        for name, sample, last in self._counters:
+            last[0] = sample()
+        for name, sample, last in self._histograms:
+            for hist in sample():
+                last[id(hist)] = hist.copy()
+
+    def _schedule(self, loop, deadline):
+        def tick():
+            if self._stopped:
+                return
+            now = time.time()
+            self.report(now)
+            next_deadline = deadline + self.interval
+            while next_deadline <= now:  # the loop fell behind, skip
+                next_deadline += self.interval
+            self._schedule(loop, next_deadline)
+        loop.call_at(deadline, tick)
+
+    def stop(self, now=None):
+        """Report the final (partial) interval and stop the timer."""
+        if not self._stopped and self._start is not None:
+            self.report(now)
+        self._stopped = True
+        if self._out is not sys.stdout:
+            self._out.close()
+
+    def report(self, now=None):
+        """Write the row for the interval that ends now."""
+        now = now or time.time()
+        elapsed = now - self._last
+        row = [('time', now), ('elapsed', now - self._start)]
+        row.extend(sorted(self._fields.items()))
+        for name, sample, last in self._counters:
+            value = sample()
+            row.append((name + '_per_sec',
+                        (value - last[0]) / elapsed if elapsed > 0 else 0.0))
+            last[0] = value
+        for name, sample in self._gauges:
+            row.append((name, sample()))
+        for name, sample, last in self._histograms:
+            interval = LatencyHistogram()
+            for hist in sample():
+                earlier = last.get(id(hist))
+                if earlier is not None and earlier.count == hist.count:
+                    continue  # nothing new
+                interval.merge(hist.since(earlier) if earlier else hist)
+                last[id(hist)] = hist.copy()
+            row.append((name + '_samples', interval.count))
+            for pct in self.PERCENTILES:
+                row.append(('%s_%s' % (name, LatencyHistogram._label(pct)),
+                            interval.percentile(pct)))
+            row.append((name + '_max', interval.max / 1000000.0))
+        self._last = now
+        self._write(row)
+
+    def _write(self, row):
+        if self._format == 'json':
+            line = json.dumps(dict(row), sort_keys=True)
+        elif self._format == 'csv':
+            if self._columns is None:
+                self._columns = [name for name, _ in row]
+                self._out.write(",".join(self._columns) + "\n")
+            line = ",".join(self._csv_value(value) for _, value in row)
+        else:
+            line = " ".join("%s=%s" % (name, self._text_value(value))
+                            for name, value in row[1:])
+        self._out.write(line + "\n")
+        self._out.flush()
+
+    @staticmethod
+    def _csv_value(value):
+        return repr(value) if isinstance(value, float) else str(value)
+
+    @staticmethod
+    def _text_value(value):
+        return "%.6g" % value if isinstance(value, float) else str(value)
+
+
+def perf_results(tool, tx_messages, tx_duration, rx_messages, rx_duration,
+                 ack_latency, rx_latency, tx_bytes=None, sequence=None):
+    """Return a perf tool's results in the common format printed by --json.
+    Durations are in seconds, None if unknown.
+    """
+    def rate(count, duration):
+        return count / duration if duration else 0.0
+    results = {'tool': tool,
+               'tx_messages': tx_messages,
+               'tx_duration': tx_duration,
+               'tx_msgs_per_sec': rate(tx_messages, tx_duration),
+               'rx_messages': rx_messages,
+               'rx_duration': rx_duration,
+               'rx_msgs_per_sec': rate(rx_messages, rx_duration),
+               'ack_latency': ack_latency.summary_dict(),
+               'rx_latency': rx_latency.summary_dict()}
+    if tx_bytes is not None:
+        results['tx_mb_per_sec'] = rate(tx_bytes, tx_duration) / 1000000.0
+    if sequence is not None:
+        results['sequence'] = sequence
+    return results
+
+
+def save_histograms(path, histograms):
+    """Write a dict of named LatencyHistograms to a JSON file."""
+    with open(path, 'w') as f:
+        json.dump(dict((name, hist.to_dict())
+                       for name, hist in histograms.items()), f)
+
+
+def load_histograms(path):
+    """Read a dict of named LatencyHistograms written by save_histograms."""
+    with open(path) as f:
+        return dict((name, LatencyHistogram.from_dict(values))
+                    for name, values in json.load(f).items())